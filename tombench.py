@@ -0,0 +1,546 @@
+"""Benchmarks for Tom's Searching Thingy
+See README for more details
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+import uuid
+
+try:
+    import resource
+except ImportError:
+    # Peak memory isn't reported where the resource module isn't available
+    resource = None
+
+import tomsearch
+
+LOREM = ("lorem ipsum dolor sit amet consectetur adipiscing elit sed do eiusmod tempor incididunt ut "
+         "labore et dolore magna aliqua enim ad minim veniam quis nostrud exercitation ullamco laboris "
+         "nisi aliquip ex ea commodo consequat duis aute irure in reprehenderit voluptate velit esse "
+         "cillum fugiat nulla pariatur excepteur sint occaecat cupidatat non proident sunt culpa qui "
+         "officia deserunt mollit anim id est laborum").split()
+
+SYLLABLES = ("al", "an", "ber", "bo", "ca", "cor", "da", "del", "el", "en", "fa", "gan", "ha", "is",
+             "ja", "ka", "lin", "lo", "ma", "mer", "na", "nor", "o", "pel", "qui", "ra", "ros", "sa",
+             "son", "ta", "tor", "u", "va", "wil", "xen", "ya", "zen")
+PLACES = ("Ohio", "Pennsylvania", "American Samoa", "Northern Mariana Islands", "Idaho", "Texas",
+          "Georgia", "Utah", "Maine", "Oregon", "Alaska", "Nevada", "Iowa", "Kansas", "Vermont",
+          "Virginia", "Guam", "Puerto Rico", "Fulton", "West", "Rodriguez", "Springville", "Sutton",
+          "Diaperville", "Hartsville/Hartley", "Farley", "Wyoming", "Montana", "Delaware", "Alabama")
+COUNTRIES = ("Korea (North)", "Korea (South)", "Malawi", "Kiribati", "Saint Lucia", "Micronesia",
+             "Russian Federation", "Peru", "Norway", "Egypt", "Fiji", "Chile", "Iceland", "Nepal",
+             "Ghana", "Tonga", "Belize", "Latvia", "Mongolia", "Uruguay", "Oman", "Laos", "Gabon")
+TROUBLES = ("Catastrophe", "Problem", "Nuisance", "Drama")
+OFFSETS = ("-10:00", "-11:00", "-01:00", "+10:00")
+# Timestamps are generated between these seconds since the epoch (2013-01-01 and 2017-01-01)
+TIMESTAMP_RANGE = (1356998400, 1483228800)
+# Sizes of the generated orgs and users compared to the number of tickets, as in the bundled data
+ORGS_PER_TICKET = 1 / 8
+USERS_PER_TICKET = 3 / 8
+# The files loaded by tomsearch, with the search type and schema of each
+DATA_FILES = (("organizations.json", "orgs", tomsearch.ORGS_SCHEMA),
+              ("users.json", "users", tomsearch.USERS_SCHEMA),
+              ("tickets.json", "tickets", tomsearch.TICKETS_SCHEMA))
+# Fields of the suite's results that are measurements rather than describing what was measured
+MEASUREMENTS = ("seconds", "index_seconds", "first_seconds", "p50", "p95", "p99", "max", "bytes",
+                "speedup", "requests_per_second")
+
+TICKET_SCHEMA = {
+    "_id": str,
+    "subject": str,
+    "description": str,
+    "status": str,
+    "organization_id": int,
+}
+
+# Mix of requests sent by each client of the server benchmark
+SERVER_REQUESTS = [
+    {"command": "search tickets status open"},
+    {"command": "next"},
+    {"command": "search users _id 1"},
+    {"command": "search tickets text problem"},
+    {"command": "search tickets tags any Ohio Texas"},
+    {"command": "search tickets organization.name Enthaze AND status pending"},
+    {"command": "search users email contains @flotonic"},
+    {"complete": "search users name Fr", "text": "Fr"},
+]
+
+
+def synthetic_tickets(count, seed=0):
+    """Yield count simple ticket records with random descriptions"""
+    rand = random.Random(seed)
+    statuses = ["open", "pending", "hold", "solved", "closed"]
+    for number in range(count):
+        yield {
+            "_id": "ticket-{:08d}".format(number),
+            "subject": " ".join(rand.choices(LOREM, k=4)),
+            "description": " ".join(rand.choices(LOREM, k=16)) + " {}".format(number),
+            "status": rand.choice(statuses),
+            "organization_id": rand.randrange(1000),
+        }
+
+
+def synthetic_word(rand, syllables=3):
+    """Return a made up capitalised word"""
+    return "".join(rand.choice(SYLLABLES) for _ in range(rand.randint(2, syllables))).capitalize()
+
+
+def synthetic_uuid(rand):
+    """Return a random uuid string"""
+    return str(uuid.UUID(int=rand.getrandbits(128), version=4))
+
+
+def synthetic_timestamp(rand):
+    """Return a random timestamp in the format of the json files"""
+    seconds = rand.randrange(*TIMESTAMP_RANGE)
+    return time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(seconds)) + " " + rand.choice(OFFSETS)
+
+
+def synthetic_orgs(count, rand):
+    """Yield count organization records, with ids from 101"""
+    for org_id in range(101, 101 + count):
+        name = synthetic_word(rand)
+        yield {
+            "_id": org_id,
+            "url": "http://initech.zendesk.com/api/v2/organizations/{}.json".format(org_id),
+            "external_id": synthetic_uuid(rand),
+            "name": name,
+            "domain_names": ["{}.com".format(synthetic_word(rand).lower())
+                             for _ in range(rand.randint(1, 4))],
+            "created_at": synthetic_timestamp(rand),
+            "details": rand.choice(("MegaCorp", "Non profit", "Artisan")),
+            "shared_tickets": rand.random() < 0.5,
+            "tags": rand.sample(PLACES, 4),
+        }
+
+
+def synthetic_users(count, org_count, rand):
+    """Yield count user records, with ids from 1, each in one of org_count orgs"""
+    for user_id in range(1, count + 1):
+        first, last = synthetic_word(rand), synthetic_word(rand)
+        yield {
+            "_id": user_id,
+            "url": "http://initech.zendesk.com/api/v2/users/{}.json".format(user_id),
+            "external_id": synthetic_uuid(rand),
+            "name": "{} {}".format(first, last),
+            "alias": "{} {}".format(rand.choice(("Miss", "Mr")), synthetic_word(rand)),
+            "created_at": synthetic_timestamp(rand),
+            "active": rand.random() < 0.5,
+            "verified": rand.random() < 0.5,
+            "shared": rand.random() < 0.5,
+            "locale": rand.choice(("en-AU", "zh-CN", "de-CH")),
+            "timezone": rand.choice(COUNTRIES),
+            "last_login_at": synthetic_timestamp(rand),
+            "email": "{}{}@{}.com".format(first.lower(), last.lower(), synthetic_word(rand).lower()),
+            "phone": "{:04d}-{:03d}-{:03d}".format(rand.randrange(10000), rand.randrange(1000),
+                                                   rand.randrange(1000)),
+            "signature": "Don't Worry Be Happy!",
+            "organization_id": rand.randrange(101, 101 + org_count),
+            "tags": rand.sample(PLACES, 4),
+            "suspended": rand.random() < 0.5,
+            "role": rand.choice(("admin", "agent", "end-user")),
+        }
+
+
+def synthetic_related_tickets(count, org_count, user_count, rand):
+    """Yield count ticket records, each submitted by, assigned to and in existing users and orgs"""
+    for _ in range(count):
+        ticket_id = synthetic_uuid(rand)
+        description = " ".join(rand.choices(LOREM, k=rand.randint(8, 24)))
+        yield {
+            "_id": ticket_id,
+            "url": "http://initech.zendesk.com/api/v2/tickets/{}.json".format(ticket_id),
+            "external_id": synthetic_uuid(rand),
+            "created_at": synthetic_timestamp(rand),
+            "type": rand.choice(("incident", "problem", "question", "task")),
+            "subject": "A {} in {}".format(rand.choice(TROUBLES), rand.choice(COUNTRIES)),
+            "description": description.capitalize() + ".",
+            "priority": rand.choice(("high", "low", "normal", "urgent")),
+            "status": rand.choice(("closed", "hold", "open", "pending", "solved")),
+            "submitter_id": rand.randint(1, user_count),
+            "assignee_id": rand.randint(1, user_count),
+            "organization_id": rand.randrange(101, 101 + org_count),
+            "tags": rand.sample(PLACES, 4),
+            "has_incidents": rand.random() < 0.5,
+            "due_at": synthetic_timestamp(rand),
+            "via": rand.choice(("chat", "voice", "web")),
+        }
+
+
+def write_json_array(filename, records):
+    """Write records to a json file one at a time, so they are never all held in memory
+    :return: The number of records written"""
+    count = 0
+    with open(filename, "w") as jsonfile:
+        jsonfile.write("[")
+        for record in records:
+            jsonfile.write(",\n" if count else "\n")
+            jsonfile.write(json.dumps(record))
+            count += 1
+        jsonfile.write("\n]\n")
+    return count
+
+
+def generate(directory, tickets, seed=0):
+    """Write organizations.json, users.json and tickets.json to directory, with the given number
+    of tickets and orgs and users in proportion, every reference between them pointing at a record
+    :return: The number of records written to each file, by file name"""
+    rand = random.Random(seed)
+    org_count = max(1, int(tickets * ORGS_PER_TICKET))
+    user_count = max(1, int(tickets * USERS_PER_TICKET))
+    os.makedirs(directory, exist_ok=True)
+    return {
+        "organizations.json": write_json_array(os.path.join(directory, "organizations.json"),
+                                               synthetic_orgs(org_count, rand)),
+        "users.json": write_json_array(os.path.join(directory, "users.json"),
+                                       synthetic_users(user_count, org_count, rand)),
+        "tickets.json": write_json_array(os.path.join(directory, "tickets.json"),
+                                         synthetic_related_tickets(tickets, org_count, user_count,
+                                                                   rand)),
+    }
+
+
+def peak_rss():
+    """Return the most memory this process has used so far, in bytes, or None if unknown"""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes and macOS bytes
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def best_time(function, repeat):
+    """Return the shortest time of repeat calls to function, and its last result"""
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function()
+        timings.append(time.perf_counter() - start)
+    return min(timings), result
+
+
+def report(outp):
+    """Write one benchmark result as a json line"""
+    print(json.dumps(outp))
+    sys.stdout.flush()
+
+
+def bench_scan(args):
+    """Time contains and matches scans of synthetic tickets with different numbers of processes"""
+    start = time.perf_counter()
+    tickets = tomsearch.ValidatedDictList(None, "tickets", TICKET_SCHEMA,
+                                          records=synthetic_tickets(args.records))
+    tomsearch.SEARCH_TYPES = {"tickets": tickets}
+    tomsearch.DATA_GENERATION += 1
+    report({"benchmark": "scan_load", "records": args.records,
+            "seconds": time.perf_counter() - start})
+    conditions = [("description", tomsearch.MODE_CONTAINS, "{}".format(args.records // 2)),
+                  ("description", tomsearch.MODE_MATCHES, r"dolor\w* sit"),
+                  ("status", tomsearch.MODE_CONTAINS, "en")]
+    baseline = {}
+    for jobs in args.jobs:
+        tomsearch.set_scan_jobs(jobs)
+        for field_name, mode, needle in conditions:
+            # The first scan starts the pool, which isn't part of the timing
+            tomsearch.scan_positions(tickets, field_name, mode, "$^" if mode == tomsearch.MODE_MATCHES
+                                     else "\0")
+            timings = []
+            for _ in range(args.repeat):
+                start = time.perf_counter()
+                found = tomsearch.scan_positions(tickets, field_name, mode, needle)
+                timings.append(time.perf_counter() - start)
+            best = min(timings)
+            key = (field_name, mode, needle)
+            baseline.setdefault(key, best)
+            report({"benchmark": "scan", "records": args.records, "jobs": jobs,
+                    "cpus": os.cpu_count(), "field": field_name, "mode": mode, "needle": needle,
+                    "matches": len(found), "seconds": best, "speedup": baseline[key] / best})
+    tomsearch.SCAN_POOL.close()
+
+
+def bench_generate(args):
+    """Write a generated data set"""
+    start = time.perf_counter()
+    counts = generate(args.output, args.tickets, args.seed)
+    for filename, records in counts.items():
+        report({"benchmark": "generate", "file": filename, "records": records})
+    report({"benchmark": "generate_total", "tickets": args.tickets,
+            "seconds": time.perf_counter() - start})
+
+
+def environment():
+    """Describe the machine and version being benchmarked"""
+    outp = {"benchmark": "environment", "python": platform.python_version(),
+            "platform": platform.platform(), "cpus": os.cpu_count()}
+    try:
+        outp["commit"] = subprocess.check_output(
+            ["git", "rev-parse", "HEAD"], stderr=subprocess.DEVNULL, universal_newlines=True,
+            cwd=os.path.dirname(os.path.abspath(tomsearch.__file__))).strip()
+    except (OSError, subprocess.CalledProcessError):
+        pass
+    return outp
+
+
+def bench_suite(args):
+    """Time loading, exact searches of every field, gathering related records and completion
+    on a generated data set, reporting the peak memory used. Without --data the data set is
+    generated in a temporary directory, removed afterwards."""
+    if args.data:
+        run_suite(args, args.data)
+    else:
+        with tempfile.TemporaryDirectory(prefix="tombench-") as directory:
+            run_suite(args, directory)
+
+
+def run_suite(args, directory):
+    """Run the suite on the files in directory, generating them if they are missing"""
+    report(dict(environment(), storage=args.storage))
+    dict_list = (tomsearch.SqliteDictList if args.storage == tomsearch.STORAGE_SQLITE
+                 else tomsearch.ValidatedDictList)
+    if not all(os.path.exists(os.path.join(directory, filename)) for filename, _, _ in DATA_FILES):
+        generate(directory, args.tickets, args.seed)
+    rand = random.Random(args.seed)
+    stored = {}
+    for filename, search_type_key, schema in DATA_FILES:
+        path = os.path.join(directory, filename)
+        start = time.perf_counter()
+        records = sum(1 for _ in tomsearch.iterloadfile(path))
+        report({"benchmark": "parse", "file": filename, "records": records,
+                "seconds": time.perf_counter() - start})
+        start = time.perf_counter()
+        stored[search_type_key] = dict_list(path, search_type_key, schema)
+        report({"benchmark": "load", "file": filename, "records": records,
+                "seconds": time.perf_counter() - start})
+    tomsearch.ORGS, tomsearch.USERS, tomsearch.TICKETS = (stored["orgs"], stored["users"],
+                                                          stored["tickets"])
+    tomsearch.SEARCH_TYPES = stored
+    start = time.perf_counter()
+    tomsearch.RELATIONS = tomsearch.Relationships(stored["orgs"], stored["users"], stored["tickets"])
+    tomsearch.DATA_GENERATION += 1
+    report({"benchmark": "relationships", "seconds": time.perf_counter() - start})
+    report({"benchmark": "loaded_rss", "bytes": peak_rss()})
+
+    for search_type_key, validated_dict_list in sorted(stored.items()):
+        values = validated_dict_list.values
+        for field_name in validated_dict_list.fields:
+            value = values[rand.randrange(len(values))][field_name]
+            start = time.perf_counter()
+            validated_dict_list.index(field_name)
+            index_seconds = time.perf_counter() - start
+            seconds, found = best_time(
+                lambda: tomsearch.find_all(validated_dict_list, field_name, value), args.repeat)
+            report({"benchmark": "find_all", "type": search_type_key, "field": field_name,
+                    "matches": len(found), "index_seconds": index_seconds, "seconds": seconds})
+
+    for search_type_key, validated_dict_list in sorted(stored.items()):
+        values = validated_dict_list.values
+        sample = [values[rand.randrange(len(values))] for _ in range(args.samples)]
+        def join():
+            for record in sample:
+                tomsearch.create_result(search_type_key, record).as_dict()
+        seconds, _ = best_time(join, args.repeat)
+        report({"benchmark": "join", "type": search_type_key, "results": len(sample),
+                "seconds": seconds / len(sample)})
+
+    commands = tomsearch.SearchCommands()
+    for search_type_key, field_name in (("users", "name"), ("users", "email"),
+                                        ("orgs", "name"), ("tickets", "subject")):
+        values = stored[search_type_key].values
+        value = str(values[rand.randrange(len(values))][field_name])
+        base = "search {} {} ".format(search_type_key, field_name)
+        timings = []
+        for length in range(1, len(value) + 1):
+            line = base + value[:length]
+            # readline completes the text after the last space
+            begidx = max(len(base), line.rfind(" ") + 1)
+            start = time.perf_counter()
+            commands.complete_search(line[begidx:], line, begidx, len(line))
+            timings.append(time.perf_counter() - start)
+        first = timings.pop(0)
+        timings.sort()
+        report({"benchmark": "completion", "type": search_type_key, "field": field_name,
+                "keystrokes": len(timings) + 1, "first_seconds": first,
+                "p50": percentile(timings, 0.5) if timings else first,
+                "max": timings[-1] if timings else first})
+    report({"benchmark": "peak_rss", "bytes": peak_rss()})
+
+
+def result_key(result):
+    """Return what a benchmark result describes, without its measurements"""
+    return tuple(sorted((name, value) for name, value in result.items()
+                        if name not in MEASUREMENTS and not isinstance(value, float)))
+
+
+def bench_compare(args):
+    """Report the ratio of each measurement in the new results to the old ones"""
+    with open(args.old) as oldfile:
+        old = {result_key(result): result for result in map(json.loads, oldfile)}
+    with open(args.new) as newfile:
+        for result in map(json.loads, newfile):
+            previous = old.get(result_key(result))
+            if previous is None or result["benchmark"] == "environment":
+                continue
+            for name, value in result.items():
+                before = previous.get(name)
+                if (name in MEASUREMENTS or isinstance(value, float)) and before and value is not None:
+                    report(dict(result_key(result), measurement=name, old=before, new=value,
+                                ratio=value / before))
+
+
+def percentile(timings, fraction):
+    """Return the timing that fraction of the sorted timings are at or below"""
+    return timings[min(len(timings) - 1, int(len(timings) * fraction))]
+
+
+async def server_client(host, port, requests, seed, latencies):
+    """Send requests from the mix to the server one at a time, recording each one's latency"""
+    reader, writer = await asyncio.open_connection(host, port)
+    rand = random.Random(seed)
+    try:
+        for _ in range(requests):
+            request = rand.choice(SERVER_REQUESTS)
+            start = time.perf_counter()
+            writer.write(json.dumps(request).encode() + b"\n")
+            await writer.drain()
+            response = json.loads(await reader.readline())
+            elapsed = time.perf_counter() - start
+            if "error" in response:
+                raise RuntimeError("{} failed: {}".format(request, response["error"]))
+            kind = request.get("command") or "complete " + request["complete"]
+            latencies.setdefault(kind, []).append(elapsed)
+    finally:
+        writer.close()
+
+
+async def server_load(host, port, clients, requests):
+    """Run clients against the server at once, returning the latencies of each kind of request"""
+    latencies = {}
+    await asyncio.gather(*(server_client(host, port, requests, seed, latencies)
+                           for seed in range(clients)))
+    return latencies
+
+
+def bench_server(args):
+    """Time requests to a search server from increasing numbers of concurrent clients
+    A server for the json files next to tomsearch.py is started unless --port is given"""
+    process = None
+    port = args.port
+    if port is None:
+        process = subprocess.Popen(
+            [sys.executable, os.path.abspath(tomsearch.__file__), "--serve", "{}:0".format(args.host),
+             "--threads", str(args.threads)],
+            cwd=os.path.dirname(os.path.abspath(tomsearch.__file__)),
+            stderr=subprocess.PIPE, universal_newlines=True)
+        started = process.stderr.readline()
+        if not started.startswith("Serving searches on "):
+            process.kill()
+            sys.exit("The server didn't start: " + started)
+        port = int(started.rsplit(":", 1)[1])
+    try:
+        for clients in args.clients:
+            start = time.perf_counter()
+            latencies = asyncio.run(server_load(args.host, port, clients, args.requests))
+            elapsed = time.perf_counter() - start
+            total = 0
+            for kind, timings in sorted(latencies.items()):
+                timings.sort()
+                total += len(timings)
+                report({"benchmark": "server_latency", "clients": clients, "request": kind,
+                        "requests": len(timings), "p50": percentile(timings, 0.5),
+                        "p95": percentile(timings, 0.95), "p99": percentile(timings, 0.99),
+                        "max": timings[-1]})
+            report({"benchmark": "server_throughput", "clients": clients, "requests": total,
+                    "seconds": elapsed, "requests_per_second": total / elapsed})
+    finally:
+        if process is not None:
+            process.send_signal(signal.SIGINT)
+            process.wait()
+
+
+def parse_args(argv=None):
+    """Parse the command line"""
+    parser = argparse.ArgumentParser(description="Benchmarks for Tom's Searching Thingy, "
+                                                 "writing one json line per result")
+    subparsers = parser.add_subparsers(dest="benchmark")
+    subparsers.required = True
+    scan = subparsers.add_parser("scan", help="parallel scans for contains and matches searches")
+    scan.add_argument("--records", type=int, default=2000000)
+    scan.add_argument("--jobs", type=int, nargs="+",
+                      default=sorted(set([1, 2, 4, os.cpu_count() or 1])))
+    scan.add_argument("--repeat", type=int, default=3)
+    scan.set_defaults(function=bench_scan)
+    server = subparsers.add_parser("server", help="latency and throughput of a search server "
+                                                  "under load from concurrent clients")
+    server.add_argument("--host", default=tomsearch.SERVER_HOST)
+    server.add_argument("--port", type=int, help="use a server already running on this port")
+    server.add_argument("--threads", type=int, default=tomsearch.SERVER_THREADS)
+    server.add_argument("--clients", type=int, nargs="+", default=[1, 4, 16, 64])
+    server.add_argument("--requests", type=int, default=100,
+                        help="number of requests sent by each client")
+    server.set_defaults(function=bench_server)
+    generator = subparsers.add_parser("generate", help="write organizations.json, users.json and "
+                                                       "tickets.json with consistent references")
+    generator.add_argument("--tickets", type=int, default=10000,
+                           help="number of tickets, with 1 org for every 8 and 3 users for every 8")
+    generator.add_argument("--output", required=True,
+                           help="directory to write the files to, which shouldn't be the one "
+                                "holding the bundled files the tests use")
+    generator.add_argument("--seed", type=int, default=0)
+    generator.set_defaults(function=bench_generate)
+    suite = subparsers.add_parser("suite", help="load, exact searches of every field, joins, "
+                                                "completion per keystroke and peak memory")
+    suite.add_argument("--tickets", type=int, default=10000,
+                       help="number of tickets to generate when there is no data")
+    suite.add_argument("--data", help="directory of the json files, generated if they are missing "
+                                      "(default: a new temporary directory)")
+    suite.add_argument("--seed", type=int, default=0)
+    suite.add_argument("--repeat", type=int, default=3)
+    suite.add_argument("--samples", type=int, default=1000,
+                       help="number of results to gather related records for")
+    suite.add_argument("--storage", choices=tomsearch.STORAGE_TYPES,
+                       default=tomsearch.STORAGE_MEMORY,
+                       help="where to keep the records, run once for each to compare them")
+    suite.set_defaults(function=bench_suite)
+    compare = subparsers.add_parser("compare", help="ratios of the measurements in two sets of "
+                                                    "results, new / old")
+    compare.add_argument("old")
+    compare.add_argument("new")
+    compare.set_defaults(function=bench_compare)
+    return parser.parse_args(argv)
+
+
+class TestGenerate(unittest.TestCase):
+    """Test the generated data sets"""
+    def test_generate(self):
+        """Test the generated files load under the schemas and their references resolve"""
+        with tempfile.TemporaryDirectory() as directory:
+            counts = generate(directory, 80)
+            stored = {search_type_key: tomsearch.ValidatedDictList(
+                          os.path.join(directory, filename), search_type_key, schema)
+                      for filename, search_type_key, schema in DATA_FILES}
+        self.assertEqual(counts, {"organizations.json": 10, "users.json": 30, "tickets.json": 80})
+        for filename, search_type_key, _ in DATA_FILES:
+            self.assertEqual(len(stored[search_type_key].values), counts[filename])
+        # Ids are unique, and every reference points at a record
+        relations = tomsearch.Relationships(stored["orgs"], stored["users"], stored["tickets"])
+        for user in stored["users"].values:
+            self.assertNotEqual(relations.org_name(user["organization_id"]), tomsearch.NONE_FOUND)
+        for ticket in stored["tickets"].values:
+            self.assertNotEqual(relations.org_name(ticket["organization_id"]),
+                                tomsearch.NONE_FOUND)
+            self.assertNotEqual(relations.user_name(ticket["submitter_id"]), tomsearch.NONE_FOUND)
+            self.assertNotEqual(relations.user_name(ticket["assignee_id"]), tomsearch.NONE_FOUND)
+
+
+if __name__ == "__main__":
+    ARGS = parse_args()
+    ARGS.function(ARGS)
@@ -1,13 +1,43 @@
 """Tom's Searching Thingy
 See README for more details
 """
+import ast
+import asyncio
+import bisect
+import calendar
+import concurrent.futures
+import cProfile
+import csv
+import hashlib
+import io
+import heapq
+import itertools
 import json
+import math
+import multiprocessing
+import os
+import pickle
+import pstats
+import re
+import shlex
+import shutil
+import socket
+import sqlite3
 import sys
+import tempfile
+import threading
+import time
+import abc
+import argparse
 import cmd
-import itertools
+import collections
+import contextlib
 import unittest
+import unittest.mock
 
-from pprint import pprint
+from array import array
+from collections.abc import Mapping, Sequence
+from pprint import pformat
 
 ## Magic strings
 # Field names
@@ -18,10 +48,201 @@ FIELD_ORGANIZATION_ID = "organization_id"
 FIELD_SUBJECT = "subject"
 FIELD_NAME = "name"
 FIELD_TAGS = "tags"
+# Returned in place of a related record's field when there is no such record
+NONE_FOUND = "None Found"
+
+# Match modes for searching the elements of list fields such as tags
+MODE_ANY = "any"
+MODE_ALL = "all"
+MEMBERSHIP_MODES = (MODE_ANY, MODE_ALL)
+# Match mode, and pseudo field name for all text fields, for ranked full text search
+MODE_TEXT = "text"
+# Free text fields covered by full text search, where present in a search type
+TEXT_FIELDS = ("subject", "description", "details", "signature", "name")
+# Match modes comparing int and timestamp fields, and the fields holding timestamps
+RANGE_MODES = (">", ">=", "<", "<=", "between")
+TIMESTAMP_FIELDS = ("created_at", "due_at", "last_login_at")
+# Match modes found by scanning records: case insensitive substrings, regular expressions
+# and substrings allowing a few typos
+MODE_CONTAINS = "contains"
+MODE_MATCHES = "matches"
+MODE_FUZZY = "fuzzy"
+SCAN_MODES = (MODE_CONTAINS, MODE_MATCHES, MODE_FUZZY)
+# String fields with a trigram index for contains and fuzzy searches, rather than a scan
+TRIGRAM_FIELDS = ("name", "email", "subject")
+# Words combining conditions in a search, which must be separated by spaces
+COMPOUND_KEYWORDS = ("AND", "OR", "NOT", "(", ")")
+# Conditions can be on related records through these foreign keys, e.g. organization.name
+RELATED_FIELDS = {
+    "tickets": {
+        "organization": (FIELD_ORGANIZATION_ID, "orgs"),
+        "submitter": (FIELD_SUBMITTER_ID, "users"),
+        "assignee": (FIELD_ASSIGNEE_ID, "users"),
+    },
+    "users": {
+        "organization": (FIELD_ORGANIZATION_ID, "orgs"),
+    },
+}
+# Formats search results can be written in: pages of text to read, or every result
+# as a json array, json lines or csv to pass to other programs
+FORMAT_TEXT = "text"
+FORMAT_JSON = "json"
+FORMAT_JSONL = "jsonl"
+FORMAT_CSV = "csv"
+OUTPUT_FORMATS = (FORMAT_TEXT, FORMAT_JSON, FORMAT_JSONL, FORMAT_CSV)
+# Related info added to each type of result, after its own fields, see ResultValue.as_dict
+JOINED_FIELDS = {
+    "orgs": ("user_names", "ticket_subjects"),
+    "tickets": ("organization_name", "submitter_name", "assignee_name"),
+    "users": ("organization_name", "assigned_ticket_subjects", "submitted_ticket_subjects"),
+}
+# Query plan steps
+PLAN_LOOKUP = "look up index"
+PLAN_SCAN = "scan all records"
+PLAN_INTERSECT = "intersect with index"
+PLAN_FILTER = "check each candidate"
+PLAN_EXCLUDE = "remove index matches"
+
+# Where the validated records are kept
+STORAGE_MEMORY = "memory"
+STORAGE_SQLITE = "sqlite"
+STORAGE_TYPES = (STORAGE_MEMORY, STORAGE_SQLITE)
+# Searches, words and quoted values
+QUERY_TOKEN_PATTERN = re.compile(r'"[^"]*"|\S+')
+
+# Fields and types of the records in each json file
+ORGS_SCHEMA = {
+    "_id": int,
+    "url": str,
+    "external_id": str,
+    "name": str,
+    "domain_names": list,
+    "created_at": str,
+    "details": str,
+    "shared_tickets": bool,
+    "tags": list,
+}
+TICKETS_SCHEMA = {
+    "_id": str,
+    "url": str,
+    "external_id": str,
+    "created_at": str,
+    "type": str,
+    "subject": str,
+    "description": str,
+    "priority": str,
+    "status": str,
+    "submitter_id": int,
+    "assignee_id": int,
+    "organization_id": int,
+    "tags": list,
+    "has_incidents": bool,
+    "due_at": str,
+    "via": str
+}
+USERS_SCHEMA = {
+    "_id": int,
+    "url": str,
+    "external_id": str,
+    "name": str,
+    "alias": str,
+    "created_at":str,
+    "active": bool,
+    "verified": bool,
+    "shared": bool,
+    "locale": str,
+    "timezone": str,
+    "last_login_at": str,
+    "email": str,
+    "phone": str,
+    "signature": str,
+    "organization_id": int,
+    "tags": list,
+    "suspended": bool,
+    "role": str
+}
 
 ## Magic Numbers
 # Limit search results to show this many
 MAX_RESULTS_SHOW = 30
+# Number of the largest groups shown by the group command unless told otherwise
+GROUP_TOP = 20
+# Number of characters read at a time when loading json files
+LOAD_CHUNK_SIZE = 64 * 1024
+# Json errors this close to the end of what has been read may only be an entry cut off by
+# the chunk, such as a literal or \u escape, so more is read before reporting them
+LOAD_ERROR_MARGIN = 10
+# String columns stop being dictionary encoded once they have more distinct values
+# than this and more than half of their values are distinct
+DICT_ENCODE_MIN_DISTINCT = 256
+# Snapshots of validated data are written to this directory, which only its owner may write to
+# as loading a snapshot can run any code put in it, with this suffix after the source file's name
+SNAPSHOT_DIR = os.path.join(os.environ.get("XDG_CACHE_HOME") or
+                            os.path.join(os.path.expanduser("~"), ".cache"), "tomsearch")
+SNAPSHOT_SUFFIX = ".snapshot"
+# Increase when the snapshot contents change so old snapshots are rebuilt
+SNAPSHOT_VERSION = 4
+# Databases of the sqlite storage engine are written next to each source file with this suffix
+SQLITE_SUFFIX = ".sqlite"
+# Increase when the database layout changes so old databases are imported again
+SQLITE_VERSION = 1
+# Number of records inserted at a time while importing a file into sqlite
+SQLITE_BATCH_SIZE = 5000
+# Most positions looked up by one sqlite query, well below its limit on query parameters
+SQLITE_IN_LIMIT = 500
+# Names of the sqlite columns holding fields outside the schema, the deleted flag and
+# the start of those holding timestamps parsed into seconds since the epoch, which can't
+# clash with field names as they aren't valid identifiers
+SQLITE_EXTRAS = "~extras"
+SQLITE_DELETED = "~deleted"
+SQLITE_EPOCH_PREFIX = "~epoch:"
+# String forms of ints, which are looked up in sqlite as numbers
+SQLITE_INT_PATTERN = re.compile(r"-?[0-9]+")
+
+# Number of best matches returned by a full text search
+TEXT_TOP_K = 100
+# Fuzzy searches allow one typo for every this many characters searched for, and at least one
+FUZZY_CHARS_PER_EDIT = 6
+# Except that fuzzy searches for fewer characters than this allow no typos, as one typo in a
+# string this short would match nearly every value
+FUZZY_MIN_LENGTH = 4
+# BM25 term frequency saturation and length normalisation parameters
+BM25_K1 = 1.2
+BM25_B = 0.75
+# Checking one candidate record is assumed to cost about as much as reading this
+# many entries of an index, when choosing between the two in a query plan
+FILTER_COST = 4
+# Scans of fewer records than this aren't worth sharing between processes
+SCAN_PARALLEL_MIN_RECORDS = 50000
+# Each scanning process is given about this many chunks of the records, to even out the work
+SCAN_CHUNKS_PER_JOB = 4
+# Servers listen on this machine only unless given another host
+SERVER_HOST = "127.0.0.1"
+# Number of threads a server runs commands in, so a slow search doesn't hold up other clients
+SERVER_THREADS = 4
+# Longest request line a server reads, in bytes; longer requests are skipped and refused
+SERVER_REQUEST_LIMIT = 64 * 1024
+# Upper bounds in seconds of the latency histogram buckets kept for each stage, and their labels
+STATS_BUCKETS = (0.00001, 0.0001, 0.001, 0.01, 0.1, 1.0)
+STATS_BUCKET_LABELS = ("<10us", "<100us", "<1ms", "<10ms", "<100ms", "<1s", ">=1s")
+# Width of the longest histogram bar shown by the stats command
+STATS_BAR_WIDTH = 40
+# Number of functions shown by the profile command
+PROFILE_TOP = 15
+# Records are validated this many at a time, in parallel when there is more than one validate job
+VALIDATE_CHUNK_SIZE = 2000
+# Number of record ids given as examples when warning about the defaults created for a field
+WARNING_EXAMPLES = 3
+# Number of characters of results gathered before writing them out in a machine readable format
+OUTPUT_BUFFER_SIZE = 256 * 1024
+# Number of results read from the records at a time while writing every result of a search,
+# releasing the DATA_LOCK in between so a slow reader of the output doesn't hold up reloads
+OUTPUT_CHUNK_SIZE = 1000
+# Most searches, and most estimated bytes of positions and results, kept by the query cache
+QUERY_CACHE_ENTRIES = 256
+QUERY_CACHE_BYTES = 64 * 1024 * 1024
+# Estimated bytes used by a cached search besides its positions and results
+QUERY_CACHE_ENTRY_BYTES = 512
 
 ## Global vars
 # Vars for data lookup
@@ -29,6 +250,21 @@ TICKETS = None
 ORGS = None
 USERS = None
 SEARCH_TYPES = None
+RELATIONS = None
+# Increased whenever the loaded data changes, so processes forked from older data are replaced
+DATA_GENERATION = 0
+# Number of processes used to scan records for unindexed conditions
+SCAN_JOBS = os.cpu_count() or 1
+# Number of processes used to validate records while loading
+VALIDATE_JOBS = 1
+# Warn about every default created while validating rather than counting them per field
+VERBOSE_WARNINGS = False
+# Compiled validators by schema, see compiled_validator
+VALIDATORS = {}
+# Format searches are written in, unless changed with the format command
+OUTPUT_FORMAT = FORMAT_TEXT
+# Where records are kept once validated, in memory or in a sqlite database next to each file
+STORAGE = STORAGE_MEMORY
 
 
 ## Class definitions
@@ -41,6 +277,10 @@ class ExitException(Exception):
     """Exception to raise a clean exit"""
     pass
 
+class NotCompoundException(Exception):
+    """Exception to signify AND, OR or NOT were part of a value rather than joining conditions"""
+    pass
+
 # Result classes
 class ResultValue(object):
     """Base Class representing a single result of the search"""
@@ -49,7 +289,15 @@ class ResultValue(object):
 
     def present(self):
         """Tell the result to print itself to stdout"""
-        pprint(self.valuedict)
+        print(self.render())
+
+    def render(self):
+        """Return the text presenting the result"""
+        return pformat(self.valuedict)
+
+    def as_dict(self):
+        """Return the record and its related info as a dictionary of plain values"""
+        return self.valuedict.copy()
 
 class OrganizationResult(ResultValue):
     """Single result of a Organization search"""
@@ -58,7 +306,13 @@ class OrganizationResult(ResultValue):
         self.usernames = usernames
         self.ticketnames = ticketnames
 
-    def present(self):
+    def as_dict(self):
+        outp = super().as_dict()
+        outp["user_names"] = list(self.usernames)
+        outp["ticket_subjects"] = list(self.ticketnames)
+        return outp
+
+    def render(self):
         domains = "\n                ".join(self.valuedict["domain_names"])
         tags = ", ".join(self.valuedict[FIELD_TAGS])
         outp = """          Name: {0[name]}
@@ -71,15 +325,14 @@ shared tickets: {0[shared_tickets]}
           tags: {2}""".format(self.valuedict,
                               domains,
                               tags)
-        print(outp)
+        lines = [outp]
         if self.usernames:
-            print(" Users:")
-            for user in self.usernames:
-                print("   * {}".format(user))
+            lines.append(" Users:")
+            lines.extend("   * {}".format(user) for user in self.usernames)
         if self.ticketnames:
-            print(" Tickets:")
-            for ticket in self.ticketnames:
-                print("   * {}".format(ticket))
+            lines.append(" Tickets:")
+            lines.extend("   * {}".format(ticket) for ticket in self.ticketnames)
+        return "\n".join(lines)
 
 class TicketResult(ResultValue):
     """Represent a result of a ticket search"""
@@ -89,7 +342,14 @@ class TicketResult(ResultValue):
         self.submitter_name = submitter_name
         self.assignee_name = assignee_name
 
-    def present(self):
+    def as_dict(self):
+        outp = super().as_dict()
+        outp["organization_name"] = found_name(self.org_name)
+        outp["submitter_name"] = found_name(self.submitter_name)
+        outp["assignee_name"] = found_name(self.assignee_name)
+        return outp
+
+    def render(self):
         outp = """         Subject: {0[subject]}
               id: {0[_id]}    ({0[external_id]})
     organization: {0[organization_id]}    ({2})
@@ -107,7 +367,7 @@ class TicketResult(ResultValue):
                                      presentation_name(self.org_name),
                                      presentation_name(self.submitter_name),
                                      presentation_name(self.assignee_name))
-        print(outp)
+        return outp
 
 class UserResult(ResultValue):
     """Represent a result for a user search"""
@@ -117,7 +377,14 @@ class UserResult(ResultValue):
         self.assigned_ticket_names = assigned_ticket_names
         self.submitted_ticket_names = submitted_ticket_names
 
-    def present(self):
+    def as_dict(self):
+        outp = super().as_dict()
+        outp["organization_name"] = found_name(self.org_name)
+        outp["assigned_ticket_subjects"] = list(self.assigned_ticket_names)
+        outp["submitted_ticket_subjects"] = list(self.submitted_ticket_names)
+        return outp
+
+    def render(self):
         outp = """            Name: {0[name]:30.30s} (alias {0[alias]:10.10s})
               id: {0[_id]:<10d}     external_id: {0[external_id]}
  organization_id: {0[organization_id]} ({2}) 
@@ -135,46 +402,2595 @@ class UserResult(ResultValue):
             tags: {1}""".format(self.valuedict,
                                 ", ".join(self.valuedict[FIELD_TAGS]),
                                 presentation_name(self.org_name))
-        print(outp)
+        lines = [outp]
         if self.assigned_ticket_names:
-            print(" Assigned Tickets:")
-            for name in self.assigned_ticket_names:
-                print("   * {}".format(name))
+            lines.append(" Assigned Tickets:")
+            lines.extend("   * {}".format(name) for name in self.assigned_ticket_names)
         if self.submitted_ticket_names:
-            print(" Submitted Tickets:")
-            for name in self.submitted_ticket_names:
-                print("   * {}".format(name))
+            lines.append(" Submitted Tickets:")
+            lines.extend("   * {}".format(name) for name in self.submitted_ticket_names)
+        return "\n".join(lines)
+
+# Column storage
+class ArrayColumn(object):
+    """Column of ints stored in a typed array, with a set of the positions holding None"""
+    typecode = "q"
+
+    def __init__(self):
+        self.data = array(self.typecode)
+        self.nulls = set()
+
+    def __len__(self):
+        return len(self.data)
+
+    def __getitem__(self, position):
+        if position in self.nulls:
+            return None
+        return self.data[position]
+
+    def __iter__(self):
+        return (self[position] for position in range(len(self.data)))
+
+    def append(self, value):
+        """Add a value, raising TypeError or OverflowError if it can't be stored"""
+        if value is None:
+            self.nulls.add(len(self.data))
+            self.data.append(0)
+        elif type(value) is not int:
+            raise TypeError("{} is not an int".format(value))
+        else:
+            self.data.append(value)
+
+class BoolColumn(ArrayColumn):
+    """Column of bools stored as bytes"""
+    typecode = "b"
+
+    def __getitem__(self, position):
+        if position in self.nulls:
+            return None
+        return self.data[position] != 0
+
+    def append(self, value):
+        if value is None:
+            self.nulls.add(len(self.data))
+            self.data.append(0)
+        elif type(value) is not bool:
+            raise TypeError("{} is not a bool".format(value))
+        else:
+            self.data.append(value)
+
+class DictColumn(object):
+    """Dictionary encoded column storing each distinct value once
+    Suited to low cardinality fields such as status, locale or role"""
+    def __init__(self):
+        self.codes = array("I")
+        self.dictionary = []
+        self.lookup = {}
+
+    def __len__(self):
+        return len(self.codes)
+
+    def __getitem__(self, position):
+        return self.dictionary[self.codes[position]]
+
+    def __iter__(self):
+        dictionary = self.dictionary
+        return (dictionary[code] for code in self.codes)
+
+    def append(self, value):
+        """Add a value, raising ValueError once the column is no longer low cardinality"""
+        code = self.lookup.get(value)
+        if code is not None and type(self.dictionary[code]) is not type(value):
+            # Equal values of different types such as 1 and True can't share a code
+            raise TypeError("{} has a mixed type".format(value))
+        if code is None:
+            distinct = len(self.dictionary)
+            if distinct >= DICT_ENCODE_MIN_DISTINCT and distinct * 2 > len(self.codes):
+                raise ValueError("Too many distinct values to dictionary encode")
+            code = self.lookup[value] = distinct
+            self.dictionary.append(value)
+        self.codes.append(code)
+
+class ListColumn(object):
+    """Column of lists stored as offsets into one array of dictionary encoded elements
+    The elements of record n are values[offsets[n]:offsets[n + 1]]"""
+    def __init__(self):
+        self.offsets = array("Q", [0])
+        self.values = array("I")
+        self.dictionary = []
+        self.lookup = {}
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, position):
+        dictionary = self.dictionary
+        return [dictionary[code]
+                for code in self.values[self.offsets[position]:self.offsets[position + 1]]]
+
+    def __iter__(self):
+        return (self[position] for position in range(len(self)))
+
+    def append(self, value):
+        """Add a list, raising TypeError if it isn't a list of hashable values"""
+        if type(value) is not list:
+            raise TypeError("{} is not a list".format(value))
+        codes = []
+        for element in value:
+            code = self.lookup.get(element)
+            if code is not None and type(self.dictionary[code]) is not type(element):
+                raise TypeError("{} has a mixed type".format(element))
+            if code is None:
+                code = self.lookup[element] = len(self.dictionary)
+                self.dictionary.append(element)
+            codes.append(code)
+        self.values.extend(codes)
+        self.offsets.append(len(self.values))
+
+class ObjectColumn(list):
+    """Column holding plain python objects, for values no other column can store"""
+    pass
+
+COLUMN_TYPES = {
+    int: ArrayColumn,
+    bool: BoolColumn,
+    str: DictColumn,
+    list: ListColumn,
+}
+
+class RecordStore(object):
+    """Base class of the stores records are kept in, by position in the order they were added
+    Subclasses set count to the number of records stored and deleted to the positions of
+    records removed by a reload, which stay stored for results found before it"""
+    count = 0
+    deleted = frozenset()
+
+    def __len__(self):
+        return self.count
+
+    def live_positions(self):
+        """Return the positions of the records that haven't been deleted, in order"""
+        if not self.deleted:
+            return range(self.count)
+        return (position for position in range(self.count) if position not in self.deleted)
+
+    def live_count(self):
+        """Return the number of records that haven't been deleted"""
+        return self.count - len(self.deleted)
+
+class ColumnStore(RecordStore):
+    """Sequence of records stored one column per schema field
+    Records are handed out as RecordViews which read from the columns on access.
+    Fields outside the schema are kept per record in extras, and the positions of
+    records without a schema field are kept in missing. Timestamp fields are also
+    stored parsed into seconds since the epoch in epochs."""
+    def __init__(self, fields, timestamp_fields=()):
+        self.columns = {field_name: COLUMN_TYPES.get(_type, ObjectColumn)()
+                        for field_name, _type in fields.items()}
+        self.epochs = {field_name: ArrayColumn() for field_name in timestamp_fields}
+        self.extras = {}
+        self.missing = {}
+        # Positions of records removed by a reload, which stay stored for results found before it
+        self.deleted = set()
+        self.count = 0
+
+    def __getitem__(self, position):
+        if position < 0:
+            position += self.count
+        if not 0 <= position < self.count:
+            raise IndexError("record position out of range")
+        return RecordView(self, position)
+
+    def __iter__(self):
+        return (RecordView(self, position) for position in self.live_positions())
+
+    def append(self, record):
+        """Store a record, falling back to a plain column for values a column can't hold"""
+        for field_name, column in self.columns.items():
+            value = record.get(field_name)
+            if value is None and field_name not in record:
+                self.missing.setdefault(field_name, set()).add(self.count)
+            try:
+                column.append(value)
+            except (TypeError, ValueError, OverflowError):
+                column = self.columns[field_name] = ObjectColumn(column)
+                column.append(value)
+        for field_name, column in self.epochs.items():
+            column.append(parse_timestamp(record.get(field_name)))
+        extra = {key: value for key, value in record.items() if key not in self.columns}
+        if extra:
+            self.extras[self.count] = extra
+        self.count += 1
+
+    def get_value(self, position, field_name):
+        """Return the value of a field in a record
+        :raises KeyError: When the record has no such field"""
+        column = self.columns.get(field_name)
+        if column is not None:
+            missing = self.missing.get(field_name)
+            if missing and position in missing:
+                raise KeyError(field_name)
+            return column[position]
+        return self.extras.get(position, {})[field_name]
+
+    def get_record(self, position):
+        """Return a record as a dictionary, reading each column once"""
+        record = {field_name: column[position] for field_name, column in self.columns.items()}
+        for field_name, missing in self.missing.items():
+            if position in missing:
+                del record[field_name]
+        extra = self.extras.get(position)
+        if extra:
+            record.update(extra)
+        return record
+
+    def field_values(self, field_name, positions):
+        """Return the value of a field, or None where it's missing, for each of some positions
+        The values are read from the field's column without building records"""
+        column = self.columns.get(field_name)
+        if isinstance(column, DictColumn):
+            dictionary = column.dictionary
+            codes = column.codes
+            values = [dictionary[codes[position]] for position in positions]
+        elif column is not None:
+            values = list(map(column.__getitem__, positions))
+        else:
+            values = [self.extras.get(position, {}).get(field_name) for position in positions]
+        missing = self.missing.get(field_name)
+        if missing and column is not None:
+            values = [None if position in missing else value
+                      for position, value in zip(positions, values)]
+        return values
+
+    def field_names(self, position):
+        """Return the field names present in a record"""
+        names = [field_name for field_name in self.columns
+                 if position not in self.missing.get(field_name, ())]
+        names.extend(self.extras.get(position, ()))
+        return names
+
+    def iter_field(self, field_name):
+        """Yield (position, value) for every record that has the field and hasn't been deleted"""
+        column = self.columns.get(field_name)
+        if column is not None:
+            missing = self.missing.get(field_name)
+            if missing or self.deleted:
+                missing = self.deleted.union(missing or ())
+                return ((position, value) for position, value in enumerate(column)
+                        if position not in missing)
+            return enumerate(column)
+        return ((position, extra[field_name]) for position, extra in sorted(self.extras.items())
+                if field_name in extra and position not in self.deleted)
+
+class RecordView(Mapping):
+    """Read only dictionary view of one record in a ColumnStore"""
+    __slots__ = ("store", "position")
+
+    def __init__(self, store, position):
+        self.store = store
+        self.position = position
+
+    def __getitem__(self, key):
+        return self.store.get_value(self.position, key)
+
+    def __iter__(self):
+        return iter(self.store.field_names(self.position))
+
+    def __len__(self):
+        return len(self.store.field_names(self.position))
+
+    def __repr__(self):
+        return repr(self.copy())
+
+    def copy(self):
+        """Return the record as a dictionary, as dict.copy would"""
+        return self.store.get_record(self.position)
+
+class RecordList(Sequence):
+    """Sequence of the records at some positions in a ColumnStore or SqliteStore
+    Records are only read from the store as they are accessed"""
+    def __init__(self, store, positions):
+        self.store = store
+        self.positions = positions
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return RecordList(self.store, self.positions[index])
+        return self.store[self.positions[index]]
+
+    def __len__(self):
+        return len(self.positions)
+
+    def __repr__(self):
+        return repr(list(self))
+
+# Disk storage
+def sqlite_name(name):
+    """Return a name quoted for use as a sqlite identifier"""
+    return '"{}"'.format(name.replace('"', '""'))
+
+def epoch_column(field_name):
+    """Return the name of the sqlite column holding a timestamp field in seconds since the epoch"""
+    return SQLITE_EPOCH_PREFIX + field_name
+
+class SqliteStore(RecordStore):
+    """Sequence of records stored as the rows of a sqlite database rather than in memory
+    Read through the same methods as a ColumnStore, so only the records a search reads
+    are held in memory. Record n is the row with rowid n + 1. Schema fields each have a
+    column, with bools stored as 0 or 1 and lists as json, while fields outside the schema
+    are stored together as json. Deleted records are flagged rather than removed.
+    Each thread and each forked process opens its own connection to the database."""
+    def __init__(self, path, fields, timestamp_fields=()):
+        self.path = path
+        self.fields = fields
+        self.timestamp_fields = tuple(timestamp_fields)
+        self.local = threading.local()
+        # Nothing is held in memory columns, so code reading them falls back to iter_field
+        self.columns = {}
+        self.missing = {}
+        self.extras = {}
+        self.epochs = {field_name: SqliteColumn(self, epoch_column(field_name))
+                       for field_name in self.timestamp_fields}
+        self.decoders = {field_name: json.loads if _type is list else
+                         bool if _type is bool else None
+                         for field_name, _type in fields.items()}
+        self.count = 0
+        self.deleted = set()
+        self.select_record = "SELECT {}, {} FROM records".format(
+            ", ".join(map(sqlite_name, fields)), sqlite_name(SQLITE_EXTRAS))
+
+    @property
+    def connection(self):
+        """The connection to the database for this thread, opened on first use"""
+        connection = getattr(self.local, "connection", None)
+        if connection is None or self.local.pid != os.getpid():
+            try:
+                connection = sqlite3.connect(self.path)
+            except sqlite3.Error as ex:
+                fail("Unable to open '{}': {}".format(self.path, str(ex)))
+            self.local.connection = connection
+            self.local.pid = os.getpid()
+        return connection
+
+    def execute(self, sql, parameters=()):
+        """Run a statement on this thread's connection, returning the cursor"""
+        return self.connection.execute(sql, parameters)
+
+    @contextlib.contextmanager
+    def transaction(self):
+        """Run the statements of a with block in one transaction, committed at its end,
+        or as part of the transaction already running in this thread"""
+        connection = self.connection
+        if connection.in_transaction:
+            yield
+            return
+        connection.execute("BEGIN")
+        try:
+            yield
+        except BaseException:
+            connection.rollback()
+            raise
+        connection.commit()
+
+    def key(self):
+        """Return the key saved with set_key, or None if there isn't a complete database"""
+        try:
+            row = self.execute("SELECT value FROM meta WHERE name = 'key'").fetchone()
+        except sqlite3.Error:
+            return None
+        return None if row is None else row[0]
+
+    def set_key(self, key):
+        """Save the text of the key describing the source of the records, or None to remove it"""
+        with self.transaction():
+            if key is None:
+                self.execute("DELETE FROM meta WHERE name = 'key'")
+            else:
+                self.execute("INSERT OR REPLACE INTO meta VALUES ('key', ?)", (key,))
+
+    def open(self):
+        """Read the number of records and the deleted records of an existing database"""
+        self.count = self.execute("SELECT COALESCE(MAX(rowid), 0) FROM records").fetchone()[0]
+        self.deleted = {row[0] for row in self.execute(
+            "SELECT rowid - 1 FROM records WHERE {}".format(sqlite_name(SQLITE_DELETED)))}
+
+    def create(self):
+        """Replace any existing database with an empty one"""
+        columns = [sqlite_name(field_name) for field_name in self.fields]
+        columns.extend(sqlite_name(epoch_column(field_name))
+                       for field_name in self.timestamp_fields)
+        columns.append(sqlite_name(SQLITE_EXTRAS))
+        columns.append("{} INTEGER NOT NULL DEFAULT 0".format(sqlite_name(SQLITE_DELETED)))
+        # Searches can read while a reload writes
+        self.execute("PRAGMA journal_mode = WAL")
+        with self.transaction():
+            self.execute("DROP TABLE IF EXISTS meta")
+            self.execute("DROP TABLE IF EXISTS records")
+            self.execute("CREATE TABLE meta (name TEXT PRIMARY KEY, value TEXT)")
+            self.execute("CREATE TABLE records ({})".format(", ".join(columns)))
+        self.count = 0
+        self.deleted = set()
+
+    def create_indexes(self):
+        """Index every field, and the parsed timestamps, for lookups and ranges"""
+        columns = list(self.fields)
+        columns.extend(epoch_column(field_name) for field_name in self.timestamp_fields)
+        for number, column in enumerate(columns):
+            self.execute("CREATE INDEX IF NOT EXISTS records_{} ON records ({})".format(
+                number, sqlite_name(column)))
+
+    def encode(self, record):
+        """Return the row storing a record"""
+        row = []
+        for field_name, _type in self.fields.items():
+            value = record.get(field_name)
+            if value is not None and _type is list:
+                value = json.dumps(value)
+            row.append(value)
+        row.extend(parse_timestamp(record.get(field_name)) for field_name in self.timestamp_fields)
+        extra = {key: value for key, value in record.items() if key not in self.fields}
+        row.append(json.dumps(extra) if extra else None)
+        return row
+
+    def decode(self, field_name, value):
+        """Return the value of a schema field read from its column"""
+        decoder = self.decoders[field_name]
+        if decoder is None or value is None:
+            return value
+        return decoder(value)
+
+    def decode_row(self, row):
+        """Return the record stored in a row read with select_record"""
+        decoders = self.decoders
+        record = {field_name: value if value is None or decoders[field_name] is None
+                  else decoders[field_name](value) for field_name, value in zip(self.fields, row)}
+        if row[-1] is not None:
+            record.update(json.loads(row[-1]))
+        return record
+
+    def insert(self, records):
+        """Store a list of validated records, in the caller's transaction if there is one"""
+        placeholders = ", ".join("?" * (len(self.fields) + len(self.timestamp_fields) + 1))
+        try:
+            with self.transaction():
+                self.connection.executemany(
+                    "INSERT INTO records VALUES ({}, 0)".format(placeholders),
+                    map(self.encode, records))
+        except (sqlite3.Error, OverflowError) as ex:
+            fail("Unable to store records in '{}': {}".format(self.path, str(ex)))
+        self.count += len(records)
+
+    def append(self, record):
+        """Store a validated record, removing the key as the records no longer match it"""
+        with self.transaction():
+            self.set_key(None)
+            self.insert([record])
+
+    def mark_deleted(self, position):
+        """Flag a record as deleted in the database as well as in deleted, removing the key
+        as the records no longer match it"""
+        with self.transaction():
+            self.set_key(None)
+            self.execute("UPDATE records SET {} = 1 WHERE rowid = ?".format(
+                sqlite_name(SQLITE_DELETED)), (position + 1,))
+        self.deleted.add(position)
+
+    def __getitem__(self, position):
+        if position < 0:
+            position += self.count
+        if not 0 <= position < self.count:
+            raise IndexError("record position out of range")
+        return self.get_record(position)
+
+    def __iter__(self):
+        rows = self.execute("{} WHERE NOT {} ORDER BY rowid".format(
+            self.select_record, sqlite_name(SQLITE_DELETED)))
+        return map(self.decode_row, rows)
+
+    def get_record(self, position):
+        """Return a record as a dictionary, read with one query"""
+        row = self.execute("{} WHERE rowid = ?".format(self.select_record),
+                           (position + 1,)).fetchone()
+        if row is None:
+            raise IndexError("record position out of range")
+        return self.decode_row(row)
+
+    def get_extra(self, position):
+        """Return the fields outside the schema of a record"""
+        row = self.execute("SELECT {} FROM records WHERE rowid = ?".format(
+            sqlite_name(SQLITE_EXTRAS)), (position + 1,)).fetchone()
+        return {} if row is None or row[0] is None else json.loads(row[0])
+
+    def get_value(self, position, field_name):
+        """Return the value of a field in a record
+        :raises KeyError: When the record has no such field"""
+        if field_name not in self.fields:
+            return self.get_extra(position)[field_name]
+        row = self.execute("SELECT {} FROM records WHERE rowid = ?".format(
+            sqlite_name(field_name)), (position + 1,)).fetchone()
+        if row is None:
+            raise KeyError(field_name)
+        return self.decode(field_name, row[0])
+
+    def field_values(self, field_name, positions):
+        """Return the value of a field, or None where it's missing, for each of some positions
+        A range of positions is read with one query, other positions a chunk at a time"""
+        if field_name not in self.fields:
+            return [self.get_extra(position).get(field_name) for position in positions]
+        column = sqlite_name(field_name)
+        if isinstance(positions, range) and positions.step == 1:
+            rows = self.execute("SELECT {} FROM records WHERE rowid > ? AND rowid <= ? "
+                                "ORDER BY rowid".format(column),
+                                (positions.start, positions.stop))
+            return [self.decode(field_name, value) for value, in rows]
+        values = []
+        for chunk in iter_chunks(positions, SQLITE_IN_LIMIT):
+            rows = dict(self.execute("SELECT rowid - 1, {} FROM records WHERE rowid IN ({})".format(
+                column, ", ".join("?" * len(chunk))), [position + 1 for position in chunk]))
+            values.extend(self.decode(field_name, rows.get(position)) for position in chunk)
+        return values
+
+    def field_names(self, position):
+        """Return the field names present in a record"""
+        return list(self.fields) + list(self.get_extra(position))
+
+    def iter_field(self, field_name):
+        """Yield (position, value) for every record that has the field and hasn't been deleted"""
+        if field_name not in self.fields:
+            rows = self.execute("SELECT rowid - 1, {} FROM records WHERE {} IS NOT NULL AND NOT {} "
+                                "ORDER BY rowid".format(sqlite_name(SQLITE_EXTRAS),
+                                                        sqlite_name(SQLITE_EXTRAS),
+                                                        sqlite_name(SQLITE_DELETED)))
+            for position, extra in rows:
+                extra = json.loads(extra)
+                if field_name in extra:
+                    yield position, extra[field_name]
+            return
+        rows = self.execute("SELECT rowid - 1, {} FROM records WHERE NOT {} ORDER BY rowid".format(
+            sqlite_name(field_name), sqlite_name(SQLITE_DELETED)))
+        decoder = self.decoders[field_name]
+        if decoder is None:
+            yield from rows
+        else:
+            for position, value in rows:
+                yield position, None if value is None else decoder(value)
+
+    def match_clause(self, field_name, text):
+        """Return a where clause and its parameters matching the records whose field has
+        text as its string form, as str(value) == text would, or None if no value can match
+        :raises TypeError: When the field can't be compared in sqlite"""
+        _type = self.fields.get(field_name)
+        column = sqlite_name(field_name)
+        if _type is None:
+            raise TypeError("{} can't be compared in sqlite".format(field_name))
+        if _type is list:
+            # Lists are stored as json, so the list the text is the string form of is needed
+            try:
+                value = ast.literal_eval(text)
+            except (ValueError, TypeError, SyntaxError, MemoryError, RecursionError):
+                return None
+            if type(value) is not list or str(value) != text:
+                return None
+            return "{} = ?".format(column), (json.dumps(value),)
+        if _type is str:
+            if text == "None":
+                return "({0} IS NULL OR {0} = ?)".format(column), (text,)
+            return "{} = ?".format(column), (text,)
+        if text == "None":
+            return "{} IS NULL".format(column), ()
+        if _type is bool:
+            if text not in ("True", "False"):
+                return None
+            return "{} = ?".format(column), (int(text == "True"),)
+        if _type is int and SQLITE_INT_PATTERN.fullmatch(text) and str(int(text)) == text:
+            return "{} = ?".format(column), (int(text),)
+        return None
+
+    def lookup(self, field_name, text):
+        """Return the sorted positions of the live records whose field has text as its
+        string form, using the field's index when it has one"""
+        try:
+            clause = self.match_clause(field_name, text)
+        except TypeError:
+            return [position for position, value in self.iter_field(field_name)
+                    if str(value) == text]
+        if clause is None:
+            return []
+        where, parameters = clause
+        # Deleted records are left out here so the query only reads the field's index
+        rows = self.execute("SELECT rowid - 1 FROM records WHERE {} ORDER BY rowid".format(where),
+                            parameters)
+        deleted = self.deleted
+        return [position for position, in rows if position not in deleted]
+
+    def live_clause(self):
+        """Return a where clause leaving out deleted records, which is only needed after
+        some are deleted and makes sqlite read each row as well as the index"""
+        if not self.deleted:
+            return "1"
+        return "NOT {}".format(sqlite_name(SQLITE_DELETED))
+
+    def distinct_values(self, field_name):
+        """Return the string forms of the distinct values of a field in the live records"""
+        if field_name not in self.fields:
+            return {str(value) for _, value in self.iter_field(field_name)}
+        rows = self.execute("SELECT DISTINCT {} FROM records WHERE {}".format(
+            sqlite_name(field_name), self.live_clause()))
+        return {str(self.decode(field_name, value)) for value, in rows}
+
+class SqliteColumn(object):
+    """Read only column of a SqliteStore, for code reading a column a record at a time"""
+    def __init__(self, store, column):
+        self.store = store
+        self.column = column
+
+    def __len__(self):
+        return self.store.count
+
+    def __getitem__(self, position):
+        row = self.store.execute("SELECT {} FROM records WHERE rowid = ?".format(
+            sqlite_name(self.column)), (position + 1,)).fetchone()
+        if row is None:
+            raise IndexError("record position out of range")
+        return row[0]
+
+    def __iter__(self):
+        rows = self.store.execute("SELECT {} FROM records ORDER BY rowid".format(
+            sqlite_name(self.column)))
+        return (value for value, in rows)
+
+class SqliteIndex(Mapping):
+    """Index of a field of a SqliteStore, mapping the string form of each value to the
+    positions of the live records holding it like the indexes of a ValidatedDictList
+    Nothing is held in memory, each lookup is a query using the field's sqlite index"""
+    def __init__(self, store, field_name):
+        self.store = store
+        self.field_name = field_name
+
+    def __getitem__(self, key):
+        positions = self.store.lookup(self.field_name, key)
+        if not positions:
+            raise KeyError(key)
+        return positions
+
+    def __iter__(self):
+        return iter(self.store.distinct_values(self.field_name))
+
+    def __len__(self):
+        return len(self.store.distinct_values(self.field_name))
+
+    def items(self):
+        """Yield each value and its positions, reading the whole field in one query"""
+        field_index = {}
+        for position, value in self.store.iter_field(self.field_name):
+            field_index.setdefault(str(value), []).append(position)
+        return field_index.items()
+
+# Text search
+class TextPosting(object):
+    """Positional postings of one term in one field
+    Record docs[n] holds the term at token positions[offsets[n]:offsets[n + 1]]"""
+    __slots__ = ("docs", "offsets", "positions")
+
+    def __init__(self):
+        self.docs = array("L")
+        self.offsets = array("L", [0])
+        self.positions = array("L")
+
+    def __len__(self):
+        return len(self.docs)
+
+    def add(self, doc, positions):
+        """Add the positions of the term in a record after any already added"""
+        self.docs.append(doc)
+        self.positions.extend(positions)
+        self.offsets.append(len(self.positions))
+
+    def find(self, doc):
+        """Return the index of a record in docs, or None when it doesn't hold the term"""
+        index = bisect.bisect_left(self.docs, doc)
+        if index < len(self.docs) and self.docs[index] == doc:
+            return index
+        return None
+
+    def term_positions(self, index):
+        """Return the token positions of the term for the record at docs[index]"""
+        return self.positions[self.offsets[index]:self.offsets[index + 1]]
+
+class TextIndex(object):
+    """Tokenized inverted index with positional postings over some text fields
+    Searches are ranked with BM25, summed over the fields searched"""
+    def __init__(self, fields):
+        self.fields = fields
+        # field name -> {term: TextPosting}
+        self.postings = {field_name: {} for field_name in fields}
+        # field name -> token count of each record
+        self.lengths = {field_name: array("L") for field_name in fields}
+        self.total_lengths = {field_name: 0 for field_name in fields}
+        # Records removed since they were added, which stay in the postings but aren't found
+        self.deleted = set()
+
+    @staticmethod
+    def tokenize(text):
+        """Split text into lower case word tokens"""
+        return re.findall(r"\w+", str(text).lower())
+
+    def add(self, position, record):
+        """Index the text fields of a record, which must come after those already added"""
+        for field_name in self.fields:
+            lengths = self.lengths[field_name]
+            while len(lengths) < position:
+                lengths.append(0)
+            tokens = self.tokenize(record.get(field_name, ""))
+            lengths.append(len(tokens))
+            self.total_lengths[field_name] += len(tokens)
+            term_positions = {}
+            for token_position, token in enumerate(tokens):
+                term_positions.setdefault(token, []).append(token_position)
+            postings = self.postings[field_name]
+            for term, positions in term_positions.items():
+                posting = postings.get(term)
+                if posting is None:
+                    posting = postings[term] = TextPosting()
+                posting.add(position, positions)
+
+    def remove(self, position):
+        """Stop finding a record. Taking it out of long postings would cost more than
+        skipping it, so its postings stay and only count towards term frequencies"""
+        for field_name in self.fields:
+            lengths = self.lengths[field_name]
+            self.total_lengths[field_name] -= lengths[position]
+            lengths[position] = 0
+        self.deleted.add(position)
+
+    def phrase_docs(self, field_names, phrase):
+        """Return the set of records holding the phrase's tokens next to each other in a field"""
+        docs = set()
+        for field_name in field_names:
+            postings = [self.postings[field_name].get(term) for term in phrase]
+            if not all(postings):
+                continue
+            for doc in intersect_postings([posting.docs for posting in postings]):
+                starts = set(postings[0].term_positions(postings[0].find(doc)))
+                for offset, posting in enumerate(postings[1:], 1):
+                    following = posting.term_positions(posting.find(doc))
+                    starts.intersection_update(position - offset for position in following)
+                if starts:
+                    docs.add(doc)
+        return docs - self.deleted
+
+    def required_docs(self, field_names, phrases):
+        """Return the set of records holding every phrase of more than one token,
+        or None when there are no such phrases"""
+        required = None
+        for phrase in phrases:
+            if len(phrase) > 1:
+                docs = self.phrase_docs(field_names, phrase)
+                required = docs if required is None else required & docs
+        return required
+
+    def candidates(self, query, field_names):
+        """Return the sorted positions of every record a search would match, without scoring them"""
+        phrases = [self.tokenize(text) for text in query]
+        docs = set()
+        for term in set(token for phrase in phrases for token in phrase):
+            for field_name in field_names:
+                posting = self.postings[field_name].get(term)
+                if posting:
+                    docs.update(posting.docs)
+        required = self.required_docs(field_names, phrases)
+        if required is not None:
+            docs &= required
+        return sorted(docs - self.deleted)
+
+    def document_frequency(self, query, field_names):
+        """Return the total number of records holding each term of a search, in each field"""
+        terms = set(token for text in query for token in self.tokenize(text))
+        return sum(len(self.postings[field_name].get(term, ()))
+                   for term in terms for field_name in field_names)
+
+    def search(self, query, field_names, record_count, top_k=TEXT_TOP_K):
+        """Return (score, position) of the best matching records, best first
+        Words match any field, while quoted phrases must appear in a field.
+        Terms are scored rarest first. Once the top_k best scores so far can't be
+        beaten by the terms left, no new records are considered and records that
+        can't reach the top_k are dropped, so most of a large result is never scored.
+        :param query: A list of words or phrases
+        :param top_k: The number of results to return, or None for all of them"""
+        phrases = [self.tokenize(text) for text in query]
+        required = self.required_docs(field_names, phrases)
+        terms = []
+        for term in sorted(set(token for phrase in phrases for token in phrase)):
+            weights = []
+            for field_name in field_names:
+                posting = self.postings[field_name].get(term)
+                if posting:
+                    idf = math.log(1 + (record_count - len(posting) + 0.5) / (len(posting) + 0.5))
+                    average = self.total_lengths[field_name] / record_count
+                    weights.append((posting, idf, self.lengths[field_name], average))
+            if weights:
+                upper_bound = sum(idf for _, idf, _, _ in weights) * (BM25_K1 + 1)
+                terms.append((upper_bound, term, weights))
+        terms.sort(key=lambda item: (-item[0], item[1]))
+
+        # The most the terms after each one could add to a record's score. Summed
+        # from the end rather than subtracted so the last is exactly zero
+        remaining_after = [0.0] * len(terms)
+        for index in range(len(terms) - 2, -1, -1):
+            remaining_after[index] = remaining_after[index + 1] + terms[index + 1][0]
+        scores = {}
+        threshold = 0.0
+        for (upper_bound, _, weights), remaining in zip(terms, remaining_after):
+            accept_new = top_k is None or len(scores) < top_k or remaining + upper_bound > threshold
+            for posting, idf, lengths, average in weights:
+                if accept_new or len(posting) < len(scores):
+                    candidates = ((doc, index) for index, doc in enumerate(posting.docs))
+                else:
+                    candidates = ((doc, posting.find(doc)) for doc in list(scores))
+                for doc, index in candidates:
+                    if index is None or (required is not None and doc not in required):
+                        continue
+                    if doc in self.deleted:
+                        continue
+                    if not accept_new and doc not in scores:
+                        continue
+                    frequency = posting.offsets[index + 1] - posting.offsets[index]
+                    norm = BM25_K1 * (1 - BM25_B + BM25_B * lengths[doc] / average)
+                    scores[doc] = scores.get(doc, 0.0) + idf * frequency * (BM25_K1 + 1) / (frequency + norm)
+            if top_k is not None and len(scores) >= top_k:
+                threshold = heapq.nlargest(top_k, scores.values())[-1]
+                # Drop records that can't reach the top_k with the terms left
+                scores = {doc: score for doc, score in scores.items()
+                          if score + remaining >= threshold}
+        ranked = sorted(((-score, doc) for doc, score in scores.items()))
+        if top_k is not None:
+            ranked = ranked[:top_k]
+        return [(-score, doc) for score, doc in ranked]
+
+class TrigramIndex(object):
+    """Index of the three character sequences in the distinct values of a string field,
+    ignoring case, for finding the values containing a substring, or close to containing it,
+    without checking every value. Each distinct value is checked once however many records
+    hold it, and records are only looked up for the values that match."""
+    def __init__(self):
+        # value id -> distinct lower case value, and the positions of the records holding it
+        self.values = []
+        self.positions = []
+        self.value_ids = {}
+        # trigram -> ascending ids of the values containing it
+        self.postings = {}
+        # Records removed since they were added, which stay in positions but aren't found
+        self.deleted = set()
+
+    def add(self, position, value):
+        """Index a record's value, which must come after those already added"""
+        text = str(value).lower()
+        value_id = self.value_ids.get(text)
+        if value_id is None:
+            value_id = self.value_ids[text] = len(self.values)
+            self.values.append(text)
+            self.positions.append([])
+            for trigram in trigrams(text):
+                posting = self.postings.get(trigram)
+                if posting is None:
+                    posting = self.postings[trigram] = array("L")
+                posting.append(value_id)
+        self.positions[value_id].append(position)
+
+    def remove(self, position):
+        """Stop finding a record"""
+        self.deleted.add(position)
+
+    def record_positions(self, value_ids):
+        """Return the sorted positions of the records holding any of some values"""
+        positions = [position for value_id in value_ids for position in self.positions[value_id]]
+        if self.deleted:
+            positions = [position for position in positions if position not in self.deleted]
+        positions.sort()
+        return positions
+
+    def estimate(self, needle):
+        """Return the number of values holding the needle's rarest trigram, or all the values"""
+        postings = [self.postings.get(trigram, ()) for trigram in trigrams(needle.lower())]
+        return min(map(len, postings)) if postings else len(self.values)
+
+    def contains(self, needle):
+        """Return the ids of the values containing needle, ignoring case
+        Candidates hold every trigram of the needle, then are checked for the whole needle"""
+        needle = needle.lower()
+        postings = [self.postings.get(trigram) for trigram in trigrams(needle)]
+        if not postings:
+            # Too short to have a trigram, so check each distinct value
+            return [value_id for value_id, text in enumerate(self.values) if needle in text]
+        if None in postings:
+            return []
+        return [value_id for value_id in intersect_postings(postings)
+                if needle in self.values[value_id]]
+
+    def similar(self, needle, max_edits):
+        """Return (edits, value id) for the values with a substring within max_edits edits
+        of needle, ignoring case. An edit changes at most three trigrams, so candidates must
+        share all but 3 * max_edits of the needle's distinct trigrams. Any such value holds
+        one of the rarest few, which give the candidates, and the rest are checked by bisecting
+        into their postings. Candidates are then checked by edit distance."""
+        needle = needle.lower()
+        postings = sorted((self.postings.get(trigram, ()) for trigram in trigrams(needle)), key=len)
+        required = len(postings) - 3 * max_edits
+        if required <= 0:
+            # Too short to rule any value out from its trigrams
+            candidates = range(len(self.values))
+        else:
+            rare = len(postings) - required + 1
+            counts = collections.Counter()
+            for posting in postings[:rare]:
+                counts.update(posting)
+            for posting in postings[rare:]:
+                for value_id in counts:
+                    index = bisect.bisect_left(posting, value_id)
+                    if index < len(posting) and posting[index] == value_id:
+                        counts[value_id] += 1
+            candidates = [value_id for value_id, count in counts.items() if count >= required]
+        matches = []
+        for value_id in candidates:
+            edits = substring_edit_distance(needle, self.values[value_id], max_edits)
+            if edits is not None:
+                matches.append((edits, value_id))
+        return matches
+
+# Query plans
+class Query(abc.ABC):
+    """Base class for a condition, or combination of conditions, on a search type
+    Indexed queries can list their matching positions without checking every record,
+    and every query can check whether a single record matches."""
+    indexed = True
+
+    def __init__(self, validated_dict_list):
+        self.validated_dict_list = validated_dict_list
+        self._estimate = None
+
+    def estimate(self):
+        """Return the expected number of matching records, from index statistics"""
+        if self._estimate is None:
+            self._estimate = self.calculate_estimate()
+        return self._estimate
+
+    def calculate_estimate(self):
+        """Work out the expected number of matching records"""
+        return len(self.positions())
+
+    def positions(self):
+        """Return the sorted positions of the matching records"""
+        return [position for position in self.validated_dict_list.values.live_positions()
+                if self.matches(position)]
+
+    def ranked_positions(self):
+        """Return the positions of the matching records in the order to show them"""
+        return self.positions()
+
+    def match_count(self, ranked_positions):
+        """Return the number of matching records, given the positions from ranked_positions"""
+        return len(ranked_positions)
+
+    @abc.abstractmethod
+    def matches(self, position):
+        """Return True if the record at position matches"""
+
+    def explain(self, indent=""):
+        """Return lines describing how the query is evaluated"""
+        return ["{}{} ({}, estimated {} records)".format(
+            indent, self, "index" if self.indexed else "scan", self.estimate())]
+
+class FieldPredicate(Query):
+    """A condition on one field, where the matching positions are found once and kept"""
+    def __init__(self, validated_dict_list, field_name):
+        super().__init__(validated_dict_list)
+        self.field_name = field_name
+        self._positions = None
+
+    def positions(self):
+        if self._positions is None:
+            self._positions = self.find_positions()
+        return self._positions
+
+    @abc.abstractmethod
+    def find_positions(self):
+        """Look up the matching positions"""
+
+    def field_value(self, position):
+        """Return the field's value in the record at position, or None if it's missing"""
+        try:
+            return self.validated_dict_list.values.get_value(position, self.field_name)
+        except KeyError:
+            return None
+
+class ExactPredicate(FieldPredicate):
+    """Field equal to a value, comparing both as strings"""
+    def __init__(self, validated_dict_list, field_name, match_value):
+        if field_name not in validated_dict_list.fields.keys():
+            fail("{} is not a valid key for {}".format(field_name, validated_dict_list.name))
+        super().__init__(validated_dict_list, field_name)
+        self.match_value = str(match_value)
+
+    def find_positions(self):
+        # To simplify searching generic fields, the index compares data as strings
+        return self.validated_dict_list.lookup(self.field_name, self.match_value)
+
+    def matches(self, position):
+        try:
+            value = self.validated_dict_list.values.get_value(position, self.field_name)
+        except KeyError:
+            return False
+        return str(value) == self.match_value
+
+    def __str__(self):
+        return "{} = {}".format(self.field_name, json.dumps(self.match_value))
+
+class MemberPredicate(FieldPredicate):
+    """List field containing any or all of some values"""
+    def __init__(self, validated_dict_list, field_name, elements, match_all):
+        if validated_dict_list.fields.get(field_name) is not list:
+            fail("{} is not a list field of {}".format(field_name, validated_dict_list.name))
+        if not elements:
+            fail("Searching the elements of {} needs at least one value".format(field_name))
+        super().__init__(validated_dict_list, field_name)
+        self.elements = [str(element) for element in elements]
+        self.match_all = match_all
+
+    def calculate_estimate(self):
+        member_index = self.validated_dict_list.member_index(self.field_name)
+        sizes = [len(member_index.get(element, ())) for element in self.elements]
+        if self.match_all:
+            return min(sizes)
+        return min(sum(sizes), self.validated_dict_list.values.live_count())
+
+    def find_positions(self):
+        return self.validated_dict_list.lookup_members(self.field_name, self.elements,
+                                                       self.match_all)
+
+    def matches(self, position):
+        elements = set(map(str, self.field_value(position) or ()))
+        test = all if self.match_all else any
+        return test(element in elements for element in self.elements)
+
+    def __str__(self):
+        return "{} {} {}".format(self.field_name, MODE_ALL if self.match_all else MODE_ANY,
+                                 " ".join(json.dumps(element) for element in self.elements))
+
+class TextPredicate(FieldPredicate):
+    """Text fields containing any of some words, and every quoted phrase
+    On its own, the best matches are ranked first and only the top_k are kept"""
+    def __init__(self, validated_dict_list, field_name, query, top_k=TEXT_TOP_K):
+        field_names = validated_dict_list.text_fields()
+        if field_name is not None:
+            if field_name not in field_names:
+                fail("{} is not a text field of {}".format(field_name, validated_dict_list.name))
+            field_names = [field_name]
+        words = split_values(query)
+        if not words:
+            fail("Text search needs at least one word")
+        super().__init__(validated_dict_list, field_name)
+        self.field_names = field_names
+        self.words = words
+        self.top_k = top_k
+
+    def calculate_estimate(self):
+        return min(self.validated_dict_list.values.live_count(),
+                   self.validated_dict_list.get_text_index().document_frequency(self.words,
+                                                                              self.field_names))
+
+    def find_positions(self):
+        return self.validated_dict_list.get_text_index().candidates(self.words, self.field_names)
+
+    def ranked_positions(self):
+        return self.validated_dict_list.text_search(self.words, self.field_names, self.top_k)
+
+    def match_count(self, ranked_positions):
+        # Only the top_k best matches are ranked, so there may be more
+        if self.top_k is not None and len(ranked_positions) >= self.top_k:
+            return len(self.positions())
+        return len(ranked_positions)
+
+    def matches(self, position):
+        values = self.validated_dict_list.values
+        field_tokens = [TextIndex.tokenize(values.get_value(position, field_name))
+                        for field_name in self.field_names]
+        found_word = False
+        for phrase in (TextIndex.tokenize(word) for word in self.words):
+            if not phrase:
+                continue
+            if len(phrase) > 1 and not any(contains_sequence(tokens, phrase) for tokens in field_tokens):
+                return False
+            found_word = found_word or any(token in tokens for token in phrase
+                                           for tokens in field_tokens)
+        return found_word
+
+    def __str__(self):
+        return "{} text {}".format(self.field_name or "*",
+                                   " ".join(json.dumps(word) for word in self.words))
+
+class RangePredicate(FieldPredicate):
+    """Int or timestamp field compared with one value, or between two"""
+    def __init__(self, validated_dict_list, field_name, mode, match_values):
+        if field_name not in validated_dict_list.range_fields():
+            fail("{} is not an int or timestamp field of {}".format(field_name,
+                                                                    validated_dict_list.name))
+        expected = 2 if mode == "between" else 1
+        if len(match_values) != expected:
+            fail("{} needs {} value(s) to compare with".format(mode, expected))
+        super().__init__(validated_dict_list, field_name)
+        self.mode = mode
+        self.match_values = match_values
+        limits = [range_value(validated_dict_list, field_name, value) for value in match_values]
+        self.low = self.high = None
+        self.include_low = self.include_high = True
+        if mode == "between":
+            self.low, self.high = limits
+        elif mode.startswith(">"):
+            self.low = limits[0]
+            self.include_low = mode == ">="
+        else:
+            self.high = limits[0]
+            self.include_high = mode == "<="
+
+    def calculate_estimate(self):
+        start, end = self.validated_dict_list.range_bounds(self.field_name, self.low, self.high,
+                                                           self.include_low, self.include_high)
+        return end - start
+
+    def find_positions(self):
+        return self.validated_dict_list.lookup_range(self.field_name, self.low, self.high,
+                                                     self.include_low, self.include_high)
+
+    def matches(self, position):
+        values = self.validated_dict_list.values
+        if self.field_name in values.epochs:
+            value = values.epochs[self.field_name][position]
+        else:
+            value = self.field_value(position)
+        if type(value) is not int:
+            return False
+        if self.low is not None and (value < self.low or (value == self.low and not self.include_low)):
+            return False
+        if self.high is not None and (value > self.high or (value == self.high and not self.include_high)):
+            return False
+        return True
+
+    def __str__(self):
+        return "{} {} {}".format(self.field_name, self.mode,
+                                 " ".join(json.dumps(value) for value in self.match_values))
+
+class ScanPredicate(FieldPredicate):
+    """Field containing a substring, ignoring case, matching a regular expression, or containing
+    a substring with a few typos. Substrings of the TRIGRAM_FIELDS are found in a TrigramIndex.
+    Otherwise the records are scanned, in parallel when there are many.
+    On its own, fuzzy matches are ranked by the fewest typos"""
+    indexed = False
+
+    def __init__(self, validated_dict_list, field_name, mode, needle):
+        if field_name not in validated_dict_list.fields.keys():
+            fail("{} is not a valid key for {}".format(field_name, validated_dict_list.name))
+        if mode == MODE_MATCHES:
+            try:
+                re.compile(needle)
+            except re.error as ex:
+                fail("Invalid regular expression {}: {}".format(needle, str(ex)))
+        super().__init__(validated_dict_list, field_name)
+        self.mode = mode
+        self.needle = needle
+        self.test = scan_test(mode, needle)
+        # (edits, value id) of the values a fuzzy search finds in the trigram index
+        self._similar = None
+        if mode != MODE_MATCHES and field_name in validated_dict_list.trigram_fields():
+            self.indexed = True
+
+    def calculate_estimate(self):
+        if self.indexed and self.mode == MODE_CONTAINS:
+            trigram_index = self.validated_dict_list.trigram_index(self.field_name)
+            return min(self.validated_dict_list.values.live_count(),
+                       trigram_index.estimate(self.needle))
+        # Nothing is known about how many records match without checking them
+        return self.validated_dict_list.values.live_count()
+
+    def find_positions(self):
+        if not self.indexed:
+            return scan_positions(self.validated_dict_list, self.field_name, self.mode, self.needle)
+        trigram_index = self.validated_dict_list.trigram_index(self.field_name)
+        if self.mode == MODE_CONTAINS:
+            return trigram_index.record_positions(trigram_index.contains(self.needle))
+        return trigram_index.record_positions(value_id for _, value_id in self.similar_values())
+
+    def similar_values(self):
+        """Return (edits, value id) for the values of the trigram index a fuzzy search finds,
+        worked out once for both finding and ranking the records"""
+        if self._similar is None:
+            trigram_index = self.validated_dict_list.trigram_index(self.field_name)
+            self._similar = trigram_index.similar(self.needle, fuzzy_edits(self.needle))
+        return self._similar
+
+    def ranked_positions(self):
+        if self.mode != MODE_FUZZY:
+            return self.positions()
+        if self.indexed:
+            # The index already worked out the edits of each value
+            trigram_index = self.validated_dict_list.trigram_index(self.field_name)
+            return [position for _, position in sorted(
+                (edits, position) for edits, value_id in self.similar_values()
+                for position in trigram_index.record_positions((value_id,)))]
+        needle = self.needle.lower()
+        max_edits = fuzzy_edits(needle)
+        values = self.validated_dict_list.values
+        return sorted(self.positions(), key=lambda position: (substring_edit_distance(
+            needle, str(values.get_value(position, self.field_name)).lower(), max_edits), position))
+
+    def matches(self, position):
+        try:
+            value = self.validated_dict_list.values.get_value(position, self.field_name)
+        except KeyError:
+            return False
+        return self.test(str(value))
+
+    def __str__(self):
+        return "{} {} {}".format(self.field_name, self.mode, json.dumps(self.needle))
+
+class RelatedPredicate(FieldPredicate):
+    """Condition on the record a foreign key refers to, such as a ticket's organization"""
+    def __init__(self, validated_dict_list, relation, field_name, related_list, related_query):
+        super().__init__(validated_dict_list, field_name)
+        self.relation = relation
+        self.related_list = related_list
+        self.related_query = related_query
+        self.indexed = related_query.indexed
+
+    def calculate_estimate(self):
+        # Assume each related record is referred to by an equal share of these records
+        related_count = max(1, self.related_list.values.live_count())
+        share = self.validated_dict_list.values.live_count() / related_count
+        return min(self.validated_dict_list.values.live_count(),
+                   int(math.ceil(self.related_query.estimate() * share)))
+
+    def find_positions(self):
+        related_values = self.related_list.values
+        keys = set(str(related_values.get_value(position, FIELD_ID))
+                   for position in self.related_query.positions())
+        foreign_index = self.validated_dict_list.index(self.field_name)
+        return union_postings([foreign_index[key] for key in keys if key in foreign_index])
+
+    def matches(self, position):
+        key = self.field_value(position)
+        return key is not None and any(self.related_query.matches(related_position)
+                                       for related_position in self.related_list.lookup(FIELD_ID, key))
+
+    def __str__(self):
+        return "{}.({})".format(self.relation, self.related_query)
+
+    def explain(self, indent=""):
+        lines = super().explain(indent)
+        lines.extend(self.related_query.explain(indent + "    {} via {}: ".format(self.relation,
+                                                                              self.field_name)))
+        return lines
+
+class NotQuery(Query):
+    """Records not matching a query"""
+    def __init__(self, validated_dict_list, query):
+        super().__init__(validated_dict_list)
+        self.query = query
+        self.indexed = query.indexed
+
+    def calculate_estimate(self):
+        return self.validated_dict_list.values.live_count() - self.query.estimate()
+
+    def positions(self):
+        if not self.query.indexed:
+            return super().positions()
+        excluded = set(self.query.positions())
+        return [position for position in self.validated_dict_list.values.live_positions()
+                if position not in excluded]
+
+    def matches(self, position):
+        return not self.query.matches(position)
+
+    def __str__(self):
+        return "NOT {}".format(self.query)
+
+    def explain(self, indent=""):
+        return ["{}NOT (estimated {} records)".format(indent, self.estimate())] + \
+            self.query.explain(indent + "    ")
+
+class OrQuery(Query):
+    """Records matching any of some queries"""
+    def __init__(self, validated_dict_list, queries):
+        super().__init__(validated_dict_list)
+        self.queries = queries
+        self.indexed = all(query.indexed for query in queries)
+
+    def calculate_estimate(self):
+        return min(self.validated_dict_list.values.live_count(),
+                   sum(query.estimate() for query in self.queries))
+
+    def positions(self):
+        if not self.indexed:
+            # One pass over the records is cheaper than a scan per query
+            return super().positions()
+        return union_postings([query.positions() for query in self.queries])
+
+    def matches(self, position):
+        return any(query.matches(position) for query in self.queries)
+
+    def __str__(self):
+        return "({})".format(" OR ".join(str(query) for query in self.queries))
+
+    def explain(self, indent=""):
+        strategy = "union of indexes" if self.indexed else "scan checking each"
+        lines = ["{}OR, {} (estimated {} records)".format(indent, strategy, self.estimate())]
+        for query in self.queries:
+            lines.extend(query.explain(indent + "    "))
+        return lines
+
+class AndQuery(Query):
+    """Records matching all of some queries
+    The query expected to match the fewest records is evaluated first. Each other
+    query then either has its index intersected with the candidates, or checks
+    each candidate, whichever is expected to be cheaper."""
+    def __init__(self, validated_dict_list, queries):
+        super().__init__(validated_dict_list)
+        self.queries = queries
+        self.indexed = any(query.indexed for query in queries)
+        self._plan = None
+
+    def plan(self):
+        """Return a list of (strategy, query, estimated candidates afterwards) in evaluation order"""
+        if self._plan is not None:
+            return self._plan
+        record_count = max(1, self.validated_dict_list.values.live_count())
+        # Queries that can be looked up come first, most selective first
+        ordered = sorted(self.queries, key=lambda query: (not query.indexed or isinstance(query, NotQuery),
+                                                          query.estimate()))
+        first = ordered[0]
+        candidates = first.estimate()
+        steps = [(PLAN_LOOKUP if first.indexed else PLAN_SCAN, first, candidates)]
+        for query in ordered[1:]:
+            lookup_cost = query.query.estimate() if isinstance(query, NotQuery) else query.estimate()
+            if query.indexed and lookup_cost < candidates * FILTER_COST:
+                strategy = PLAN_EXCLUDE if isinstance(query, NotQuery) else PLAN_INTERSECT
+            else:
+                strategy = PLAN_FILTER
+            # Assume the queries are independent
+            candidates = int(math.ceil(candidates * query.estimate() / record_count))
+            steps.append((strategy, query, candidates))
+        self._plan = steps
+        return steps
+
+    def calculate_estimate(self):
+        return self.plan()[-1][2]
+
+    def positions(self):
+        candidates = []
+        for strategy, query, _ in self.plan():
+            if strategy in (PLAN_LOOKUP, PLAN_SCAN):
+                # Unindexed conditions scan the records themselves, in parallel when worth it
+                candidates = query.positions()
+            elif strategy == PLAN_INTERSECT:
+                candidates = intersect_postings([candidates, query.positions()])
+            elif strategy == PLAN_EXCLUDE:
+                excluded = set(query.query.positions())
+                candidates = [position for position in candidates if position not in excluded]
+            else:
+                candidates = [position for position in candidates if query.matches(position)]
+            if not candidates:
+                break
+        return candidates
+
+    def matches(self, position):
+        return all(query.matches(position) for query in self.queries)
+
+    def __str__(self):
+        return "({})".format(" AND ".join(str(query) for query in self.queries))
+
+    def explain(self, indent=""):
+        lines = ["{}AND (estimated {} records)".format(indent, self.estimate())]
+        for step, (strategy, query, candidates) in enumerate(self.plan(), 1):
+            lines.append("{}    {}. {}, leaving an estimated {} records".format(
+                indent, step, strategy, candidates))
+            lines.extend(query.explain(indent + "       "))
+        return lines
+
+class QueryParser(object):
+    """Recursive descent parser for conditions on a search type combined with
+    AND, OR, NOT and brackets. NOT binds tightest, then AND, then OR."""
+    def __init__(self, search_type_key, tokens):
+        self.search_type_key = search_type_key
+        self.validated_dict_list = SEARCH_TYPES[search_type_key]
+        self.tokens = tokens
+        self.position = 0
+
+    def peek(self):
+        """Return the next token, or None at the end"""
+        if self.position < len(self.tokens):
+            return self.tokens[self.position]
+        return None
+
+    def parse(self):
+        """Parse all of the tokens into a Query
+        :raises FailedException: When the tokens aren't a valid search"""
+        query = self.parse_or()
+        if self.peek() is not None:
+            fail("Unexpected {} in search".format(self.peek()))
+        return query
+
+    def parse_or(self):
+        """Parse conditions separated by OR"""
+        queries = [self.parse_and()]
+        while self.peek() == "OR":
+            self.position += 1
+            queries.append(self.parse_and())
+        if len(queries) == 1:
+            return queries[0]
+        return OrQuery(self.validated_dict_list, queries)
+
+    def parse_and(self):
+        """Parse conditions separated by AND"""
+        queries = [self.parse_not()]
+        while self.peek() == "AND":
+            self.position += 1
+            queries.append(self.parse_not())
+        if len(queries) == 1:
+            return queries[0]
+        return AndQuery(self.validated_dict_list, queries)
+
+    def parse_not(self):
+        """Parse a condition, a NOT condition or a bracketed group"""
+        token = self.peek()
+        if token == "NOT":
+            self.position += 1
+            return NotQuery(self.validated_dict_list, self.parse_not())
+        if token == "(":
+            self.position += 1
+            query = self.parse_or()
+            if self.peek() != ")":
+                fail("Missing ) in search")
+            self.position += 1
+            return query
+        start = self.position
+        words = []
+        while self.peek() not in (None, "AND", "OR", "(", ")"):
+            words.append(self.peek())
+            self.position += 1
+        if not words:
+            fail("Expected <field name> <match> in search but found {}".format(token or "the end"))
+        if len(words) == 1 and start > 0 and not is_field_name(self.search_type_key, words[0]):
+            # A lone word that isn't a field, as in subject Rock AND Roll, is part of a value
+            raise NotCompoundException()
+        return parse_predicate(self.search_type_key, words)
 
 # Other classes
 
+class ScanPool(object):
+    """Pool of processes forked from this one to scan the loaded records in parallel
+    Forked processes share the loaded columns with this process copy on write, so
+    the data isn't copied or sent to them. The pool is replaced when the data or
+    the number of jobs changes."""
+    def __init__(self):
+        self.pool = None
+        self.generation = None
+        self.jobs = None
+        # Server threads can scan at the same time, and must share one pool
+        self.lock = threading.Lock()
+
+    def map(self, function, tasks):
+        """Run function over tasks in the pool, returning the results in order"""
+        if "fork" not in multiprocessing.get_all_start_methods():
+            return list(map(function, tasks))
+        with self.lock:
+            if self.pool is None or self.generation != DATA_GENERATION or self.jobs != SCAN_JOBS:
+                self.close()
+                self.pool = multiprocessing.get_context("fork").Pool(SCAN_JOBS)
+                self.generation = DATA_GENERATION
+                self.jobs = SCAN_JOBS
+            pool = self.pool
+        return pool.map(function, tasks)
+
+    def close(self):
+        """Stop the processes in the pool"""
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool.join()
+            self.pool = None
+
+SCAN_POOL = ScanPool()
+
+class ReadWriteLock(object):
+    """Lock letting any number of threads read at once, or one thread write
+    Threads waiting to write go ahead of threads that start reading after them."""
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.readers = 0
+        self.writers_waiting = 0
+        self.writer = False
+
+    @contextlib.contextmanager
+    def reading(self):
+        """Hold the lock for reading"""
+        with self.condition:
+            while self.writer or self.writers_waiting:
+                self.condition.wait()
+            self.readers += 1
+        try:
+            yield
+        finally:
+            with self.condition:
+                self.readers -= 1
+                self.condition.notify_all()
+
+    @contextlib.contextmanager
+    def writing(self):
+        """Hold the lock for writing"""
+        with self.condition:
+            self.writers_waiting += 1
+            while self.writer or self.readers:
+                self.condition.wait()
+            self.writers_waiting -= 1
+            self.writer = True
+        try:
+            yield
+        finally:
+            with self.condition:
+                self.writer = False
+                self.condition.notify_all()
+
+# Searches read the loaded data holding this for reading, and reloads change it holding it for writing
+DATA_LOCK = ReadWriteLock()
+# Held while working out and applying a reload, so only one happens at a time
+RELOAD_LOCK = threading.Lock()
+
+class Stats(object):
+    """Counters and latency histograms of the stages of loading and running commands
+    Stages are timed with start and stop, which cost a flag check when disabled:
+        start = STATS.start()
+        ...
+        STATS.stop("search", start)
+    or a whole function with the timed decorator:
+        @STATS.timed("completion")"""
+    def __init__(self):
+        self.enabled = True
+        self.lock = threading.Lock()
+        self.stages = {}
+        self.counters = {}
+
+    def reset(self):
+        """Forget everything recorded so far"""
+        with self.lock:
+            self.stages = {}
+            self.counters = {}
+
+    def start(self):
+        """Return the start time of a stage, or None when disabled"""
+        return time.perf_counter() if self.enabled else None
+
+    def stop(self, stage, start):
+        """Record the time since a stage started, if it was timed"""
+        if start is not None:
+            self.record(stage, time.perf_counter() - start)
+
+    @contextlib.contextmanager
+    def timed(self, stage):
+        """Time a with block as a run of a stage, or each call of a function it decorates"""
+        start = self.start()
+        try:
+            yield
+        finally:
+            self.stop(stage, start)
+
+    def record(self, stage, seconds):
+        """Record one run of a stage that took seconds"""
+        bucket = bisect.bisect_right(STATS_BUCKETS, seconds)
+        with self.lock:
+            stats = self.stages.get(stage)
+            if stats is None:
+                stats = self.stages[stage] = {"count": 0, "seconds": 0.0, "max": 0.0,
+                                              "histogram": [0] * len(STATS_BUCKET_LABELS)}
+            stats["count"] += 1
+            stats["seconds"] += seconds
+            stats["max"] = max(stats["max"], seconds)
+            stats["histogram"][bucket] += 1
+
+    def count(self, counter, amount=1):
+        """Add to a counter"""
+        if self.enabled:
+            with self.lock:
+                self.counters[counter] = self.counters.get(counter, 0) + amount
+
+    def dump(self):
+        """Return everything recorded as plain values, for json"""
+        with self.lock:
+            return {
+                "enabled": self.enabled,
+                "stages": {stage: dict(stats, histogram=dict(zip(STATS_BUCKET_LABELS,
+                                                                 stats["histogram"])))
+                           for stage, stats in self.stages.items()},
+                "counters": dict(self.counters),
+            }
+
+STATS = Stats()
+
+class CachedSearch(object):
+    """The matching positions of a search kept by the QueryCache, and the results
+    created for them so far by index, which hold the names of related records"""
+    def __init__(self, key, search_type_key, positions, match_count):
+        self.key = key
+        self.search_type_key = search_type_key
+        self.positions = array("q", positions)
+        self.match_count = match_count
+        self.results = {}
+        self.size = QUERY_CACHE_ENTRY_BYTES + self.positions.itemsize * len(self.positions)
+
+class QueryCache(object):
+    """Least recently used cache of searches by normalized query, bounded by the number of
+    searches and an estimate of the memory they use. Everything cached is dropped once the
+    data changes, as seen by DATA_GENERATION. Safe to use from several threads."""
+    def __init__(self, max_entries=QUERY_CACHE_ENTRIES, max_bytes=QUERY_CACHE_BYTES):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.entries = collections.OrderedDict()
+        self.size = 0
+        self.generation = DATA_GENERATION
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def clear(self):
+        """Drop every cached search"""
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+    def check_generation(self):
+        """Drop every cached search if the data has changed since they were cached
+        Called with the lock held"""
+        if self.generation != DATA_GENERATION:
+            self.entries.clear()
+            self.size = 0
+            self.generation = DATA_GENERATION
+
+    def get(self, key):
+        """Return the CachedSearch for a normalized query, or None, counting a hit or miss"""
+        with self.lock:
+            self.check_generation()
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self.entries.move_to_end(key)
+        STATS.count("query cache misses" if entry is None else "query cache hits")
+        return entry
+
+    def put(self, key, search_type_key, positions, match_count):
+        """Cache the positions found by a search
+        :param match_count: The number of matching records, which may be more than the positions
+        :return: The CachedSearch, or None when the search is too big to cache"""
+        entry = CachedSearch(key, search_type_key, positions, match_count)
+        if entry.size > self.max_bytes or self.max_entries <= 0:
+            return None
+        with self.lock:
+            self.check_generation()
+            previous = self.entries.pop(key, None)
+            if previous is not None:
+                self.size -= previous.size
+            self.entries[key] = entry
+            self.size += entry.size
+            self.evict()
+        return entry
+
+    def add_result(self, entry, index, result):
+        """Keep a result created for a cached search, if the search is still cached"""
+        size = result_size(result)
+        with self.lock:
+            if self.entries.get(entry.key) is not entry or index in entry.results:
+                return
+            entry.results[index] = result
+            entry.size += size
+            self.size += size
+            self.evict()
+
+    def evict(self):
+        """Drop the least recently used searches until within the limits
+        Called with the lock held"""
+        while self.entries and (len(self.entries) > self.max_entries or
+                                self.size > self.max_bytes):
+            _, entry = self.entries.popitem(last=False)
+            self.size -= entry.size
+            self.evictions += 1
+
+    def resize(self, max_entries=None, max_bytes=None):
+        """Change the limits, evicting searches as needed"""
+        with self.lock:
+            if max_entries is not None:
+                self.max_entries = max_entries
+            if max_bytes is not None:
+                self.max_bytes = max_bytes
+            self.evict()
+
+    def dump(self):
+        """Return the limits, contents and hit rate as a dictionary of plain values"""
+        with self.lock:
+            self.check_generation()
+            lookups = self.hits + self.misses
+            return {"entries": len(self.entries), "max_entries": self.max_entries,
+                    "bytes": self.size, "max_bytes": self.max_bytes,
+                    "hits": self.hits, "misses": self.misses, "evictions": self.evictions,
+                    "hit_rate": self.hits / lookups if lookups else 0.0}
+
+QUERY_CACHE = QueryCache()
+
+class SchemaWarnings(object):
+    """The defaults created while validating a file, counted per field with a few record ids
+    as examples, so a file missing a field in every record doesn't print a line per record"""
+    def __init__(self, filename, validatedict):
+        self.filename = filename
+        self.fields = validatedict
+        self.counts = {}
+        self.examples = {}
+
+    def add(self, record_id, keys):
+        """Count the defaults created for a record"""
+        for key in keys:
+            if VERBOSE_WARNINGS:
+                print("{} Creating a default for {} {} record id {}".format(
+                    self.filename, key, self.fields[key], record_id), file=sys.stderr)
+            self.counts[key] = self.counts.get(key, 0) + 1
+            examples = self.examples.setdefault(key, [])
+            if len(examples) < WARNING_EXAMPLES:
+                examples.append(record_id)
+
+    def merge(self, other):
+        """Add the defaults counted by another SchemaWarnings for the same file"""
+        for key, count in other.counts.items():
+            self.counts[key] = self.counts.get(key, 0) + count
+            examples = self.examples.setdefault(key, [])
+            examples.extend(other.examples[key][:WARNING_EXAMPLES - len(examples)])
+
+    def report(self):
+        """Warn once for each field that defaults were created for, on stderr
+        In verbose mode each default was already reported as it was created"""
+        if VERBOSE_WARNINGS:
+            return
+        for key, _type in self.fields.items():
+            count = self.counts.get(key)
+            if count:
+                print("{} Created a default for {} {} in {} record(s), e.g. record ids {}{}".format(
+                    self.filename, key, _type, count, ", ".join(map(str, self.examples[key])),
+                    ", ..." if count > len(self.examples[key]) else ""), file=sys.stderr)
+
+class SearchResults(Sequence):
+    """The results of a search, created from the matching records as they are accessed
+    Counting the results needs no records, and presenting a page of them only
+    gathers the related records for that page. Results of a cached search are kept
+    in its CachedSearch, so the related records are only gathered once.
+    match_count is the number of matching records, which is more than the results
+    when only the best matches are kept. generation is the DATA_GENERATION searched,
+    as the results only hold the positions of the records in that data."""
+    def __init__(self, search_type_key, records, cached=None, match_count=None):
+        self.search_type_key = search_type_key
+        self.records = records
+        self.cached = cached
+        self.match_count = len(records) if match_count is None else match_count
+        self.generation = DATA_GENERATION
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self.result(position) for position in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        return self.result(index)
+
+    def result(self, index):
+        """Return the result at an index, from the cache when it was created before"""
+        if self.cached is None:
+            return create_result(self.search_type_key, self.records[index])
+        result = self.cached.results.get(index)
+        if result is None:
+            result = create_result(self.search_type_key, self.records[index])
+            QUERY_CACHE.add_result(self.cached, index, result)
+        return result
+
+    def __len__(self):
+        return len(self.records)
+
 class ValidatedDictList(object):
     """Read in a json file and type check it from the given dict of key -> type
-    Store the read in list of dictionaries inside this instance"""
-    def __init__(self, filename, name, validatedict):
+    Store the read in records inside this instance in a ColumnStore
+    When use_snapshot is set, a snapshot of the validated records saved by
+    save_snapshot is used instead of the file if the file hasn't changed.
+    When records is given, those records are validated and stored instead of reading the file"""
+    def __init__(self, filename, name, validatedict, use_snapshot=False, records=None):
+        start = STATS.start()
         self.name = name
-        loadeddict = loadfile(filename)
-
-        for val in loadeddict:
-            for key, _type in validatedict.items():
-                if key not in val:
-                    # Not all entries are complete, so create a default
-                    # This could later be extended to provide a default in the type defintion
-                    # Never create a valid id though
-                    if key.endswith("_id"):
-                        val[key] = None
-                    else:
-                        val[key] = _type()
-                    # Creating a default could cause problems depending on data needs
-                    # So warn about it on load
-                    print("{} Creating a default for {} {} record id {}".format(
-                                filename, key, _type, val[FIELD_ID]),
-                          file=sys.stderr)
-                elif type(val[key]) is not _type:
-                    fail("{} contained entry {} with key {} that was type {} instead of {}".format(
-                            filename, val, key, type(val[key]), _type))
-        self.values = loadeddict
+        self.filename = filename
         self.fields = validatedict
+        self.use_snapshot = use_snapshot
+        self.snapshot_key = None
+        self.from_snapshot = False
+        # Size and modification time of the file when it was read, to notice it changing
+        self.source_stat = None
+        # field name -> sorted distinct string values for tab completion, built on first use
+        self.completions = {}
+        # list field name -> {str(element): [record positions]}, built on first use
+        self.member_indexes = {}
+        # TextIndex over the TEXT_FIELDS of the schema, built on first use
+        self.text_index = None
+        # field name -> TrigramIndex for the TRIGRAM_FIELDS of the schema, built on first use
+        self.trigram_indexes = {}
+        # int or timestamp field name -> (sorted values, positions), built on first use
+        self.range_indexes = {}
+        if use_snapshot:
+            self.snapshot_key = snapshot_key(filename, validatedict)
+            if self.load_snapshot():
+                self.from_snapshot = True
+                self.source_stat = (self.snapshot_key["size"], self.snapshot_key["mtime"])
+                STATS.stop("load", start)
+                return
+        self.values = self.create_store()
+        # field name -> {str(value): [record positions]}, built on first use
+        self.indexes = {}
+        # Records are validated and stored as they are read so the whole file
+        # never needs to be held in memory at once
+        if records is None:
+            self.source_stat = source_stat(filename)
+            records = iterloadfile(filename)
+        self.store_records(self.validate_records(filename, records))
+        STATS.count("records loaded", len(self.values))
+        if self.snapshot_key is not None and not snapshot_source_matches(filename,
+                                                                         self.snapshot_key):
+            # The file changed while loading, so the key doesn't describe what was loaded
+            self.snapshot_key = None
+        STATS.stop("load", start)
+
+    def load_snapshot(self):
+        """Use the records and indexes of the snapshot matching snapshot_key if there is one
+        :return: True when the snapshot was loaded"""
+        snapshot = load_snapshot(self.filename, self.snapshot_key)
+        if snapshot is None:
+            return False
+        self.values, self.indexes = snapshot
+        return True
+
+    def create_store(self):
+        """Return the empty store the validated records are kept in"""
+        return ColumnStore(self.fields, self.timestamp_fields())
+
+    def store_records(self, records):
+        """Store validated records as they are read"""
+        for val in records:
+            self.append(val)
+
+    def snapshot_data(self):
+        """Return what a snapshot saves: the records and a copy of the dictionary of indexes,
+        which searches add to as they build indexes. Take it while no searches are running."""
+        return self.values, dict(self.indexes)
+
+    def save_snapshot(self, data=None):
+        """Save the records and any indexes built so far in the SNAPSHOT_DIR
+        Failing to save only warns, as the snapshot is just there to speed up loading
+        :param data: What snapshot_data returned while no searches were running, or None to
+                     take it now when nothing else can be using the records"""
+        if self.snapshot_key is None:
+            return
+        if data is None:
+            data = self.snapshot_data()
+        try:
+            key = hashed_snapshot_key(self.filename, self.snapshot_key)
+            if key is not None:
+                save_snapshot(self.filename, key, data)
+        except (OSError, pickle.PicklingError) as ex:
+            print("Unable to save snapshot of '{}': {}".format(self.filename, str(ex)),
+                  file=sys.stderr)
+
+    def validate_records(self, filename, records):
+        """Type check records, yielding each one once it is valid with defaults filled in
+        The defaults created are reported once per field after all the records are checked,
+        or for each record in verbose mode. With VALIDATE_JOBS above one, chunks of records
+        are checked in forked processes while the records already checked are stored.
+        :raises FailedException: When a field has an unexpected type"""
+        warnings = SchemaWarnings(filename, self.fields)
+        chunks = iter_chunks(records, VALIDATE_CHUNK_SIZE)
+        seconds = 0.0
+        if VALIDATE_JOBS > 1 and "fork" in multiprocessing.get_all_start_methods():
+            def finish(result):
+                """Wait for a chunk checked in the pool"""
+                nonlocal seconds
+                start = STATS.start()
+                chunk, chunk_warnings, error = result.get()
+                if start is not None:
+                    seconds += time.perf_counter() - start
+                warnings.merge(chunk_warnings)
+                if error is not None:
+                    warnings.report()
+                    fail(error)
+                return chunk
+            with multiprocessing.get_context("fork").Pool(VALIDATE_JOBS) as pool:
+                # Only a few chunks are sent ahead, so the whole file is never held in memory
+                pending = collections.deque()
+                for chunk in chunks:
+                    pending.append(pool.apply_async(validate_chunk,
+                                                    ((self.fields, filename, chunk),)))
+                    if len(pending) > VALIDATE_JOBS * 2:
+                        yield from finish(pending.popleft())
+                while pending:
+                    yield from finish(pending.popleft())
+        else:
+            validator = compiled_validator(self.fields)
+            for chunk in chunks:
+                start = STATS.start()
+                error = check_records(validator, self.fields, filename, chunk, warnings)
+                if start is not None:
+                    seconds += time.perf_counter() - start
+                if error is not None:
+                    warnings.report()
+                    fail(error)
+                yield from chunk
+        if STATS.enabled:
+            STATS.record("validate", seconds)
+        warnings.report()
+
+    def append(self, val):
+        """Store a validated record, adding it to any indexes already built"""
+        position = len(self.values)
+        self.values.append(val)
+        for field_name, field_index in self.indexes.items():
+            if field_name in val:
+                field_index.setdefault(str(val[field_name]), []).append(position)
+        for field_name, member_index in self.member_indexes.items():
+            if field_name in val:
+                for element in set(map(str, val[field_name])):
+                    member_index.setdefault(element, []).append(position)
+        if self.text_index is not None:
+            self.text_index.add(position, val)
+        for field_name, trigram_index in self.trigram_indexes.items():
+            if field_name in val:
+                trigram_index.add(position, val[field_name])
+        if self.completions:
+            self.completions.clear()
+        if self.range_indexes:
+            self.range_indexes.clear()
+
+    def delete(self, position):
+        """Remove a record from the indexes, so searches no longer find it
+        The record stays stored so results found before it was deleted can still show it"""
+        record = self.values[position]
+        for field_name, field_index in self.indexes.items():
+            if field_name in record:
+                remove_posting(field_index, str(record[field_name]), position)
+        for field_name, member_index in self.member_indexes.items():
+            if field_name in record:
+                for element in set(map(str, record[field_name])):
+                    remove_posting(member_index, element, position)
+        if self.text_index is not None:
+            self.text_index.remove(position)
+        for trigram_index in self.trigram_indexes.values():
+            trigram_index.remove(position)
+        self.values.deleted.add(position)
+        if self.completions:
+            self.completions.clear()
+        if self.range_indexes:
+            self.range_indexes.clear()
+
+    def changed_stat(self):
+        """Return the size and modification time of the file if they changed since it was read,
+        otherwise None"""
+        if self.source_stat is None:
+            return None
+        stat = source_stat(self.filename)
+        return None if stat == self.source_stat else stat
+
+    def changes(self, records):
+        """Compare records to the stored records with the same _id
+        :param records: The records of a new version of the file, which are validated
+        :return: Lists of the records to insert, (position, record) of the records to update
+                 and the positions of the records to delete
+        :raises FailedException: When a record is invalid or an _id appears more than once"""
+        ids = self.index(FIELD_ID)
+        inserts = []
+        updates = []
+        seen = set()
+        for record in self.validate_records(self.filename, records):
+            key = str(record[FIELD_ID])
+            if key in seen:
+                fail("found multiple results for value {} of {} in {} only expected one ".format(
+                    key, FIELD_ID, self.name))
+            seen.add(key)
+            positions = ids.get(key)
+            if not positions:
+                inserts.append(record)
+            elif dict(self.values[positions[0]]) != record:
+                updates.append((positions[0], record))
+        deletes = [positions[0] for key, positions in ids.items() if key not in seen]
+        return inserts, updates, deletes
+
+    def apply_changes(self, inserts, updates, deletes):
+        """Apply changes found by changes. Updated records are deleted and stored again
+        as new records, so they move to the end of the search results"""
+        for position in deletes:
+            self.delete(position)
+        for position, record in updates:
+            self.delete(position)
+            self.append(record)
+        for record in inserts:
+            self.append(record)
+
+    def compact(self):
+        """Store only the records that haven't been deleted, in a new ColumnStore
+        Results found before keep the old store. Indexes are built again on first use."""
+        values = self.create_store()
+        for record in self.values:
+            values.append(record)
+        self.values = values
+        self.indexes = {}
+        self.member_indexes = {}
+        self.text_index = None
+        self.trigram_indexes = {}
+        self.range_indexes = {}
+        self.completions = {}
+
+    def index(self, field_name):
+        """Return the index for a field, building it on first use
+        The index maps the string form of each value to the positions of the
+        records holding it, so exact matches don't need to scan every record"""
+        field_index = self.indexes.get(field_name)
+        if field_index is None:
+            field_index = {}
+            for position, value in self.values.iter_field(field_name):
+                field_index.setdefault(str(value), []).append(position)
+            self.indexes[field_name] = field_index
+        return field_index
+
+    def complete(self, field_name, prefix):
+        """Return the distinct string values of a field that start with prefix, in order
+        The sorted values are searched with bisect, so this costs the number of matches"""
+        completion_index = self.completions.get(field_name)
+        if completion_index is None:
+            completion_index = sorted(self.index(field_name))
+            self.completions[field_name] = completion_index
+        matches = []
+        for position in range(bisect.bisect_left(completion_index, prefix), len(completion_index)):
+            value = completion_index[position]
+            if not value.startswith(prefix):
+                break
+            matches.append(value)
+        return matches
+
+    def lookup(self, field_name, match_value):
+        """Return the positions of records whose field matches match_value as a string
+        The positions are a copy, so results found before a reload aren't changed by it"""
+        return list(self.index(field_name).get(str(match_value), ()))
+
+    def duplicate_value(self, field_name):
+        """Return the string form of a value of a field held by more than one record,
+        or None when every value is unique"""
+        for value, positions in self.index(field_name).items():
+            if len(positions) > 1:
+                return value
+        return None
+
+    def member_index(self, field_name):
+        """Return the inverted index for a list field, building it on first use
+        The index maps the string form of each element to the positions of the
+        records whose list contains it"""
+        member_index = self.member_indexes.get(field_name)
+        if member_index is None:
+            member_index = {}
+            for position, elements in self.values.iter_field(field_name):
+                for element in set(map(str, elements)):
+                    member_index.setdefault(element, []).append(position)
+            self.member_indexes[field_name] = member_index
+        return member_index
+
+    def timestamp_fields(self):
+        """Return the string fields of this schema holding timestamps"""
+        return [field_name for field_name in TIMESTAMP_FIELDS
+                if self.fields.get(field_name) is str]
+
+    def range_fields(self):
+        """Return the fields of this schema that can be compared: ints and timestamps"""
+        return [field_name for field_name, _type in self.fields.items()
+                if _type is int] + self.timestamp_fields()
+
+    def range_index(self, field_name):
+        """Return the sorted index of an int or timestamp field, building it on first use
+        :return: An array of the sorted values and an array of the position holding each"""
+        range_index = self.range_indexes.get(field_name)
+        if range_index is None:
+            if field_name in self.values.epochs:
+                column = self.values.epochs[field_name]
+            else:
+                column = self.values.columns[field_name]
+            deleted = self.values.deleted
+            pairs = sorted((value, position) for position, value in enumerate(column)
+                           if type(value) is int and position not in deleted)
+            range_index = (array("q", (value for value, _ in pairs)),
+                           array("L", (position for _, position in pairs)))
+            self.range_indexes[field_name] = range_index
+        return range_index
+
+    def range_bounds(self, field_name, low=None, high=None, include_low=True, include_high=True):
+        """Return the start and end of the part of a field's sorted index between low and high
+        Timestamps are compared as seconds since the epoch
+        :param low: The lowest value to find, or None for no lower limit
+        :param high: The highest value to find, or None for no upper limit"""
+        values, _ = self.range_index(field_name)
+        start = 0
+        end = len(values)
+        if low is not None:
+            start = (bisect.bisect_left if include_low else bisect.bisect_right)(values, low)
+        if high is not None:
+            end = (bisect.bisect_right if include_high else bisect.bisect_left)(values, high)
+        return start, max(start, end)
+
+    def lookup_range(self, field_name, low=None, high=None, include_low=True, include_high=True):
+        """Return the sorted positions of records whose field is between low and high
+        See range_bounds for the parameters"""
+        start, end = self.range_bounds(field_name, low, high, include_low, include_high)
+        _, positions = self.range_index(field_name)
+        return sorted(positions[start:end])
+
+    def text_fields(self):
+        """Return the free text fields of this schema covered by full text search"""
+        return [field_name for field_name in TEXT_FIELDS if field_name in self.fields]
+
+    def get_text_index(self):
+        """Return the TextIndex over the text fields, building it on first use"""
+        if self.text_index is None:
+            text_index = TextIndex(self.text_fields())
+            # The live records are read in order rather than one at a time by position
+            for position, record in zip(self.values.live_positions(), self.values):
+                text_index.add(position, record)
+            self.text_index = text_index
+        return self.text_index
+
+    def text_search(self, query, field_names, top_k=TEXT_TOP_K):
+        """Return the positions of the best matches for a full text query, best first
+        :param query: A list of words or phrases to look for
+        :param field_names: The text fields to search"""
+        text_index = self.get_text_index()
+        if not self.values.live_count():
+            return []
+        return [position for _, position
+                in text_index.search(query, field_names, self.values.live_count(), top_k)]
+
+    def trigram_fields(self):
+        """Return the string fields of the schema with a trigram index"""
+        return [field_name for field_name in TRIGRAM_FIELDS if self.fields.get(field_name) is str]
+
+    def trigram_index(self, field_name):
+        """Return the TrigramIndex of a field, building it on first use"""
+        trigram_index = self.trigram_indexes.get(field_name)
+        if trigram_index is None:
+            trigram_index = TrigramIndex()
+            for position, value in self.values.iter_field(field_name):
+                trigram_index.add(position, value)
+            self.trigram_indexes[field_name] = trigram_index
+        return trigram_index
+
+    def lookup_members(self, field_name, elements, match_all):
+        """Return the positions of records whose list field contains the elements
+        :param match_all: True to require every element, False to require any of them"""
+        member_index = self.member_index(field_name)
+        postings = [member_index.get(str(element), []) for element in elements]
+        if match_all:
+            return intersect_postings(postings)
+        return union_postings(postings)
+
+
+class SqliteDictList(ValidatedDictList):
+    """ValidatedDictList keeping its records in a sqlite database next to the file
+    rather than in memory, for files too large to hold in memory. The file is validated
+    and imported once, then the database is used until the file or schema changes, as
+    snapshots are. Exact lookups, joins, ranges and completion are answered by queries using
+    the sqlite indexes of the fields, while the member, text and trigram indexes are
+    built in memory on first use as usual."""
+    def load_snapshot(self):
+        store = SqliteStore(self.filename + SQLITE_SUFFIX, self.fields, self.timestamp_fields())
+        saved_key = store.key()
+        if saved_key is None or not snapshot_key_matches(
+                self.filename, json.loads(saved_key), dict(self.snapshot_key, version=SQLITE_VERSION)):
+            return False
+        store.open()
+        self.values = store
+        self.indexes = {}
+        return True
+
+    def create_store(self):
+        store = SqliteStore(self.filename + SQLITE_SUFFIX, self.fields, self.timestamp_fields())
+        store.create()
+        return store
+
+    def store_records(self, records):
+        """Insert validated records a batch at a time in a single transaction, then index them
+        Building the sqlite indexes once at the end is faster than updating them per record"""
+        with self.values.transaction():
+            for chunk in iter_chunks(records, SQLITE_BATCH_SIZE):
+                self.values.insert(chunk)
+            self.values.create_indexes()
+
+    def save_snapshot(self, data=None):
+        """Mark the database as holding the current file, so it isn't imported again"""
+        key = None
+        if self.snapshot_key is not None:
+            try:
+                key = hashed_snapshot_key(self.filename, self.snapshot_key)
+            except OSError:
+                pass
+        if key is None:
+            self.values.set_key(None)
+        else:
+            self.values.set_key(json.dumps(dict(key, version=SQLITE_VERSION), sort_keys=True))
+
+    def delete(self, position):
+        super().delete(position)
+        self.values.mark_deleted(position)
+
+    def apply_changes(self, inserts, updates, deletes):
+        """Apply changes found by changes in a single transaction"""
+        with self.values.transaction():
+            super().apply_changes(inserts, updates, deletes)
+
+    def compact(self):
+        """Deleted records only take up disk space, so they are kept rather than
+        rewriting the database"""
+        pass
+
+    def index(self, field_name):
+        """Return a SqliteIndex of a field, which looks up values with queries"""
+        return SqliteIndex(self.values, field_name)
 
+    def lookup(self, field_name, match_value):
+        return self.values.lookup(field_name, str(match_value))
+
+    def duplicate_value(self, field_name):
+        if field_name not in self.fields:
+            return super().duplicate_value(field_name)
+        row = self.values.execute(
+            "SELECT {} FROM records WHERE {} GROUP BY 1 HAVING COUNT(*) > 1 LIMIT 1".format(
+                sqlite_name(field_name), self.values.live_clause())).fetchone()
+        return None if row is None else str(self.values.decode(field_name, row[0]))
+
+    def complete(self, field_name, prefix):
+        """Return the distinct string values of a field that start with prefix, in order
+        String fields are searched with their sqlite index, seeking from each match to the
+        next distinct value so this costs the number of matches rather than of records.
+        Other fields have few enough distinct values to filter."""
+        if self.fields.get(field_name) is not str or not prefix:
+            return sorted(value for value in self.values.distinct_values(field_name)
+                          if value.startswith(prefix))
+        end = prefix + chr(sys.maxunicode)
+        rows = self.values.execute(
+            "WITH RECURSIVE matches(value) AS ("
+            "SELECT MIN({0}) FROM records WHERE {0} >= ? AND {0} < ? AND {1} UNION ALL "
+            "SELECT (SELECT MIN({0}) FROM records WHERE {0} > value AND {0} < ? AND {1}) "
+            "FROM matches WHERE value IS NOT NULL) "
+            "SELECT value FROM matches WHERE value IS NOT NULL".format(
+                sqlite_name(field_name), self.values.live_clause()), (prefix, end, end))
+        matches = [value for value, in rows if value.startswith(prefix)]
+        if "None".startswith(prefix) and "None" not in matches and self.values.lookup(
+                field_name, "None"):
+            bisect.insort(matches, "None")
+        return matches
+
+    def range_index(self, field_name):
+        """Return the sorted index of an int or timestamp field, read in order from its
+        sqlite index on first use"""
+        range_index = self.range_indexes.get(field_name)
+        if range_index is None:
+            if field_name in self.values.epochs:
+                column = sqlite_name(epoch_column(field_name))
+            else:
+                column = sqlite_name(field_name)
+            rows = self.values.execute(
+                "SELECT {0}, rowid - 1 FROM records WHERE typeof({0}) = 'integer' AND {1} "
+                "ORDER BY {0}, rowid".format(column, self.values.live_clause())).fetchall()
+            range_index = (array("q", (value for value, _ in rows)),
+                           array("L", (position for _, position in rows)))
+            self.range_indexes[field_name] = range_index
+        return range_index
+
+class Relationships(object):
+    """Primary key and foreign key lookups between orgs, users and tickets
+    Built once at load time so that gathering related records for a result
+    costs a dictionary lookup per related record rather than a table scan"""
+    def __init__(self, orgs, users, tickets):
+        self.orgs = orgs
+        self.users = users
+        self.tickets = tickets
+        # Primary key maps, checked for uniqueness here rather than on every lookup
+        self.orgs_by_id = unique_index(orgs, FIELD_ID)
+        self.users_by_id = unique_index(users, FIELD_ID)
+        unique_index(tickets, FIELD_ID)
+        # Reverse adjacency lists for each foreign key
+        self.users_by_org = users.index(FIELD_ORGANIZATION_ID)
+        self.tickets_by_org = tickets.index(FIELD_ORGANIZATION_ID)
+        self.tickets_by_submitter = tickets.index(FIELD_SUBMITTER_ID)
+        self.tickets_by_assignee = tickets.index(FIELD_ASSIGNEE_ID)
+
+    @staticmethod
+    def _primary(validated_dict_list, primary_map, key, return_field):
+        """Return a field of the record with the given primary key or 'None Found'"""
+        positions = primary_map.get(str(key))
+        if not positions:
+            return NONE_FOUND
+        return validated_dict_list.values.get_value(positions[0], return_field)
+
+    @staticmethod
+    def _related(validated_dict_list, adjacency, key, return_field):
+        """Return a list of a field from each record related by key
+        Gathered straight away with one read of the field, so the time is spent where the
+        result is created"""
+        return validated_dict_list.values.field_values(return_field, adjacency.get(str(key), ()))
+
+    def org_name(self, org_id):
+        """Name of the organization with the given id"""
+        return self._primary(self.orgs, self.orgs_by_id, org_id, FIELD_NAME)
+
+    def user_name(self, user_id):
+        """Name of the user with the given id"""
+        return self._primary(self.users, self.users_by_id, user_id, FIELD_NAME)
+
+    def org_user_names(self, org_id):
+        """Names of the users belonging to an organization"""
+        return self._related(self.users, self.users_by_org, org_id, FIELD_NAME)
+
+    def org_ticket_subjects(self, org_id):
+        """Subjects of the tickets belonging to an organization"""
+        return self._related(self.tickets, self.tickets_by_org, org_id, FIELD_SUBJECT)
+
+    def submitted_ticket_subjects(self, user_id):
+        """Subjects of the tickets submitted by a user"""
+        return self._related(self.tickets, self.tickets_by_submitter, user_id, FIELD_SUBJECT)
+
+    def assigned_ticket_subjects(self, user_id):
+        """Subjects of the tickets assigned to a user"""
+        return self._related(self.tickets, self.tickets_by_assignee, user_id, FIELD_SUBJECT)
+
+
+def unique_index(validated_dict_list, field_name):
+    """Return the index of a field, failing if any value appears in more than one record
+    :raises FailedException: When a value is not unique"""
+    value = validated_dict_list.duplicate_value(field_name)
+    if value is not None:
+        fail("found multiple results for value {} of {} in {} only expected one ".format(
+            value, field_name, validated_dict_list.name))
+    return validated_dict_list.index(field_name)
+
+def compiled_validator(validatedict):
+    """Return a function type checking a record against a schema in a single pass
+    The function fills in defaults for any missing fields, all at once, then returns a
+    tuple of the fields it filled in and the first field with the wrong type, or None.
+    Complete records are checked by one expression generated for the schema, so they
+    cost a lookup and type comparison per field with no loop. Compiled once per schema."""
+    key = tuple(validatedict.items())
+    validator = VALIDATORS.get(key)
+    if validator is not None:
+        return validator
+    namespace = {}
+    checks = []
+    for number, (field_name, _type) in enumerate(validatedict.items()):
+        namespace["type{}".format(number)] = _type
+        checks.append("type(get({!r})) is type{}".format(field_name, number))
+    source = "def complete(record):\n    get = record.get\n    return {}\n".format(
+        " and ".join(checks) or "True")
+    exec(source, namespace)
+    complete = namespace["complete"]
+    # Never create a valid id, so missing ids are None rather than a default of their type
+    defaults = {field_name: (lambda: None) if field_name.endswith("_id") else _type
+                for field_name, _type in validatedict.items()}
+    valid = ((), None)
+
+    def validator(record):
+        if complete(record):
+            return valid
+        missing = tuple(field_name for field_name in validatedict if field_name not in record)
+        if missing:
+            record.update({field_name: defaults[field_name]() for field_name in missing})
+        for field_name, _type in validatedict.items():
+            # Defaults are always the right type, apart from ids
+            if type(record[field_name]) is not _type and field_name not in missing:
+                return missing, field_name
+        return missing, None
+    VALIDATORS[key] = validator
+    return validator
+
+def check_records(validator, validatedict, filename, records, warnings):
+    """Validate records, filling in defaults and counting them in warnings
+    :return: The error message for the first record with a field of the wrong type, or None"""
+    for record in records:
+        missing, wrong = validator(record)
+        if missing:
+            warnings.add(record.get(FIELD_ID), missing)
+        if wrong is not None:
+            return "{} contained entry {} with key {} that was type {} instead of {}".format(
+                filename, record, wrong, type(record[wrong]), validatedict[wrong])
+    return None
+
+def validate_chunk(task):
+    """Validate a chunk of records in a validating process
+    :return: The records with defaults filled in, the SchemaWarnings and any error message"""
+    validatedict, filename, records = task
+    warnings = SchemaWarnings(filename, validatedict)
+    error = check_records(compiled_validator(validatedict), validatedict, filename, records,
+                          warnings)
+    return records, warnings, error
+
+def iter_chunks(iterable, size):
+    """Yield lists of up to size items from iterable"""
+    iterator = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+def result_size(result):
+    """Estimate the memory used by a ResultValue besides the record and names it refers to,
+    which are kept by the loaded data anyway"""
+    size = sys.getsizeof(result) + sys.getsizeof(vars(result))
+    for value in vars(result).values():
+        if isinstance(value, list):
+            size += sys.getsizeof(value)
+    return size
+
+def remove_posting(field_index, value, position):
+    """Remove a position from the sorted positions of a value in an index,
+    removing the value once no records hold it"""
+    positions = field_index.get(value)
+    if positions is None:
+        return
+    index = bisect.bisect_left(positions, position)
+    if index < len(positions) and positions[index] == position:
+        del positions[index]
+    if not positions:
+        del field_index[value]
+
+def intersect_postings(postings):
+    """Return the positions present in every one of a list of sorted position lists
+    Starts from the shortest list and bisects into the others, so the cost depends
+    on the size of the smallest list rather than the largest"""
+    if not postings:
+        return []
+    postings = sorted(postings, key=len)
+    result = postings[0]
+    for posting in postings[1:]:
+        matched = []
+        low = 0
+        for position in result:
+            low = bisect.bisect_left(posting, position, low)
+            if low == len(posting):
+                break
+            if posting[low] == position:
+                matched.append(position)
+        result = matched
+        if not result:
+            break
+    return list(result)
+
+def union_postings(postings):
+    """Return the sorted positions present in any of a list of sorted position lists"""
+    if len(postings) == 1:
+        return list(postings[0])
+    return sorted(set().union(*postings))
+
+def snapshot_key(filename, validatedict):
+    """Return the key identifying a file and schema for its snapshot, without the content
+    hash, which is only worked out when saving or when the modification time differs
+    :raises FailedException: When the file can't be read"""
+    try:
+        stat = os.stat(filename)
+    except (OSError, IOError, ) as ex:
+        fail("Unable to open '{}': {}".format(filename, str(ex)))
+    return {
+        "version": SNAPSHOT_VERSION,
+        "path": os.path.abspath(filename),
+        "size": stat.st_size,
+        "mtime": stat.st_mtime_ns,
+        "schema": [[key, _type.__name__] for key, _type in validatedict.items()],
+    }
+
+def file_digest(filename):
+    """Return the hash of a file's contents
+    :raises OSError: When the file can't be read"""
+    digest = hashlib.blake2b()
+    with open(filename, "rb") as sourcefile:
+        for block in iter(lambda: sourcefile.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+def hashed_snapshot_key(filename, key):
+    """Return a snapshot key with the hash of the file's contents added to save it with
+    :return: The key, or None when the file changed since the key was taken
+    :raises OSError: When the file can't be read"""
+    hashed = dict(key, hash=file_digest(filename))
+    if not snapshot_source_matches(filename, key):
+        return None
+    return hashed
+
+def snapshot_key_matches(filename, saved_key, key):
+    """Return True if a key saved with a snapshot describes the file key was taken from
+    A file with a different modification time but the same size, such as a copy, is hashed
+    to check its contents are the same"""
+    if not isinstance(saved_key, dict) or "hash" not in saved_key:
+        return False
+    if dict(saved_key, mtime=key["mtime"], hash=None) != dict(key, hash=None):
+        return False
+    if saved_key["mtime"] == key["mtime"]:
+        return True
+    try:
+        return file_digest(filename) == saved_key["hash"]
+    except OSError:
+        return False
+
+def snapshot_path(filename):
+    """Return where the snapshot of a file is kept, named after the file and its whole path"""
+    path_digest = hashlib.blake2b(os.path.abspath(filename).encode(), digest_size=8).hexdigest()
+    return os.path.join(SNAPSHOT_DIR, "{}-{}{}".format(os.path.basename(filename), path_digest,
+                                                      SNAPSHOT_SUFFIX))
+
+def is_private(path):
+    """Return True if nobody but this user can have written path: it is theirs and
+    neither its group nor anyone else may write to it"""
+    stat = os.stat(path)
+    if hasattr(os, "getuid") and stat.st_uid != os.getuid():
+        return False
+    return not stat.st_mode & 0o022
+
+def source_stat(filename):
+    """Return the size and modification time of a file, or None when it can't be read"""
+    try:
+        stat = os.stat(filename)
+    except OSError:
+        return None
+    return stat.st_size, stat.st_mtime_ns
+
+def snapshot_source_matches(filename, key):
+    """Cheaply check a file's size and modification time still match a snapshot key"""
+    return source_stat(filename) == (key["size"], key["mtime"])
+
+def load_snapshot(filename, key):
+    """Return the data saved in a file's snapshot, or None if it is missing or out of date
+    The key is stored ahead of the data so a stale snapshot is rejected without reading it.
+    Snapshots others could have written are ignored, as unpickling them can run any code."""
+    snapshot_name = snapshot_path(filename)
+    try:
+        if not (is_private(SNAPSHOT_DIR) and is_private(snapshot_name)):
+            print("Ignoring snapshot of '{}' as others can write to '{}'".format(filename,
+                                                                                 snapshot_name),
+                  file=sys.stderr)
+            return None
+        with open(snapshot_name, "rb") as snapshotfile:
+            if not snapshot_key_matches(filename, pickle.load(snapshotfile), key):
+                return None
+            return pickle.load(snapshotfile)
+    except FileNotFoundError:
+        return None
+    except (OSError, pickle.UnpicklingError, EOFError, AttributeError, ImportError,
+            IndexError, TypeError, ValueError) as ex:
+        print("Ignoring unreadable snapshot of '{}': {}".format(filename, str(ex)),
+              file=sys.stderr)
+        return None
+
+def save_snapshot(filename, key, data):
+    """Write a snapshot of data for a file, replacing any previous one in a single step
+    :param key: The snapshot key, including the hash of the file's contents"""
+    os.makedirs(SNAPSHOT_DIR, mode=0o700, exist_ok=True)
+    snapshot_name = snapshot_path(filename)
+    temporary_name = "{}.{}.tmp".format(snapshot_name, os.getpid())
+    try:
+        # Only this user may write to the snapshot, as load_snapshot requires
+        with open(temporary_name, "wb",
+                  opener=lambda path, flags: os.open(path, flags, 0o600)) as snapshotfile:
+            pickle.dump(key, snapshotfile, pickle.HIGHEST_PROTOCOL)
+            pickle.dump(data, snapshotfile, pickle.HIGHEST_PROTOCOL)
+        os.replace(temporary_name, snapshot_name)
+    finally:
+        if os.path.exists(temporary_name):
+            os.remove(temporary_name)
 
 def presentation_name(name):
     """Return a name to present or 'None found' if it's missing"""
@@ -182,6 +2998,12 @@ def presentation_name(name):
         return name
     return "None found"
 
+def found_name(name):
+    """Return a related record's name, or None if there was no related record"""
+    if name == NONE_FOUND:
+        return None
+    return name
+
 def fail(message):
     """Handle simple failures by printing a message and then raising an exception"""
     print(message)
@@ -194,7 +3016,7 @@ def find_one_field(validated_dict_list, match_field, match_value, return_field):
     """
     results = find_all(validated_dict_list, match_field, match_value)
     if not results:
-        return "None Found"
+        return NONE_FOUND
     elif len(results) == 1:
         return results[0][return_field]
     else:
@@ -207,36 +3029,191 @@ def find_all(validated_dict_list, match_field, match_value):
     :param match_field: the string of a field name to match on
     :param match_value: the value to match against
     """
-    results = []
-    if match_field not in validated_dict_list.fields.keys():
-        fail("{} is not a valid key for {}".format(match_field, validated_dict_list.name))
-    for value in validated_dict_list.values:
-        if match_field in value:
-            # To simplify searching generic fields, convert  data to string
-            if str(value[match_field]) == str(match_value):
-                results.append(value)
-    return results
+    return RecordList(validated_dict_list.values,
+                      ExactPredicate(validated_dict_list, match_field, match_value).positions())
+
+def find_members(validated_dict_list, match_field, elements, match_all):
+    """ find_members - Search the elements of a list field such as tags
+    :param match_field: the string of a list field name to match on
+    :param elements: the values to look for in the list, compared as strings
+    :param match_all: True for records containing every element, False for any of them
+    """
+    predicate = MemberPredicate(validated_dict_list, match_field, elements, match_all)
+    return RecordList(validated_dict_list.values, predicate.positions())
+
+def find_text(validated_dict_list, match_field, query, top_k=TEXT_TOP_K):
+    """ find_text - Ranked full text search of free text fields
+    :param match_field: the text field to search, or None for all of them
+    :param query: the words to look for, with quotes around phrases
+    :param top_k: the number of best matches to return
+    """
+    predicate = TextPredicate(validated_dict_list, match_field, query, top_k)
+    return RecordList(validated_dict_list.values, predicate.ranked_positions())
 
-def field_from_values(values, field_name):
-    """Return a generator of a certain field from a list of values"""
-    return (value[field_name] for value in values)
+def find_range(validated_dict_list, match_field, mode, match_values):
+    """ find_range - Compare an int or timestamp field using a sorted index
+    :param match_field: the string of an int or timestamp field name
+    :param mode: one of RANGE_MODES
+    :param match_values: the value to compare with, or the lowest and highest value for between
+    """
+    predicate = RangePredicate(validated_dict_list, match_field, mode, match_values)
+    return RecordList(validated_dict_list.values, predicate.positions())
+
+def scan_test(mode, needle):
+    """Return a function testing whether a string matches a scan condition"""
+    if mode == MODE_MATCHES:
+        return re.compile(needle).search
+    needle = needle.lower()
+    if mode == MODE_FUZZY:
+        max_edits = fuzzy_edits(needle)
+        return lambda text: substring_edit_distance(needle, text.lower(), max_edits) is not None
+    return lambda text: needle in text.lower()
+
+def fuzzy_edits(needle):
+    """Return the number of typos a fuzzy search for needle allows"""
+    if len(needle) < FUZZY_MIN_LENGTH:
+        return 0
+    return max(1, len(needle) // FUZZY_CHARS_PER_EDIT)
+
+def trigrams(text):
+    """Return the set of three character sequences in text"""
+    return {text[start:start + 3] for start in range(len(text) - 2)}
+
+def substring_edit_distance(pattern, text, max_edits):
+    """Return the fewest insertions, deletions and substitutions turning pattern into
+    some substring of text, or None if that is more than max_edits"""
+    if pattern in text:
+        return 0
+    # column[i] is the fewest edits turning pattern[:i] into a substring ending here
+    column = list(range(len(pattern) + 1))
+    best = column[-1]
+    for char in text:
+        diagonal = column[0]
+        for index, pattern_char in enumerate(pattern, 1):
+            above = column[index]
+            column[index] = min(above + 1, column[index - 1] + 1,
+                                diagonal + (pattern_char != char))
+            diagonal = above
+        best = min(best, column[-1])
+    return best if best <= max_edits else None
+
+def scan_column(store, field_name, test, start, end):
+    """Return the positions from start to end of the records whose field, as a string, passes test
+    Dictionary encoded columns test each distinct value once rather than every record"""
+    column = store.columns.get(field_name)
+    missing = store.missing.get(field_name, set()).union(store.deleted)
+    if isinstance(column, DictColumn):
+        passed = set(code for code, value in enumerate(column.dictionary) if test(str(value)))
+        codes = column.codes
+        positions = [position for position in range(start, end) if codes[position] in passed]
+    elif column is not None:
+        positions = [position for position in range(start, end) if test(str(column[position]))]
+    else:
+        positions = [position for position, value in store.iter_field(field_name)
+                     if start <= position < end and test(str(value))]
+    if missing:
+        positions = [position for position in positions if position not in missing]
+    return positions
+
+def scan_chunk(task):
+    """Scan one chunk of records in a scanning process
+    The process was forked after the data was loaded, so only the condition and the
+    chunk's bounds are sent to it, and the matching positions come back as bytes"""
+    search_type_key, field_name, mode, needle, start, end = task
+    positions = scan_column(SEARCH_TYPES[search_type_key].values, field_name,
+                            scan_test(mode, needle), start, end)
+    return array("L", positions).tobytes()
+
+def scan_positions(validated_dict_list, field_name, mode, needle):
+    """Return the sorted positions of records whose field matches a scan condition
+    Large scans of a loaded search type are split into chunks shared between SCAN_JOBS
+    processes, and the chunks' results are joined back in order"""
+    record_count = len(validated_dict_list.values)
+    search_type_key = None
+    for key, search_type in (SEARCH_TYPES or {}).items():
+        if search_type is validated_dict_list:
+            search_type_key = key
+    if search_type_key is None or SCAN_JOBS <= 1 or record_count < SCAN_PARALLEL_MIN_RECORDS:
+        return scan_column(validated_dict_list.values, field_name, scan_test(mode, needle),
+                           0, record_count)
+    chunk_count = SCAN_JOBS * SCAN_CHUNKS_PER_JOB
+    chunk_size = -(-record_count // chunk_count)
+    tasks = [(search_type_key, field_name, mode, needle, start, min(start + chunk_size, record_count))
+             for start in range(0, record_count, chunk_size)]
+    positions = array("L")
+    for chunk in SCAN_POOL.map(scan_chunk, tasks):
+        positions.frombytes(chunk)
+    return positions.tolist()
+
+def contains_sequence(tokens, phrase):
+    """Return True if the list phrase appears in order within the list tokens"""
+    length = len(phrase)
+    return any(tokens[start:start + length] == phrase
+               for start in range(len(tokens) - length + 1))
+
+def range_value(validated_dict_list, field_name, text):
+    """Convert a value typed by the user to compare with an int or timestamp field
+    :raises FailedException: When the value isn't an int or timestamp"""
+    if validated_dict_list.fields.get(field_name) is int:
+        try:
+            return int(text)
+        except ValueError:
+            fail("{} is not a whole number".format(text))
+    epoch = parse_timestamp(text)
+    if epoch is None:
+        fail("{} is not a timestamp like 2016-04-28T11:19:34 -10:00 or 2016-04-28".format(text))
+    return epoch
+
+TIMESTAMP_PATTERN = re.compile(r"\s*(\d{4})-(\d{1,2})-(\d{1,2})"
+                               r"(?:[T ](\d{1,2}):(\d{2})(?::(\d{2}))?)?"
+                               r"\s*(?:(Z)|([+-])(\d{2}):?(\d{2}))?\s*$")
+
+def parse_timestamp(text):
+    """Return the seconds since the epoch of a timestamp such as "2016-04-28T11:19:34 -10:00"
+    The time defaults to midnight and the offset to UTC when they are left out
+    :return: The seconds as an int, or None if text isn't a timestamp"""
+    if type(text) is not str:
+        return None
+    match = TIMESTAMP_PATTERN.match(text)
+    if not match:
+        return None
+    year, month, day, hour, minute, second = (int(part or 0) for part in match.group(1, 2, 3, 4, 5, 6))
+    # timegm accepts out of range values, so check them first
+    if not (year >= 1 and 1 <= month <= 12 and 1 <= day <= calendar.monthrange(year, month)[1]
+            and hour < 24 and minute < 60 and second < 60):
+        return None
+    epoch = calendar.timegm((year, month, day, hour, minute, second, 0, 0, 0))
+    if match.group(8):
+        offset = int(match.group(9)) * 3600 + int(match.group(10)) * 60
+        epoch -= offset if match.group(8) == "+" else -offset
+    return epoch
+
+def split_values(text):
+    """Split a space separated list of values, allowing quotes around values with spaces
+    :raises FailedException: When the quotes don't match up"""
+    try:
+        return shlex.split(text)
+    except ValueError as ex:
+        fail("Unable to read values '{}': {}".format(text, str(ex)))
 
 def create_orgs_result(orgdict):
     """Create an OrganizationResult from a an organization diction entry"""
     org_id = orgdict.get(FIELD_ID)
-    users = field_from_values(find_all(USERS, FIELD_ORGANIZATION_ID, org_id),
-                              FIELD_NAME)
-    tickets = field_from_values(find_all(TICKETS, FIELD_ORGANIZATION_ID, org_id),
-                                FIELD_SUBJECT)
+    users = RELATIONS.org_user_names(org_id)
+    tickets = RELATIONS.org_ticket_subjects(org_id)
     return OrganizationResult(orgdict, users, tickets)
 
 def loadfile(file):
     """ Load a Json file and return the contents"""
+    return list(iterloadfile(file))
+
+def iterloadfile(file, chunk_size=LOAD_CHUNK_SIZE):
+    """ Load a Json file containing an array, yielding one entry at a time
+    The file is read in chunks of chunk_size characters"""
     err_message = None
     try:
         with open(file, "r") as loadedfile:
-            contents = json.load(loadedfile)
-            return contents
+            yield from iter_json_array(loadedfile, chunk_size)
 
     except (OSError, IOError, ) as ex:
         err_message = "Unable to open '{}': {}".format(file, str(ex))
@@ -245,32 +3222,332 @@ def loadfile(file):
     if err_message:
         fail(err_message)
 
-def output_results(results):
-    """ Output results, or a message indicating there aren't any"""
-    total_result_count = len(results)
-    if total_result_count == 1:
-        print("Search found 1 result")
+def iter_json_array(stream, chunk_size=LOAD_CHUNK_SIZE):
+    """Incrementally decode a json array from a text stream, yielding each entry
+    Only the entry being decoded and about a chunk either side of it are kept in memory
+    :raises json.decoder.JSONDecodeError: With the position of the error in the whole stream"""
+    decoder = json.JSONDecoder()
+    buf = ""
+    idx = 0
+    eof = False
+    # Position, line count and column of buf[0] within the stream, for error messages
+    base_pos = 0
+    base_line = 0
+    base_col = 0
+
+    def decode_error(msg, pos):
+        """Create a JSONDecodeError for a position in buf, relative to the whole stream"""
+        newlines = buf.count("\n", 0, pos)
+        if newlines:
+            lineno = base_line + newlines + 1
+            colno = pos - buf.rfind("\n", 0, pos)
+        else:
+            lineno = base_line + 1
+            colno = base_col + pos + 1
+        error = json.decoder.JSONDecodeError(msg, buf, pos)
+        error.pos = base_pos + pos
+        error.lineno = lineno
+        error.colno = colno
+        error.args = ("{}: line {} column {} (char {})".format(msg, lineno, colno, error.pos),)
+        return error
+
+    def read_more():
+        """Read another chunk, growing the read size with the pending data so
+        entries larger than a chunk are still decoded in linear time"""
+        nonlocal buf, eof
+        chunk = stream.read(max(chunk_size, len(buf) - idx))
+        if chunk:
+            buf += chunk
+        else:
+            eof = True
+
+    def skip_whitespace():
+        """Advance idx to the next non whitespace character, reading as needed
+        :return: The character, or an empty string at the end of the stream"""
+        nonlocal idx
+        while True:
+            while idx < len(buf) and buf[idx] in " \t\n\r":
+                idx += 1
+            if idx < len(buf) or eof:
+                return buf[idx:idx + 1]
+            read_more()
+
+    def discard_consumed():
+        """Drop the decoded part of the buffer once it is at least a chunk, tracking where
+        it ends in the stream. Dropping less at a time would copy the buffer for every entry"""
+        nonlocal buf, idx, base_pos, base_line, base_col
+        if idx < chunk_size:
+            return
+        newlines = buf.count("\n", 0, idx)
+        if newlines:
+            base_line += newlines
+            base_col = idx - buf.rfind("\n", 0, idx) - 1
+        else:
+            base_col += idx
+        base_pos += idx
+        buf = buf[idx:]
+        idx = 0
+
+    if skip_whitespace() != "[":
+        # Not an array, so there is nothing to stream. Decode the document as a
+        # whole for the usual error, but entries must be records in an array
+        while not eof:
+            read_more()
+        decoder.decode(buf)
+        raise decode_error("Expecting '['", idx)
+    idx += 1
+    if skip_whitespace() == "]":
+        idx += 1
     else:
-        print("Search found {} results".format(total_result_count))
-    truncated = False
+        while True:
+            discard_consumed()
+            skip_whitespace()
+            while True:
+                try:
+                    value, end = decoder.raw_decode(buf, idx)
+                except json.decoder.JSONDecodeError as ex:
+                    # Strings are only unterminated, and errors only near the end, when
+                    # the entry continues in the next chunk. Otherwise the entry is invalid
+                    truncated = (ex.msg.startswith("Unterminated string") or
+                                 len(buf) - ex.pos <= LOAD_ERROR_MARGIN)
+                    if eof or not truncated:
+                        raise decode_error(ex.msg, ex.pos) from None
+                    read_more()
+                    continue
+                if end == len(buf) and not eof:
+                    # A number could continue in the next chunk
+                    read_more()
+                    continue
+                break
+            idx = end
+            yield value
+            delimiter = skip_whitespace()
+            if delimiter == "]":
+                idx += 1
+                break
+            if delimiter != ",":
+                raise decode_error("Expecting ',' delimiter", idx)
+            idx += 1
+    if skip_whitespace():
+        raise decode_error("Extra data", idx)
+
+def output_results(results, start=0, match_count=None):
+    """ Output a page of results, or a message indicating there aren't any
+    :param results: A sequence of ResultValues, only the page shown is accessed
+    :param start: The index of the first result to show
+    :param match_count: The number of matching records when only the best of them are results"""
+    total_result_count = len(results)
+    if start == 0:
+        if total_result_count == 1:
+            print("Search found 1 result")
+        elif match_count is not None and match_count > total_result_count:
+            print("Search found {} results, showing the best {}".format(match_count,
+                                                                        total_result_count))
+        else:
+            print("Search found {} results".format(total_result_count))
+    page = results[start:start + MAX_RESULTS_SHOW]
+    # The page is written at once rather than printing each line of each result
+    rendered = []
+    for result in page:
+        render_start = STATS.start()
+        rendered.append(result.render() + "\n\n")
+        STATS.stop("render", render_start)
+    sys.stdout.write("".join(rendered))
+    STATS.count("results shown", len(page))
     if total_result_count > MAX_RESULTS_SHOW:
-        truncated = True
-        results = itertools.islice(results, MAX_RESULTS_SHOW)
-    for result in results:
-        result.present()
-        print()
-    if truncated:
-        print("Results were truncated to {} of {} entries".format(
-            MAX_RESULTS_SHOW, total_result_count))
-    if not results:
+        print("Showing results {} to {} of {} entries, use next and prev to see more".format(
+            start + 1, start + len(page), total_result_count))
+    if not total_result_count:
         print("No results found")
 
+class ResultWriter(object):
+    """Gathers text written to it into large writes to a stream, so results can be
+    written one field at a time without a system call for each"""
+    def __init__(self, stream, size=OUTPUT_BUFFER_SIZE):
+        self.stream = stream
+        self.size = size
+        self.parts = []
+        self.length = 0
+
+    def write(self, text):
+        """Add text, writing out everything gathered once there is enough of it"""
+        self.parts.append(text)
+        self.length += len(text)
+        if self.length >= self.size:
+            self.flush()
+        return len(text)
+
+    def flush(self):
+        """Write out everything gathered so far"""
+        if self.parts:
+            self.stream.write("".join(self.parts))
+            self.parts = []
+            self.length = 0
+
+def csv_value(value):
+    """Return a value as a csv cell, with lists as json so their elements can be told apart"""
+    if isinstance(value, list):
+        return json.dumps(value)
+    return value
+
+def write_results(results, output_format, stream):
+    """Write every result of a search, with no paging, in a machine readable format
+    Each result has its own fields followed by the JOINED_FIELDS of its type. The results
+    are read OUTPUT_CHUNK_SIZE at a time holding the DATA_LOCK, which isn't held while
+    writing them. If the data is reloaded in between, the output ends early with a warning.
+    Call without holding the DATA_LOCK.
+    :param results: A SearchResults
+    :param output_format: FORMAT_JSON, FORMAT_JSONL or FORMAT_CSV
+    :param stream: A text stream to write to
+    :return: The number of results written"""
+    columns = list(SEARCH_TYPES[results.search_type_key].fields)
+    columns.extend(JOINED_FIELDS[results.search_type_key])
+
+    def rows():
+        for chunk_start in range(0, len(results), OUTPUT_CHUNK_SIZE):
+            chunk = []
+            with DATA_LOCK.reading():
+                if results.generation != DATA_GENERATION:
+                    print("The data was reloaded while writing the results, so only {} of {} "
+                          "were written".format(chunk_start, len(results)), file=sys.stderr)
+                    return
+                for result in results[chunk_start:chunk_start + OUTPUT_CHUNK_SIZE]:
+                    render_start = STATS.start()
+                    chunk.append(result.as_dict())
+                    STATS.stop("render", render_start)
+            yield from chunk
+    count = write_rows(rows(), columns, output_format, stream)
+    STATS.count("results shown", count)
+    return count
+
+def write_rows(rows, columns, output_format, stream):
+    """Write dictionaries as a json array, json lines or csv through a ResultWriter
+    :param rows: An iterable of dictionaries
+    :param columns: The csv columns, other keys are left out of csv
+    :param output_format: FORMAT_JSON, FORMAT_JSONL or FORMAT_CSV
+    :param stream: A text stream to write to
+    :return: The number of rows written"""
+    writer = ResultWriter(stream)
+    if output_format == FORMAT_CSV:
+        csv_writer = csv.DictWriter(writer, columns, extrasaction="ignore")
+        csv_writer.writeheader()
+    elif output_format == FORMAT_JSON:
+        writer.write("[")
+    count = 0
+    for outp in rows:
+        if output_format == FORMAT_CSV:
+            csv_writer.writerow({key: csv_value(value) for key, value in outp.items()})
+        elif output_format == FORMAT_JSONL:
+            writer.write(json.dumps(outp))
+            writer.write("\n")
+        else:
+            writer.write(",\n" if count else "\n")
+            writer.write(json.dumps(outp))
+        count += 1
+    if output_format == FORMAT_JSON:
+        writer.write("\n]\n" if count else "]\n")
+    writer.flush()
+    return count
+
+def format_seconds(seconds):
+    """Format a duration in the most readable unit"""
+    if seconds < 0.001:
+        return "{:.1f}us".format(seconds * 1000000)
+    if seconds < 1:
+        return "{:.1f}ms".format(seconds * 1000)
+    return "{:.2f}s".format(seconds)
+
+def output_stats(dump):
+    """Output the stage timings and counters from Stats.dump as a table and histograms"""
+    if not dump["stages"] and not dump["counters"]:
+        print("Nothing recorded yet" if dump["enabled"] else "Stats are turned off")
+        return
+    print("{:12s} {:>8s} {:>10s} {:>10s} {:>10s}".format("stage", "count", "total", "mean", "max"))
+    for stage, stats in sorted(dump["stages"].items()):
+        print("{:12s} {:8d} {:>10s} {:>10s} {:>10s}".format(
+            stage, stats["count"], format_seconds(stats["seconds"]),
+            format_seconds(stats["seconds"] / stats["count"]), format_seconds(stats["max"])))
+    for stage, stats in sorted(dump["stages"].items()):
+        print()
+        print("{} latency:".format(stage))
+        most = max(stats["histogram"].values())
+        for label in STATS_BUCKET_LABELS:
+            count = stats["histogram"][label]
+            print("    {:>7s} {:8d} {}".format(label, count,
+                                             "#" * math.ceil(count * STATS_BAR_WIDTH / most)).rstrip())
+    if dump["counters"]:
+        print()
+        for counter, value in sorted(dump["counters"].items()):
+            print("{:20s} {:10d}".format(counter, value))
+
+def output_groups(field_names, counts, total, top):
+    """Output the largest groups found by group_counts as a table
+    :param total: The number of records grouped
+    :param top: The number of groups to show, or None for all of them"""
+    groups = counts.most_common(top)
+    print("{} record(s) in {} group(s)".format(total, len(counts)))
+    if not groups:
+        return
+    rows = [["count"] + field_names]
+    rows.extend([str(count)] + [str(value) for value in key] for key, count in groups)
+    widths = [max(len(row[column]) for row in rows) for column in range(len(rows[0]))]
+    for row in rows:
+        print("  " + "  ".join([row[0].rjust(widths[0])] +
+                               [value.ljust(width) for value, width in zip(row[1:], widths[1:])]).rstrip())
+    if len(groups) < len(counts):
+        print("Showing the largest {} of {} groups, use top <count> or top all to see more".format(
+            len(groups), len(counts)))
+
+def output_cache(dump):
+    """Output the contents and hit rate of the query cache from QueryCache.dump"""
+    print("searches cached {:10d} of {}".format(dump["entries"], dump["max_entries"]))
+    print("memory used     {:>10s} of {}".format(format_megabytes(dump["bytes"]),
+                                                format_megabytes(dump["max_bytes"])))
+    print("hits            {:10d} ({:.1%})".format(dump["hits"], dump["hit_rate"]))
+    print("misses          {:10d}".format(dump["misses"]))
+    print("evictions       {:10d}".format(dump["evictions"]))
+
+def format_megabytes(size):
+    """Format a number of bytes in megabytes"""
+    return "{:.1f}MB".format(size / (1024 * 1024))
+
 def cmd_search(commandline):
     """ Run a search and return results
     :param command: The command as a single string
-    :return: A list of ResultValues
+    :return: A list of ResultValues
+    :raises FailedException: When invalid input is entered"""
+    return list(run_search(commandline))
+
+def run_search(commandline):
+    """ Run a search and return results that are only created as they are accessed
+    :param command: The command as a single string
+    :return: A SearchResults
+    :raises FailedException: When invalid input is entered"""
+    start = STATS.start()
+    search_type_key, query = parse_query(commandline)
+    # Searches that parse to the same query share a cache entry
+    key = (search_type_key, str(query))
+    cached = QUERY_CACHE.get(key)
+    if cached is None:
+        positions = query.ranked_positions()
+        match_count = query.match_count(positions)
+        cached = QUERY_CACHE.put(key, search_type_key, positions, match_count)
+    if cached is not None:
+        positions = cached.positions
+        match_count = cached.match_count
+    results = SearchResults(search_type_key,
+                            RecordList(SEARCH_TYPES[search_type_key].values, positions), cached,
+                            match_count)
+    STATS.stop("search", start)
+    STATS.count("searches")
+    STATS.count("results found", len(results))
+    return results
+
+def parse_query(commandline):
+    """ Parse a search into its search type and Query
+    :param command: The command as a single string
+    :return: The search type key and the Query
     :raises FailedException: When invalid input is entered"""
-    results = []
     command = commandline.split(" ")
     if len(command) == 2:
         # Allow for empty matching by appending empty string
@@ -281,18 +3558,186 @@ def cmd_search(commandline):
     search_type_key = command[0]
     if search_type_key not in SEARCH_TYPES:
         fail("Invalid search type {}".format(search_type_key))
+    if any(word in COMPOUND_KEYWORDS for word in command[1:]):
+        tokens = QUERY_TOKEN_PATTERN.findall(" ".join(command[1:]))
+        try:
+            return search_type_key, QueryParser(search_type_key, tokens).parse()
+        except NotCompoundException:
+            pass
+    return search_type_key, parse_predicate(search_type_key, command[1:])
+
+def count_matches(commandline):
+    """ Count the records of a search type matching some conditions, or all of them
+    Text searches count every record they match, not just the best ones shown
+    :param commandline: <search type> [<conditions>]
+    :return: The search type key and the number of matching records
+    :raises FailedException: When invalid input is entered"""
+    search_type_key, _, conditions = commandline.strip().partition(" ")
+    if search_type_key not in SEARCH_TYPES:
+        fail("Invalid search type {}".format(search_type_key))
+    if not conditions.strip():
+        return search_type_key, SEARCH_TYPES[search_type_key].values.live_count()
+    return search_type_key, len(parse_query(commandline.strip())[1].positions())
+
+def parse_group(commandline):
+    """ Parse a group command
+    :param commandline: <search type> <field name> [<field name> ...] [top <count>|all]
+                        [where <conditions>]
+    :return: The search type key, the field names, the number of groups to show or None
+             for all of them, and the Query of the where conditions or None
+    :raises FailedException: When invalid input is entered"""
+    words = commandline.split(" ")
+    query_words = None
+    if "where" in words:
+        query_words = words[words.index("where") + 1:]
+        words = words[:words.index("where")]
+    words = [word for word in words if word]
+    top = GROUP_TOP
+    if len(words) > 2 and words[-2] == "top":
+        if words[-1] == "all":
+            top = None
+        elif words[-1].isdigit() and int(words[-1]) > 0:
+            top = int(words[-1])
+        else:
+            fail("top should be followed by a number of groups or all, not {}".format(words[-1]))
+        words = words[:-2]
+    if len(words) < 2:
+        fail("group command should be in the form: <search type> <field name> [<field name> ...] "
+             "[top <count>|all] [where <conditions>]")
+    search_type_key = words[0]
+    if search_type_key not in SEARCH_TYPES:
+        fail("Invalid search type {}".format(search_type_key))
+    field_names = words[1:]
+    for field_name in field_names:
+        group_field(search_type_key, field_name)
+    query = None
+    if query_words is not None:
+        if not " ".join(query_words).strip():
+            fail("where should be followed by the conditions records must match")
+        query = parse_query(" ".join([search_type_key] + query_words))[1]
+    return search_type_key, field_names, top, query
+
+def group_field(search_type_key, field_name):
+    """ Find where the values of a group field are kept
+    :param field_name: A field of the search type, or of a related record such as organization.name
+    :return: The foreign key to follow or None, and the search type and field holding the values
+    :raises FailedException: When there is no such field"""
+    relation, _, related_field = field_name.partition(".")
+    if related_field and relation in RELATED_FIELDS.get(search_type_key, {}):
+        foreign_key, related_key = RELATED_FIELDS[search_type_key][relation]
+        search_type_key, field_name = related_key, related_field
+    else:
+        foreign_key = None
     search_type = SEARCH_TYPES[search_type_key]
-    field_name = command[1]
-    match_value = " ".join(command[2:])
-    search_results = find_all(search_type, field_name, match_value)
-    for search_result in search_results:
-        if search_type_key == "users":
-            results.append(create_user_result(search_result))
-        elif search_type_key == "orgs":
-            results.append(create_orgs_result(search_result))
-        elif search_type_key == "tickets":
-            results.append(create_tickets_result(search_result))
-    return results
+    if field_name not in search_type.fields:
+        fail("{} is not a valid key for {}".format(field_name, search_type.name))
+    return foreign_key, search_type, field_name
+
+def group_values(search_type_key, field_name, positions):
+    """Return the value of a group field for the record at each position
+    Values of related records are looked up once for each distinct foreign key"""
+    foreign_key, search_type, field_name = group_field(search_type_key, field_name)
+    if foreign_key is None:
+        return search_type.values.field_values(field_name, positions)
+    keys = SEARCH_TYPES[search_type_key].values.field_values(foreign_key, positions)
+    ids = search_type.index(FIELD_ID)
+    related_values = {}
+    for key in set(keys):
+        related_positions = ids.get(str(key)) if key is not None else None
+        related_values[key] = (search_type.values.field_values(field_name, related_positions[:1])[0]
+                               if related_positions else None)
+    return [related_values[key] for key in keys]
+
+def group_counts(search_type_key, field_names, positions):
+    """Count the records at some positions holding each combination of values of some fields,
+    read from the columns without building records. Each element of a list field, such as
+    tags, counts as a value of its own
+    :return: A Counter of value tuples -> number of records, in the order they first appear"""
+    if len(field_names) == 1:
+        foreign_key, search_type, field_name = group_field(search_type_key, field_names[0])
+        column = search_type.values.columns.get(field_name)
+        if foreign_key is None and isinstance(column, ListColumn):
+            # Count the distinct element codes of each list, then look up each element once
+            offsets = column.offsets
+            codes = column.values
+            counts = collections.Counter(itertools.chain.from_iterable(
+                dict.fromkeys(codes[offsets[position]:offsets[position + 1]])
+                for position in positions))
+            return collections.Counter({(column.dictionary[code],): count
+                                        for code, count in counts.items()})
+    columns = [group_values(search_type_key, field_name, positions) for field_name in field_names]
+    if not any(type(value) is list for column in columns for value in column):
+        return collections.Counter(zip(*columns))
+    counts = collections.Counter()
+    for row in zip(*columns):
+        # Duplicates are dropped keeping their order, so equal counts are listed in the order
+        # the values first appear whichever way they were counted
+        counts.update(itertools.product(*(dict.fromkeys(value) if type(value) is list
+                                          else (value,) for value in row)))
+    return counts
+
+def is_field_name(search_type_key, field_name):
+    """Return True if a condition can be on field_name, including related and text fields"""
+    relation, _, related_field = field_name.partition(".")
+    if related_field and relation in RELATED_FIELDS.get(search_type_key, {}):
+        return is_field_name(RELATED_FIELDS[search_type_key][relation][1], related_field)
+    return field_name in SEARCH_TYPES[search_type_key].fields or field_name == MODE_TEXT
+
+def parse_predicate(search_type_key, words):
+    """ Parse a single condition on a search type
+    Quotes around a whole match value are removed, so it can hold spaces and keywords
+    :param words: The field name followed by the words of the match
+    :return: A Query
+    :raises FailedException: When invalid input is entered"""
+    search_type = SEARCH_TYPES[search_type_key]
+    field_name = words[0]
+    words = words[1:] or [""]
+    mode = words[0]
+    relation, _, related_field = field_name.partition(".")
+    if related_field and relation in RELATED_FIELDS.get(search_type_key, {}):
+        # A condition on a related record, such as a ticket's organization
+        foreign_key, related_key = RELATED_FIELDS[search_type_key][relation]
+        related_query = parse_predicate(related_key, [related_field] + words)
+        return RelatedPredicate(search_type, relation, foreign_key, SEARCH_TYPES[related_key],
+                                related_query)
+    if mode in MEMBERSHIP_MODES and search_type.fields.get(field_name) is list:
+        # Searching for the elements of a list rather than the whole list
+        return MemberPredicate(search_type, field_name, split_values(" ".join(words[1:])),
+                               mode == MODE_ALL)
+    if field_name == MODE_TEXT and field_name not in search_type.fields:
+        # Full text search across all the text fields
+        return TextPredicate(search_type, None, " ".join(words))
+    if mode == MODE_TEXT and field_name in search_type.text_fields():
+        return TextPredicate(search_type, field_name, " ".join(words[1:]))
+    if mode in RANGE_MODES and field_name in search_type.range_fields():
+        if mode == "between":
+            match_values = split_values(" ".join(words[1:]))
+        else:
+            match_values = [" ".join(words[1:])]
+        return RangePredicate(search_type, field_name, mode, match_values)
+    if mode in SCAN_MODES and field_name in search_type.fields:
+        needle = " ".join(words[1:])
+        if len(needle) >= 2 and needle[0] == needle[-1] == '"':
+            needle = needle[1:-1]
+        return ScanPredicate(search_type, field_name, mode, needle)
+    match_value = " ".join(words)
+    if len(match_value) >= 2 and match_value[0] == match_value[-1] == '"':
+        match_value = match_value[1:-1]
+    return ExactPredicate(search_type, field_name, match_value)
+
+def create_result(search_type_key, record):
+    """Create the ResultValue for a record of a search type, gathering its related info"""
+    start = STATS.start()
+    if search_type_key == "users":
+        result = create_user_result(record)
+    elif search_type_key == "orgs":
+        result = create_orgs_result(record)
+    elif search_type_key == "tickets":
+        result = create_tickets_result(record)
+    else:
+        result = None
+    STATS.stop("join", start)
+    return result
 
 def create_tickets_result(ticketdict):
     """create_tickets_result - Create a tickets result gathering extra info
@@ -301,8 +3746,8 @@ def create_tickets_result(ticketdict):
     assignee_id = ticketdict.get(FIELD_ASSIGNEE_ID)
     submitter_id = ticketdict.get(FIELD_SUBMITTER_ID)
     org_name = org_name_get(org_id)
-    assignee = find_one_field(USERS, FIELD_ID, assignee_id, FIELD_NAME)
-    submitter = find_one_field(USERS, FIELD_ID, submitter_id, FIELD_NAME)
+    assignee = RELATIONS.user_name(assignee_id)
+    submitter = RELATIONS.user_name(submitter_id)
     result_value = TicketResult(ticketdict, org_name, submitter, assignee)
     return result_value
 
@@ -314,30 +3759,66 @@ def create_user_result(userdict):
     orgname = org_name_get(org_id)
 
     user_id = userdict.get(FIELD_ID)
-    submitted = field_from_values(find_all(TICKETS, FIELD_SUBMITTER_ID, user_id),
-                                  FIELD_SUBJECT)
-    assigned = field_from_values(find_all(TICKETS, FIELD_ASSIGNEE_ID, user_id),
-                                 FIELD_SUBJECT)
+    submitted = RELATIONS.submitted_ticket_subjects(user_id)
+    assigned = RELATIONS.assigned_ticket_subjects(user_id)
     return UserResult(userdict, orgname, assigned, submitted)
 
 def org_name_get(org_id):
     """Shortcut for getting an organization name"""
-    return find_one_field(ORGS, FIELD_ID, org_id, FIELD_NAME)
+    return RELATIONS.org_name(org_id)
 
 class SearchCommands(cmd.Cmd):
     """Command definitions using python's cmd module"""
+    # Results of the last search and the index of the first one shown, for paging
+    results = None
+    page_start = 0
+    # Format chosen with the format command, or None to use OUTPUT_FORMAT
+    output_format = None
+
     def do_search(self, line):
         """Perform a search for:
     search users <field name> <value>
     search orgs <field name> <value>
-    search tickets <field name> <value>"""
+    search tickets <field name> <value>
+List fields such as tags can be searched for records containing any or all of some values:
+    search tickets tags any|all <value> ["<value with spaces>" ...]
+Text fields can be searched for words or "quoted phrases", with the best matches first:
+    search tickets text <words>
+    search tickets subject text <words>
+Int and timestamp fields can be compared, timestamps with or without a time and offset:
+    search users _id between 10 50
+    search tickets due_at > "2016-07-31T02:37:50 -10:00"
+    search tickets created_at <= 2016-05-01
+Conditions can be combined with AND, OR, NOT and ( ), separated by spaces, and can be on
+the organization, submitter or assignee of a record. Quote values containing these words:
+    search tickets status open AND ( priority high OR priority urgent )
+    search tickets organization.name Enthaze AND NOT submitter.role admin
+Any field can be searched for a substring, ignoring case, a regular expression, or a
+substring with a few typos, closest first. Names, emails and subjects are indexed for
+substrings and typos, other fields are searched by checking every record:
+    search users email contains @flotonic
+    search tickets url matches /tickets/[0-9a-f]{8}-
+    search users name fuzzy francsica rasmusen
+Every result is written at once instead of in pages after choosing json, jsonl or csv
+with the format command."""
+        output_format = self.output_format or OUTPUT_FORMAT
         try:
-            results = cmd_search(line)
-            output_results(results)
+            with DATA_LOCK.reading():
+                results = run_search(line)
+                if output_format == FORMAT_TEXT:
+                    self.results = results
+                    self.page_start = 0
+                    output_results(results, match_count=results.match_count)
+            if output_format != FORMAT_TEXT:
+                # Everything is written, so there are no pages left to show. The lock is taken
+                # for each chunk of results, so writing to a slow reader doesn't hold up reloads
+                self.results = None
+                write_results(results, output_format, sys.stdout)
         except FailedException:
             #Failed exception means it's already handled
             pass
 
+    @STATS.timed("completion")
     def complete_search(self, text, line, begidx, endidx):
         """Perform tab completion help for search command
         """
@@ -373,16 +3854,205 @@ class SearchCommands(cmd.Cmd):
             if typename not in SEARCH_TYPES:
                 return ""
             if field_name in SEARCH_TYPES[typename].fields.keys():
-                # Show all values of the field that start with the current string
-                # Setup a chain to select only the parts of the fields that match the
-                # requsted tab completion
-                field_values = (str(value[field_name]) for value in SEARCH_TYPES[typename].values)
-                matching_entries = filter(lambda x: x.startswith(field_starts_with),
-                                          field_values)
-                truncated_matching_entry_list = [x[cut_first_chars:] for x in matching_entries]   
+                # Show all distinct values of the field that start with the current string
+                # cut down to the parts that match the requested tab completion
+                with DATA_LOCK.reading():
+                    matching_entries = SEARCH_TYPES[typename].complete(field_name,
+                                                                       field_starts_with)
+                truncated_matching_entry_list = [x[cut_first_chars:] for x in matching_entries]
                 return truncated_matching_entry_list
         return ""
 
+    def do_explain(self, line):
+        """Show how a search would be evaluated, without running it:
+    explain <search type> <conditions>"""
+        try:
+            with DATA_LOCK.reading():
+                search_type_key, query = parse_query(line)
+                print("Plan for searching {} {} records:".format(
+                    SEARCH_TYPES[search_type_key].values.live_count(), search_type_key))
+                for explanation in query.explain("  "):
+                    print(explanation)
+        except FailedException:
+            #Failed exception means it's already handled
+            pass
+
+    def complete_explain(self, text, line, begidx, endidx):
+        """Perform tab completion help for explain command, the same as for search"""
+        return self.complete_search(text, line, begidx, endidx)
+
+    def do_format(self, line):
+        """Choose how searches are written, or show the current format:
+    format text   (pages of results to read, with next and prev)
+    format json   (every result in one json array)
+    format jsonl  (every result as a json line)
+    format csv    (every result as a csv row, with list fields as json)
+Results in json, jsonl and csv include the names and subjects of related records."""
+        output_format = line.strip()
+        if not output_format:
+            print(self.output_format or OUTPUT_FORMAT)
+        elif output_format in OUTPUT_FORMATS:
+            self.output_format = output_format
+        else:
+            print("Unknown format {}, expected one of {}".format(output_format,
+                                                                ", ".join(OUTPUT_FORMATS)))
+
+    def complete_format(self, text, line, begidx, endidx):
+        """Complete the name of a format"""
+        return [output_format for output_format in OUTPUT_FORMATS
+                if output_format.startswith(text)]
+
+    def do_count(self, line):
+        """Count the records matching some conditions, or all of them:
+    count <search type> [<conditions>]
+The conditions are the same as for search:
+    count tickets status open AND organization.name Enthaze"""
+        try:
+            with DATA_LOCK.reading():
+                start = STATS.start()
+                search_type_key, count = count_matches(line)
+                STATS.stop("count", start)
+            print("{} {} record(s)".format(count, search_type_key))
+        except FailedException:
+            #Failed exception means it's already handled
+            pass
+
+    def complete_count(self, text, line, begidx, endidx):
+        """Perform tab completion help for count command, the same as for search"""
+        return self.complete_search(text, line, begidx, endidx)
+
+    def do_group(self, line):
+        """Count the records with each value of some fields, largest groups first:
+    group <search type> <field name> [<field name> ...] [top <count>|all] [where <conditions>]
+Fields can be on the organization, submitter or assignee of a record, and each element of a
+list field such as tags is counted. Only records matching the conditions, the same as for
+search, are counted:
+    group users role locale
+    group tickets organization.name top 5 where status open
+    group tickets tags top all"""
+        output_format = self.output_format or OUTPUT_FORMAT
+        try:
+            with DATA_LOCK.reading():
+                start = STATS.start()
+                search_type_key, field_names, top, query = parse_group(line)
+                if query is None:
+                    # Each field's column is read in turn, so the positions are needed more than once
+                    positions = SEARCH_TYPES[search_type_key].values.live_positions()
+                    if not isinstance(positions, range):
+                        positions = list(positions)
+                else:
+                    positions = query.positions()
+                counts = group_counts(search_type_key, field_names, positions)
+                STATS.stop("group", start)
+        except FailedException:
+            #Failed exception means it's already handled
+            return
+        if output_format == FORMAT_TEXT:
+            output_groups(field_names, counts, len(positions), top)
+        else:
+            rows = (dict(zip(field_names, key), count=count) for key, count in counts.most_common(top))
+            write_rows(rows, field_names + ["count"], output_format, sys.stdout)
+
+    def complete_group(self, text, line, begidx, endidx):
+        """Complete the search type, then the fields of a group command, including the fields of
+        related records. After where, complete as for search"""
+        words = line[:begidx].split()
+        if "where" in words:
+            where = line.index(" where ") + len(" where ")
+            search_line = "search {} {}".format(words[1], line[where:])
+            offset = len(search_line) - len(line)
+            return self.complete_search(text, search_line, begidx + offset, endidx + offset)
+        if len(words) < 2:
+            return [search_type_key for search_type_key in SEARCH_TYPES if search_type_key.startswith(text)]
+        if words[1] not in SEARCH_TYPES:
+            return []
+        field_names = list(SEARCH_TYPES[words[1]].fields)
+        for relation, (_, related_key) in RELATED_FIELDS.get(words[1], {}).items():
+            field_names.extend("{}.{}".format(relation, field_name)
+                               for field_name in SEARCH_TYPES[related_key].fields)
+        return [field_name for field_name in field_names + ["top", "where"]
+                if field_name.startswith(text)]
+
+    def do_next(self, _):
+        """Show the next page of results from the last search"""
+        self.show_page(self.page_start + MAX_RESULTS_SHOW)
+
+    def do_prev(self, _):
+        """Show the previous page of results from the last search"""
+        self.show_page(self.page_start - MAX_RESULTS_SHOW)
+
+    def show_page(self, start):
+        """Show the page of the last search's results starting at start"""
+        if self.results is None:
+            print("No search to page through")
+        elif start < 0 or start >= len(self.results):
+            print("No more results")
+        else:
+            self.page_start = start
+            with DATA_LOCK.reading():
+                output_results(self.results, start)
+
+    def do_stats(self, line):
+        """Show how long each stage of loading and running commands took, and counters:
+    stats          (a table and latency histogram of each stage, and the counters)
+    stats json     (the same as json)
+    stats reset    (start recording again)
+    stats on|off   (turn recording on or off)"""
+        option = line.strip()
+        if option == "json":
+            print(json.dumps(STATS.dump()))
+        elif option == "reset":
+            STATS.reset()
+        elif option in ("on", "off"):
+            STATS.enabled = option == "on"
+        elif option:
+            print("Unknown stats option {}".format(option))
+        else:
+            output_stats(STATS.dump())
+
+    def do_cache(self, line):
+        """Show how often searches are answered from the query cache, or clear it:
+    cache          (searches and memory cached, hits and misses)
+    cache json     (the same as json)
+    cache clear    (drop every cached search)"""
+        option = line.strip()
+        if option == "json":
+            print(json.dumps(QUERY_CACHE.dump()))
+        elif option == "clear":
+            QUERY_CACHE.clear()
+        elif option:
+            print("Unknown cache option {}".format(option))
+        else:
+            output_cache(QUERY_CACHE.dump())
+
+    def do_profile(self, line):
+        """Run a command under cProfile and show the functions it spent the most time in:
+    profile search tickets status open"""
+        if not line.strip():
+            print("Give a command to profile, e.g. profile search tickets status open")
+            return
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError as ex:
+            # Only one profiler can run at a time
+            print("Unable to profile: {}".format(ex))
+            return
+        try:
+            self.onecmd(line)
+        finally:
+            profiler.disable()
+        print()
+        pstats.Stats(profiler, stream=sys.stdout).sort_stats("tottime").print_stats(PROFILE_TOP)
+
+    def do_reload(self, _):
+        """Apply changes made to the json files since they were loaded"""
+        try:
+            print("\n".join(reload_files()) or "No files have changed")
+        except FailedException:
+            #Failed exception means it's already handled
+            pass
+
     def do_EOF(self, line):
         """Exit"""
         self.do_exit(line)
@@ -392,8 +4062,258 @@ class SearchCommands(cmd.Cmd):
         raise ExitException()
 
 
-def do_interactive():
-    """Start interactive mode with a command input loop"""
+class ThreadOutput(object):
+    """Stand in for sys.stdout that sends what a thread prints to that thread's own buffer
+    while it is capturing, so commands running in several threads at once can print"""
+    def __init__(self, stream):
+        self.stream = stream
+        self.local = threading.local()
+
+    def write(self, text):
+        """Write to this thread's buffer, or to the original stream when not capturing"""
+        buffer = getattr(self.local, "buffer", None)
+        return (self.stream if buffer is None else buffer).write(text)
+
+    def flush(self):
+        """Flush the original stream when not capturing"""
+        if getattr(self.local, "buffer", None) is None:
+            self.stream.flush()
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+    @contextlib.contextmanager
+    def capture(self):
+        """Capture what this thread prints, yielding the buffer it is written to"""
+        self.local.buffer = io.StringIO()
+        try:
+            yield self.local.buffer
+        finally:
+            self.local.buffer = None
+
+
+class SearchServer(object):
+    """Serve searches on the data loaded in this process to many clients at once
+    Clients send one json object per line and get one json line back for each, in order:
+        {"command": "search users _id 1"} -> {"output": "<what the command printed>"}
+        {"complete": "search users na", "text": "na", "begidx": 13, "endidx": 15}
+            -> {"completions": ["name"]}
+    An "id" in a request is copied to its response, and bad requests get an "error".
+    Each connection has its own SearchCommands, so next and prev page through that
+    client's last search. Commands run in a pool of threads rather than in the event
+    loop, so a slow search doesn't stop other clients' requests being read."""
+    def __init__(self, host=SERVER_HOST, port=0, threads=SERVER_THREADS):
+        self.host = host
+        self.port = port
+        self.threads = threads
+        self.loop = None
+        self.output = None
+        self.writers = set()
+
+    def run(self, ready=None):
+        """Serve until stop is called
+        :param ready: Called with the (host, port) being served once clients can connect"""
+        installed = not isinstance(sys.stdout, ThreadOutput)
+        if installed:
+            sys.stdout = ThreadOutput(sys.stdout)
+        self.output = sys.stdout
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        executor = concurrent.futures.ThreadPoolExecutor(self.threads)
+        loop.set_default_executor(executor)
+        try:
+            server = loop.run_until_complete(
+                asyncio.start_server(self.handle_client, self.host, self.port,
+                                     limit=SERVER_REQUEST_LIMIT))
+            self.loop = loop
+            if ready is not None:
+                ready(server.sockets[0].getsockname()[:2])
+            try:
+                loop.run_forever()
+            finally:
+                server.close()
+                # Hang up on clients still connected, letting their current commands finish
+                for writer in self.writers:
+                    writer.close()
+                tasks = asyncio.all_tasks(loop)
+                loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
+        finally:
+            self.loop = None
+            executor.shutdown()
+            loop.close()
+            asyncio.set_event_loop(None)
+            if installed:
+                sys.stdout = self.output.stream
+
+    def stop(self):
+        """Stop serving, from any thread"""
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self.loop.stop)
+
+    async def handle_client(self, reader, writer):
+        """Answer the requests from one client connection until it closes"""
+        commands = SearchCommands()
+        loop = asyncio.get_event_loop()
+        self.writers.add(writer)
+        try:
+            while True:
+                line = await self.read_request(reader)
+                if line is None:
+                    response = json.dumps({"error": "Requests must be shorter than {} bytes".format(
+                        SERVER_REQUEST_LIMIT)})
+                elif not line:
+                    break
+                else:
+                    response = await loop.run_in_executor(None, self.respond, commands, line)
+                writer.write(response.encode() + b"\n")
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            self.writers.discard(writer)
+            writer.close()
+
+    @staticmethod
+    async def read_request(reader):
+        """Read the next request line from a client
+        :return: The line, empty once the client closes the connection, or None when the line
+                 is longer than SERVER_REQUEST_LIMIT, in which case it is skipped"""
+        try:
+            return await reader.readuntil(b"\n")
+        except asyncio.IncompleteReadError as ex:
+            return ex.partial
+        except asyncio.LimitOverrunError as ex:
+            consumed = ex.consumed
+        while True:
+            # Drop what has been read of the line so far, until its end
+            await reader.readexactly(consumed)
+            try:
+                await reader.readuntil(b"\n")
+                return None
+            except asyncio.IncompleteReadError:
+                return None
+            except asyncio.LimitOverrunError as ex:
+                consumed = ex.consumed
+
+    def respond(self, commands, line):
+        """Answer one json line request from a client, with an error for anything unexpected
+        so the client always gets a response
+        :param commands: The SearchCommands of the client's connection
+        :return: The json line response"""
+        try:
+            return self.answer(commands, line)
+        except Exception as ex:
+            return json.dumps({"error": "Unable to answer the request: {!r}".format(ex)})
+
+    def answer(self, commands, line):
+        """Answer one json line request from a client
+        :return: The json line response"""
+        try:
+            request = json.loads(line)
+        except ValueError:
+            request = None
+        if not isinstance(request, dict):
+            return json.dumps({"error": "Requests must be json objects"})
+        response = {}
+        if "id" in request:
+            response["id"] = request["id"]
+        if isinstance(request.get("command"), str):
+            with self.output.capture() as output:
+                try:
+                    commands.onecmd(request["command"])
+                except ExitException:
+                    # Exiting is up to the client
+                    pass
+            response["output"] = output.getvalue()
+        elif isinstance(request.get("complete"), str):
+            line = request["complete"]
+            text = request.get("text", "")
+            begidx = request.get("begidx", len(line) - len(text))
+            endidx = request.get("endidx", len(line))
+            if not isinstance(text, str) or not isinstance(begidx, int) or not isinstance(endidx, int):
+                response["error"] = "Invalid completion request"
+            else:
+                command = commands.parseline(line)[0]
+                completer = getattr(commands, "complete_" + command, None) if command else None
+                response["completions"] = list(completer(text, line, begidx, endidx)
+                                               if completer else [])
+        else:
+            response["error"] = "Requests need a command or a line to complete"
+        return json.dumps(response)
+
+
+class SearchClient(object):
+    """Connection to a SearchServer, sending one request at a time"""
+    def __init__(self, host, port):
+        try:
+            self.connection = socket.create_connection((host, port))
+        except OSError as ex:
+            fail("Could not connect to {}:{}: {}".format(host, port, ex.strerror or ex))
+        self.stream = self.connection.makefile("rwb")
+
+    def request(self, request):
+        """Send a request and wait for the response
+        :param request: A dictionary of the request fields described in SearchServer
+        :raises FailedException: When the connection is lost or the request is refused"""
+        try:
+            self.stream.write(json.dumps(request).encode() + b"\n")
+            self.stream.flush()
+            line = self.stream.readline()
+        except OSError as ex:
+            fail("Lost connection to the server: {}".format(ex.strerror or ex))
+        if not line:
+            fail("The server closed the connection")
+        response = json.loads(line)
+        if "error" in response:
+            fail(response["error"])
+        return response
+
+    def close(self):
+        """Close the connection"""
+        self.stream.close()
+        self.connection.close()
+
+
+class RemoteSearchCommands(SearchCommands):
+    """The interactive commands, run on a SearchServer rather than on data loaded here
+    Help, exit and repeating the last command on an empty line are handled locally."""
+    def __init__(self, client):
+        super().__init__()
+        self.client = client
+
+    def onecmd(self, line):
+        """Run a command on the server and print its output"""
+        command = self.parseline(line)[0]
+        if not line.strip() or command in ("help", "EOF", "exit"):
+            return super().onecmd(line)
+        self.lastcmd = line
+        try:
+            print(self.client.request({"command": line})["output"], end="")
+        except FailedException:
+            #Failed exception means it's already handled
+            pass
+        return False
+
+    def complete_search(self, text, line, begidx, endidx):
+        """Ask the server to complete a search"""
+        try:
+            return self.client.request({"complete": line, "text": text,
+                                        "begidx": begidx, "endidx": endidx})["completions"]
+        except FailedException:
+            return []
+
+    def complete_explain(self, text, line, begidx, endidx):
+        """Ask the server to complete an explain"""
+        return self.complete_search(text, line, begidx, endidx)
+
+    def complete_group(self, text, line, begidx, endidx):
+        """Ask the server to complete a group"""
+        return self.complete_search(text, line, begidx, endidx)
+
+
+def do_interactive(commands=None):
+    """Start interactive mode with a command input loop
+    :param commands: The SearchCommands to run, by default searching the data loaded here"""
     intro = """Welcome to Tom's searcher
 
 The following commands are available:
@@ -401,83 +4321,265 @@ The following commands are available:
     search users <field name> <exact match>
     search orgs <field name> <exact match>
     search tickets <field name> <exact match>
+    search <type> <list field> any|all <value> ["<value with spaces>" ...]
+    search <type> [<text field>] text <words> ["<phrase>" ...]
+    search <type> <int or timestamp field> >|>=|<|<= <value>
+    search <type> <int or timestamp field> between <low> <high>
+    search <type> <field name> contains|matches <substring or regular expression>
+    search <type> <field name> fuzzy <substring with typos>
+    search <type> <condition> AND|OR [NOT] <condition> ... (with ( ) to group)
+    explain <type> <conditions> (show how a search is evaluated)
+    count <type> [<conditions>] (count the matching records)
+    group <type> <field name> ... [top <count>|all] [where <conditions>] (count each value)
+    next / prev (page through the results of the last search)
+    format [text|json|jsonl|csv] (write every result for other programs to read)
+    reload (apply changes made to the json files)
+    stats [json|reset|on|off] (timings of each stage and counters)
+    cache [json|clear] (hits and misses of the query cache)
+    profile <command> (run a command under cProfile)
     help [<command>]
     exit
 
 Use TAB to complete any field.
 """
     try:
-        SearchCommands().cmdloop(intro=intro)
+        (commands or SearchCommands()).cmdloop(intro=intro)
     except ExitException:
         pass
     return
 
-def do_init():
+def do_init(use_snapshots=False):
     """Load files into global variables
+    :param use_snapshots: Load from and save snapshots of the validated files
     :raises FailedException: When there is an issue loading a file"""
     global ORGS
     global TICKETS
     global USERS
     global SEARCH_TYPES
-    ORGS = ValidatedDictList("organizations.json",
-        "tickets", {
-            "_id": int,
-            "url": str,
-            "external_id": str,
-            "name": str,
-            "domain_names": list,
-            "created_at": str,
-            "details": str,
-            "shared_tickets": bool,
-            "tags": list,
-        })
-    TICKETS = ValidatedDictList("tickets.json",
-        "tickets", {
-            "_id": str,
-            "url": str,
-            "external_id": str,
-            "created_at": str,
-            "type": str,
-            "subject": str,
-            "description": str,
-            "priority": str,
-            "status": str,
-            "submitter_id": int,
-            "assignee_id": int,
-            "organization_id": int,
-            "tags": list,
-            "has_incidents": bool,
-            "due_at": str,
-            "via": str
-        })
-    USERS = ValidatedDictList("users.json",
-        "users", {
-            "_id": int,
-            "url": str,
-            "external_id": str,
-            "name": str,
-            "alias": str,
-            "created_at":str,
-            "active": bool,
-            "verified": bool,
-            "shared": bool,
-            "locale": str,
-            "timezone": str,
-            "last_login_at": str,
-            "email": str,
-            "phone": str,
-            "signature": str,
-            "organization_id": int,
-            "tags": list,
-            "suspended": bool,
-            "role": str
-        })
+    global RELATIONS
+    global DATA_GENERATION
+    dict_list = SqliteDictList if STORAGE == STORAGE_SQLITE else ValidatedDictList
+    ORGS = dict_list("organizations.json", "tickets", ORGS_SCHEMA, use_snapshots)
+    TICKETS = dict_list("tickets.json", "tickets", TICKETS_SCHEMA, use_snapshots)
+    USERS = dict_list("users.json", "users", USERS_SCHEMA, use_snapshots)
 
     SEARCH_TYPES = {
         "users": USERS,
         "orgs": ORGS,
         "tickets": TICKETS,
 }
+    RELATIONS = Relationships(ORGS, USERS, TICKETS)
+    DATA_GENERATION += 1
+    # Save after building relationships so the snapshots include their indexes
+    for validated_dict_list in (ORGS, USERS, TICKETS):
+        if not validated_dict_list.from_snapshot:
+            validated_dict_list.save_snapshot()
+
+def reload_files():
+    """Apply the changes made to the json files since they were loaded, by _id
+    Changes are worked out while searches carry on, then applied at once while none are
+    running. Once more records have been deleted than are left, the rest are stored again.
+    :return: A message for each file that changed
+    :raises FailedException: When a changed file can't be read or is invalid, leaving the
+                             data as it was"""
+    global RELATIONS
+    global DATA_GENERATION
+    messages = []
+    with RELOAD_LOCK:
+        for validated_dict_list in (ORGS, USERS, TICKETS):
+            stat = validated_dict_list.changed_stat()
+            if stat is None:
+                continue
+            filename = validated_dict_list.filename
+            key = None
+            if validated_dict_list.use_snapshot:
+                key = snapshot_key(filename, validated_dict_list.fields)
+            start = STATS.start()
+            with DATA_LOCK.reading():
+                changes = validated_dict_list.changes(iterloadfile(filename))
+            with DATA_LOCK.writing():
+                validated_dict_list.apply_changes(*changes)
+                store = validated_dict_list.values
+                if len(store.deleted) > store.live_count():
+                    validated_dict_list.compact()
+                    RELATIONS = Relationships(ORGS, USERS, TICKETS)
+                DATA_GENERATION += 1
+                # Searches add indexes while the snapshot is written, so save what is there now.
+                # The records themselves only change in a reload, which RELOAD_LOCK holds off.
+                data = validated_dict_list.snapshot_data()
+            validated_dict_list.source_stat = stat
+            if key is not None and snapshot_source_matches(filename, key):
+                validated_dict_list.snapshot_key = key
+                validated_dict_list.save_snapshot(data)
+            else:
+                validated_dict_list.snapshot_key = None
+            STATS.stop("reload", start)
+            messages.append("{}: {} added, {} changed, {} removed".format(
+                filename, len(changes[0]), len(changes[1]), len(changes[2])))
+    return messages
+
+def watch_files(interval):
+    """Reload the json files in a background thread, checking for changes every interval seconds
+    :return: An Event to set to stop watching"""
+    stop = threading.Event()
+    def watch():
+        while not stop.wait(interval):
+            try:
+                for message in reload_files():
+                    print(message, file=sys.stderr)
+            except FailedException:
+                # Error message is already printed, and the loaded data is unchanged
+                pass
+            except Exception as ex:
+                # Keep watching, as the next change to the files may well load
+                print("Unable to reload the files: {!r}".format(ex), file=sys.stderr)
+    threading.Thread(target=watch, daemon=True).start()
+    return stop
+
+def batch_query(line):
+    """Run one search line for batch mode
+    :return: The json line describing the query and its results"""
+    query = line.strip()
+    if query.startswith("search "):
+        query = query[len("search "):]
+    outp = {"query": line.strip()}
+    messages = io.StringIO()
+    try:
+        # Failures print their message, which is reported in the json instead
+        with contextlib.redirect_stdout(messages):
+            results = run_search(query)
+            outp["count"] = len(results)
+            if results.match_count > len(results):
+                # Only the best matches are results
+                outp["matches"] = results.match_count
+            outp["results"] = [result.as_dict() for result in results]
+    except FailedException:
+        outp["error"] = messages.getvalue().strip()
+    return json.dumps(outp)
+
+def set_scan_jobs(jobs):
+    """Set the number of processes used to scan records for unindexed conditions"""
+    global SCAN_JOBS
+    SCAN_JOBS = jobs
+
+def open_batch_file(filename):
+    """Open a file of batch queries
+    :raises FailedException: When the file can't be opened"""
+    try:
+        return open(filename)
+    except OSError as ex:
+        fail("Unable to open '{}': {}".format(filename, str(ex)))
+
+def do_batch(lines, output, jobs=1):
+    """Run many search lines against the loaded data, writing a json line for each in order
+    With more than one job the queries are shared out to a pool of forked processes,
+    which use the data already loaded in this process rather than loading their own.
+    :param lines: An iterable of lines in the form [search] <search type> <field name> <match>
+                  Blank lines and lines starting with # are skipped
+    :param output: A text stream to write the json lines to
+    :param jobs: The number of processes to run queries in
+    :return: The number of queries run"""
+    queries = (line.rstrip("\n") for line in lines
+               if line.strip() and not line.lstrip().startswith("#"))
+    if jobs > 1 and "fork" not in multiprocessing.get_all_start_methods():
+        print("Running batch queries in one process as processes can't be forked here",
+              file=sys.stderr)
+        jobs = 1
+    start = time.perf_counter()
+    count = 0
+    if jobs > 1:
+        # The batch processes already run in parallel, so each scans on its own
+        with multiprocessing.get_context("fork").Pool(jobs, set_scan_jobs, (1,)) as pool:
+            for outp in pool.imap(batch_query, queries, chunksize=16):
+                output.write(outp + "\n")
+                count += 1
+    else:
+        for outp in map(batch_query, queries):
+            output.write(outp + "\n")
+            count += 1
+    output.flush()
+    elapsed = time.perf_counter() - start
+    print("Ran {} queries in {:.3f}s ({:.1f} queries/s) with {} job(s)".format(
+        count, elapsed, count / elapsed if elapsed else 0.0, jobs), file=sys.stderr)
+    return count
+
+def do_serve(host, port, threads=SERVER_THREADS):
+    """Serve searches on the loaded data until interrupted"""
+    server = SearchServer(host, port, threads)
+    try:
+        server.run(lambda address: print("Serving searches on {}:{}".format(*address),
+                                         file=sys.stderr))
+    except KeyboardInterrupt:
+        pass
+
+def parse_address(text):
+    """Parse a [HOST:]PORT command line option, on this machine when no host is given"""
+    host, _, port = text.rpartition(":")
+    try:
+        port = int(port)
+    except ValueError:
+        raise argparse.ArgumentTypeError("invalid address {!r}, expected [HOST:]PORT".format(text))
+    return host or SERVER_HOST, port
+
+def positive_int(text):
+    """Parse a command line option counting processes or threads, which must be at least one"""
+    try:
+        value = int(text)
+    except ValueError:
+        value = 0
+    if value < 1:
+        raise argparse.ArgumentTypeError("invalid count {!r}, expected a whole number of at "
+                                         "least 1".format(text))
+    return value
+
+def parse_args(argv=None):
+    """Parse the command line"""
+    parser = argparse.ArgumentParser(description="Tom's Searching Thingy")
+    parser.add_argument("command", nargs="*",
+                        help="run this command, e.g. search tickets status open, and exit "
+                             "instead of starting interactive mode")
+    parser.add_argument("--format", choices=OUTPUT_FORMATS,
+                        help="write searches as pages of text to read (the default), or every "
+                             "result as json, json lines or csv for other programs")
+    parser.add_argument("--batch", metavar="FILE",
+                        help="run the search commands in FILE (- for stdin) and write the "
+                             "results as json lines instead of starting interactive mode")
+    parser.add_argument("--jobs", type=positive_int, default=os.cpu_count() or 1,
+                        help="number of processes to run batch queries in (default: %(default)s)")
+    parser.add_argument("--scan-jobs", type=positive_int, default=SCAN_JOBS,
+                        help="number of processes to scan records in for contains and matches "
+                             "searches (default: %(default)s)")
+    parser.add_argument("--validate-jobs", type=positive_int, default=VALIDATE_JOBS,
+                        help="number of processes to type check records in while loading "
+                             "(default: %(default)s)")
+    parser.add_argument("--verbose", action="store_true",
+                        help="warn about each default created while loading instead of "
+                             "counting them per field")
+    parser.add_argument("--no-snapshots", action="store_true",
+                        help="always load from the json files and don't save snapshots")
+    parser.add_argument("--storage", choices=STORAGE_TYPES, default=STORAGE,
+                        help="keep the records in memory, or in a sqlite database next to each "
+                             "file for files larger than memory (default: %(default)s)")
+    parser.add_argument("--serve", metavar="[HOST:]PORT", type=parse_address,
+                        help="serve searches to clients started with --connect instead of "
+                             "starting interactive mode")
+    parser.add_argument("--threads", type=positive_int, default=SERVER_THREADS,
+                        help="number of threads a server runs commands in (default: %(default)s)")
+    parser.add_argument("--cache-entries", type=int, default=QUERY_CACHE_ENTRIES,
+                        help="number of searches to cache the results of, 0 to turn the cache "
+                             "off (default: %(default)s)")
+    parser.add_argument("--cache-mb", type=float, default=QUERY_CACHE_BYTES / (1024 * 1024),
+                        help="megabytes of memory the query cache may use, estimated "
+                             "(default: %(default)s)")
+    parser.add_argument("--no-stats", action="store_true",
+                        help="don't record timings and counters for the stats command")
+    parser.add_argument("--watch", metavar="SECONDS", type=float,
+                        help="check the json files for changes every SECONDS and apply them "
+                             "while interactive or serving")
+    parser.add_argument("--connect", metavar="[HOST:]PORT", type=parse_address,
+                        help="start interactive mode searching on a server instead of loading "
+                             "the files here")
+    return parser.parse_args(argv)
 
 class TestTabCompletion(unittest.TestCase):
     """Python unittest for tab completion"""
@@ -517,6 +4619,11 @@ class TestTabCompletion(unittest.TestCase):
         self.assertEqual(len(f("['V", "search users tags ")), 4)
         self.assertEqual(len(f("['Veg", "search users tags ")), 1)
         self.assertEqual(len(f("dfdfsd", "search users tags ")), 0)
+        # Values are only offered once, in sorted order
+        self.assertListEqual(f("", "search tickets status "), ["closed", "hold", "open", "pending", "solved"])
+        self.assertListEqual(f("o", "search tickets status "), ["open"])
+        self.assertListEqual(f("Catastrophe in Kor", "search tickets subject A "),
+                             ["Catastrophe in Korea (North)", "Catastrophe in Korea (South)"])
 
     def test_search(self):
         """Test search functionality with loaded default data"""
@@ -545,6 +4652,831 @@ class TestTabCompletion(unittest.TestCase):
         # Test searching tags
         self.assertEqual(len(list(cmd_search("tickets _id 1"))), 0)
 
+    def test_relationships(self):
+        """Test joins through the relationship maps match a full search"""
+        org = cmd_search("orgs _id 101")[0]
+        self.assertListEqual(list(org.usernames),
+                             [user["name"] for user in find_all(USERS, "organization_id", 101)])
+        self.assertListEqual(list(org.ticketnames),
+                             [ticket["subject"] for ticket in find_all(TICKETS, "organization_id", 101)])
+        ticket = cmd_search("tickets _id 436bf9b0-1147-4c0a-8439-6f79833bff5b")[0]
+        self.assertEqual(ticket.org_name, find_one_field(ORGS, "_id", 116, "name"))
+        self.assertEqual(ticket.submitter_name, find_one_field(USERS, "_id", 38, "name"))
+        self.assertEqual(RELATIONS.user_name(None), "None Found")
+
+class TestColumnStore(unittest.TestCase):
+    """Test the columnar record storage"""
+    def test_round_trip(self):
+        """Test records read back from columns match the loaded json"""
+        with open("users.json") as userfile:
+            expected = json.load(userfile)
+        store = ColumnStore({"_id": int, "name": str, "active": bool, "tags": list,
+                             "organization_id": int})
+        for record in expected:
+            store.append(record)
+        self.assertEqual(len(store), len(expected))
+        self.assertListEqual([dict(record) for record in store], expected)
+        self.assertIsInstance(store.columns["_id"], ArrayColumn)
+        self.assertIsInstance(store.columns["active"], BoolColumn)
+        self.assertIsInstance(store.columns["tags"], ListColumn)
+        self.assertEqual(store[-1]["_id"], expected[-1]["_id"])
+
+    def test_fallback_columns(self):
+        """Test values a column can't hold move the column to plain storage"""
+        store = ColumnStore({"a": int, "b": list, "c": str})
+        store.append({"a": 1, "b": [1], "c": "x", "d": 4})
+        store.append({"a": 2 ** 70, "b": [True, [2]], "c": None})
+        self.assertIsInstance(store.columns["a"], ObjectColumn)
+        self.assertIsInstance(store.columns["b"], ObjectColumn)
+        self.assertEqual(dict(store[0]), {"a": 1, "b": [1], "c": "x", "d": 4})
+        self.assertEqual(dict(store[1]), {"a": 2 ** 70, "b": [True, [2]], "c": None})
+        # High cardinality strings stop being dictionary encoded
+        store = ColumnStore({"c": str})
+        for number in range(DICT_ENCODE_MIN_DISTINCT * 2):
+            store.append({"c": str(number)})
+        self.assertIsInstance(store.columns["c"], ObjectColumn)
+        self.assertEqual(store[5]["c"], "5")
+
+class TestMembershipSearch(unittest.TestCase):
+    """Test searching the elements of list fields"""
+    def setUp(self):
+        do_init()
+
+    @staticmethod
+    def scan(search_type_key, field_name, elements, match):
+        """Find matching ids by checking every record"""
+        return [value["_id"] for value in SEARCH_TYPES[search_type_key].values
+                if match(element in value[field_name] for element in elements)]
+
+    def test_membership_search(self):
+        """Test any and all searches agree with checking every record"""
+        for elements in (["Ohio"], ["Ohio", "Idaho"], ["American Samoa", "Ohio"], ["Nowhere"]):
+            quoted = " ".join('"{}"'.format(element) for element in elements)
+            found_any = [result.valuedict["_id"] for result in cmd_search("tickets tags any " + quoted)]
+            found_all = [result.valuedict["_id"] for result in cmd_search("tickets tags all " + quoted)]
+            self.assertListEqual(found_any, self.scan("tickets", "tags", elements, any))
+            self.assertListEqual(found_all, self.scan("tickets", "tags", elements, all))
+        self.assertEqual(len(cmd_search("orgs domain_names any kage.com")), 1)
+        # Exact matches of the whole list still work
+        self.assertEqual(len(cmd_search("users tags ['Springville', 'Sutton', 'Hartsville/Hartley', 'Diaperville']")), 1)
+        with self.assertRaises(FailedException):
+            cmd_search("tickets tags any")
+        with self.assertRaises(FailedException):
+            cmd_search('tickets tags any "Ohio')
+
+    def test_postings(self):
+        """Test combining sorted position lists"""
+        self.assertListEqual(intersect_postings([[1, 3, 5, 7], [3, 4, 7], [0, 3, 7, 9]]), [3, 7])
+        self.assertListEqual(intersect_postings([[1, 2], []]), [])
+        self.assertListEqual(union_postings([[1, 5], [2, 5], [9]]), [1, 2, 5, 9])
+
+class TestTextSearch(unittest.TestCase):
+    """Test ranked full text search"""
+    def setUp(self):
+        do_init()
+
+    def test_text_search(self):
+        """Test text search finds and ranks matching records"""
+        results = cmd_search("tickets text korea")
+        self.assertTrue(results)
+        for result in results:
+            text = (result.valuedict["subject"] + " " + result.valuedict["description"]).lower()
+            self.assertIn("korea", text)
+        # A phrase must appear in order
+        subjects = [result.valuedict["subject"] for result in cmd_search('tickets subject text "korea north"')]
+        self.assertListEqual(subjects, ["A Catastrophe in Korea (North)"])
+        self.assertListEqual(cmd_search('tickets subject text "north korea"'), [])
+        subjects = [result.valuedict["subject"] for result in cmd_search('tickets subject text "in korea"')]
+        self.assertSetEqual(set(subjects), {"A Catastrophe in Korea (North)", "A Catastrophe in Korea (South)"})
+        self.assertEqual(cmd_search("users name text francisca")[0].valuedict["_id"], 1)
+        self.assertEqual(len(cmd_search("orgs text nosuchwordatall")), 0)
+        with self.assertRaises(FailedException):
+            cmd_search("tickets text")
+        with self.assertRaises(FailedException):
+            find_text(TICKETS, "status", "open")
+
+    def test_match_count(self):
+        """Test only the best text matches are results but every match is counted"""
+        self.assertEqual(len(cmd_search("tickets text a")), TEXT_TOP_K)
+        _, match_count = count_matches("tickets text a")
+        self.assertGreater(match_count, TEXT_TOP_K)
+        with contextlib.redirect_stdout(io.StringIO()) as output:
+            SearchCommands().do_search("tickets text a")
+        self.assertIn("Search found {} results, showing the best {}".format(match_count, TEXT_TOP_K),
+                      output.getvalue())
+        outp = json.loads(batch_query("search tickets text a"))
+        self.assertEqual((outp["count"], outp["matches"]), (TEXT_TOP_K, match_count))
+        self.assertNotIn("matches", json.loads(batch_query("search tickets text korea")))
+
+    def test_top_k(self):
+        """Test pruned top k retrieval ranks the same as scoring every record"""
+        TICKETS.text_search(["a"], TICKETS.text_fields())
+        text_index = TICKETS.text_index
+        fields = TICKETS.text_fields()
+        for query in (["a", "catastrophe", "problem"], ["nostrud", "ipsum", "korea", "sint"], ["in"]):
+            full = text_index.search(query, fields, len(TICKETS.values), None)
+            for top_k in (1, 5, 30):
+                self.assertListEqual(text_index.search(query, fields, len(TICKETS.values), top_k),
+                                     full[:top_k])
+
+class TestPaging(unittest.TestCase):
+    """Test results are only created for the page being shown"""
+    def setUp(self):
+        do_init()
+
+    def test_lazy_results(self):
+        """Test counting and paging results without creating them all"""
+        with unittest.mock.patch("tomsearch.create_tickets_result",
+                                 side_effect=create_tickets_result) as create:
+            results = run_search("tickets has_incidents False")
+            self.assertGreater(len(results), MAX_RESULTS_SHOW)
+            self.assertEqual(create.call_count, 0)
+            commands = SearchCommands()
+            with contextlib.redirect_stdout(io.StringIO()) as output:
+                commands.do_search("tickets has_incidents False")
+                commands.do_next("")
+            self.assertEqual(create.call_count, MAX_RESULTS_SHOW * 2)
+            self.assertEqual(commands.page_start, MAX_RESULTS_SHOW)
+            self.assertIn("Showing results 31 to 60", output.getvalue())
+            with contextlib.redirect_stdout(io.StringIO()) as output:
+                commands.do_prev("")
+                commands.do_prev("")
+            self.assertEqual(commands.page_start, 0)
+            self.assertIn("No more results", output.getvalue())
+        self.assertListEqual([result.valuedict["_id"] for result in results[30:32]],
+                             [ticket["_id"] for ticket in find_all(TICKETS, "has_incidents", False)[30:32]])
+
+class TestBatch(unittest.TestCase):
+    """Test running searches in batch mode"""
+    def setUp(self):
+        do_init()
+
+    def test_batch(self):
+        """Test batch output is in input order with joined names, in one process or several"""
+        lines = ["search users _id 1\n", "# comment\n", "\n", "orgs _id 101\n",
+                 "tickets _id 436bf9b0-1147-4c0a-8439-6f79833bff5b\n", "cats _id 1\n"]
+        for jobs in (1, 2):
+            output = io.StringIO()
+            with contextlib.redirect_stderr(io.StringIO()):
+                self.assertEqual(do_batch(lines, output, jobs), 4)
+            user, org, ticket, failed = [json.loads(line) for line in output.getvalue().splitlines()]
+            self.assertEqual(user["query"], "search users _id 1")
+            self.assertEqual(user["count"], 1)
+            self.assertEqual(user["results"][0]["name"], "Francisca Rasmussen")
+            self.assertEqual(len(user["results"][0]["assigned_ticket_subjects"]), 2)
+            self.assertEqual(org["results"][0]["_id"], 101)
+            self.assertListEqual(org["results"][0]["user_names"],
+                                 list(RELATIONS.org_user_names(101)))
+            self.assertEqual(ticket["results"][0]["organization_name"], RELATIONS.org_name(116))
+            self.assertEqual(failed["error"], "Invalid search type cats")
+        self.assertIsNone(cmd_search("users _id 16")[0].as_dict()["organization_name"])
+
+    def test_missing_batch_file(self):
+        """Test a batch file that can't be opened is reported rather than raising OSError"""
+        with contextlib.redirect_stdout(io.StringIO()) as output:
+            with self.assertRaises(FailedException):
+                open_batch_file("test-nosuchfile.txt")
+        self.assertIn("Unable to open 'test-nosuchfile.txt': [Errno 2]", output.getvalue())
+
+class TestOutputFormat(unittest.TestCase):
+    """Test writing every result of a search for other programs"""
+    def setUp(self):
+        do_init()
+
+    def search(self, output_format, line):
+        """Run a search in a format, returning what was written"""
+        commands = SearchCommands()
+        commands.do_format(output_format)
+        with contextlib.redirect_stdout(io.StringIO()) as output:
+            commands.do_search(line)
+        return output.getvalue()
+
+    def test_formats(self):
+        """Test every result is written, with no paging and with related names"""
+        expected = [result.as_dict() for result in cmd_search("tickets has_incidents False")]
+        self.assertGreater(len(expected), MAX_RESULTS_SHOW)
+        self.assertListEqual(json.loads(self.search("json", "tickets has_incidents False")),
+                             expected)
+        lines = self.search("jsonl", "tickets has_incidents False").splitlines()
+        self.assertListEqual([json.loads(line) for line in lines], expected)
+        rows = list(csv.DictReader(io.StringIO(self.search("csv", "tickets has_incidents False"))))
+        self.assertEqual(len(rows), len(expected))
+        self.assertEqual(rows[0]["_id"], expected[0]["_id"])
+        self.assertEqual(rows[0]["organization_name"], expected[0]["organization_name"])
+        self.assertListEqual(json.loads(rows[0]["tags"]), expected[0]["tags"])
+        self.assertEqual(json.loads(self.search("json", "tickets status nothing")), [])
+        self.assertEqual(self.search("csv", "orgs _id 0").splitlines(),
+                         [",".join(list(ORGS_SCHEMA) + list(JOINED_FIELDS["orgs"]))])
+
+    def test_chunked_write(self):
+        """Test the records are read a chunk at a time, without holding the lock while writing"""
+        results = run_search("tickets has_incidents False")
+        readers = []
+        class Stream(io.StringIO):
+            def write(self, text):
+                readers.append(DATA_LOCK.readers)
+                return super().write(text)
+        stream = Stream()
+        with unittest.mock.patch("tomsearch.OUTPUT_CHUNK_SIZE", 10), \
+                unittest.mock.patch.object(DATA_LOCK, "reading", wraps=DATA_LOCK.reading) as reading:
+            self.assertEqual(write_results(results, FORMAT_JSONL, stream), len(results))
+        self.assertEqual(reading.call_count, math.ceil(len(results) / 10))
+        self.assertEqual(set(readers), {0})
+        self.assertEqual(len(stream.getvalue().splitlines()), len(results))
+        # Results of data that has since been reloaded aren't written
+        results.generation -= 1
+        with contextlib.redirect_stderr(io.StringIO()) as errors:
+            self.assertEqual(write_results(results, FORMAT_JSON, io.StringIO()), 0)
+        self.assertIn("reloaded while writing", errors.getvalue())
+
+    def test_format_command(self):
+        """Test the format is kept for the session and bad formats are refused"""
+        commands = SearchCommands()
+        with contextlib.redirect_stdout(io.StringIO()) as output:
+            commands.do_format("")
+            commands.do_format("xml")
+            commands.do_format("jsonl")
+            commands.do_format("")
+            commands.do_next("")
+        self.assertEqual(output.getvalue().splitlines(),
+                         ["text", "Unknown format xml, expected one of text, json, jsonl, csv",
+                          "jsonl", "No search to page through"])
+        self.assertListEqual(commands.complete_format("js", "format js", 7, 9), ["json", "jsonl"])
+        writer = ResultWriter(io.StringIO(), size=10)
+        writer.write("12345")
+        self.assertEqual(writer.stream.getvalue(), "")
+        writer.write("67890")
+        self.assertEqual(writer.stream.getvalue(), "1234567890")
+
+class TestRangeSearch(unittest.TestCase):
+    """Test comparing int and timestamp fields"""
+    def setUp(self):
+        do_init()
+
+    def test_parse_timestamp(self):
+        """Test timestamps are converted using their offsets"""
+        self.assertEqual(parse_timestamp("1970-01-01T00:00:00 -00:00"), 0)
+        self.assertEqual(parse_timestamp("1970-01-01T10:00:00 +10:00"), 0)
+        self.assertEqual(parse_timestamp("1970-01-01T00:00:00 -10:00"), 36000)
+        self.assertEqual(parse_timestamp("1970-01-02"), 86400)
+        self.assertEqual(parse_timestamp("2016-04-28T11:19:34 -10:00"), 1461878374)
+        self.assertIsNone(parse_timestamp(""))
+        self.assertIsNone(parse_timestamp("2016-02-30"))
+
+    def test_range_search(self):
+        """Test range searches agree with comparing every record"""
+        ids = [result.valuedict["_id"] for result in cmd_search("users _id between 10 50")]
+        self.assertListEqual(ids, list(range(10, 51)))
+        self.assertEqual(len(cmd_search("users _id > 74")), 1)
+        self.assertEqual(len(cmd_search("users _id >= 74")), 2)
+        self.assertEqual(len(cmd_search("users _id < 2")), 1)
+        self.assertEqual(len(cmd_search("users _id between 50 10")), 0)
+        limit = parse_timestamp("2016-07-31T02:37:50 -10:00")
+        expected = [ticket["_id"] for ticket in TICKETS.values
+                    if parse_timestamp(ticket["due_at"]) is not None
+                    and parse_timestamp(ticket["due_at"]) > limit]
+        found = [result.valuedict["_id"] for result in cmd_search("tickets due_at > 2016-07-31T02:37:50 -10:00")]
+        self.assertTrue(expected)
+        self.assertListEqual(found, expected)
+        found = [result.valuedict["_id"]
+                 for result in cmd_search('tickets due_at between 2016-07-31T02:37:50-10:00 "2100-01-01"')]
+        self.assertListEqual(found, [ticket["_id"] for ticket in TICKETS.values
+                                     if parse_timestamp(ticket["due_at"]) is not None
+                                     and parse_timestamp(ticket["due_at"]) >= limit])
+        with self.assertRaises(FailedException):
+            cmd_search("users _id > ten")
+        with self.assertRaises(FailedException):
+            cmd_search("users created_at > yesterday")
+        with self.assertRaises(FailedException):
+            cmd_search("users _id between 1")
+        # Exact matches of a timestamp still compare the text
+        self.assertEqual(len(cmd_search("tickets created_at 2016-04-28T11:19:34 -10:00")), 1)
+
+class TestCompoundSearch(unittest.TestCase):
+    """Test combining conditions with AND, OR and NOT"""
+    def setUp(self):
+        do_init()
+
+    @staticmethod
+    def ids(commandline):
+        """Return the ids found by a search"""
+        return [result.valuedict["_id"] for result in cmd_search(commandline)]
+
+    def test_compound_search(self):
+        """Test compound searches agree with combining single searches"""
+        open_tickets = self.ids("tickets status open")
+        high = self.ids("tickets priority high")
+        urgent = self.ids("tickets priority urgent")
+        incidents = self.ids("tickets type incident")
+        in_order = lambda ids: [ticket["_id"] for ticket in TICKETS.values if ticket["_id"] in ids]
+        self.assertListEqual(self.ids("tickets status open AND priority high"),
+                             in_order(set(open_tickets) & set(high)))
+        self.assertListEqual(self.ids("tickets status open AND ( priority high OR priority urgent )"),
+                             in_order(set(open_tickets) & (set(high) | set(urgent))))
+        self.assertListEqual(self.ids("tickets NOT type incident AND status open"),
+                             in_order(set(open_tickets) - set(incidents)))
+        # NOT binds tighter than AND, which binds tighter than OR
+        self.assertListEqual(self.ids("tickets priority high OR status open AND NOT type incident"),
+                             in_order(set(high) | (set(open_tickets) - set(incidents))))
+        # Quoted values may contain spaces and keywords
+        self.assertEqual(len(cmd_search('tickets subject "A Catastrophe in Korea (North)" OR status nothing')), 1)
+        self.assertEqual(len(cmd_search("tickets subject A Catastrophe in Korea (North)")), 1)
+        self.assertEqual(len(cmd_search('tickets subject "A Catastrophe in Korea (North)"')), 1)
+        # A lone word after a keyword that isn't a field makes the keyword part of the value
+        query = parse_query("tickets subject Rock AND Roll")[1]
+        self.assertIsInstance(query, ExactPredicate)
+        self.assertEqual(query.match_value, "Rock AND Roll")
+        self.assertIsInstance(parse_query("tickets subject Rock AND organization.name")[1], AndQuery)
+        with self.assertRaises(TypeError):
+            Query(TICKETS)
+        for commandline in ("tickets status open AND", "tickets ( status open", "tickets status ( open",
+                            "tickets NOT", "tickets status open AND nosuchfield 1"):
+            with self.assertRaises(FailedException):
+                with contextlib.redirect_stdout(io.StringIO()):
+                    cmd_search(commandline)
+
+    def test_related_search(self):
+        """Test conditions on related records"""
+        org_id = ORGS.values[0]["_id"]
+        org_name = ORGS.values[0]["name"]
+        self.assertListEqual(self.ids("tickets organization.name {}".format(org_name)),
+                             [ticket["_id"] for ticket in find_all(TICKETS, "organization_id", org_id)])
+        admins = set(self.ids("users role admin"))
+        found = self.ids("tickets submitter.role admin AND NOT assignee.role admin")
+        self.assertListEqual(found, [ticket["_id"] for ticket in TICKETS.values
+                                     if ticket["submitter_id"] in admins
+                                     and ticket["assignee_id"] not in admins])
+
+    def test_plan(self):
+        """Test the most selective condition is evaluated first and every plan matches checking each record"""
+        search_type_key, query = parse_query(
+            "tickets due_at > 2016-01-01 AND tags any Ohio AND NOT type incident AND organization.name Enthaze")
+        strategies = [strategy for strategy, _, _ in query.plan()]
+        self.assertEqual(strategies[0], PLAN_LOOKUP)
+        self.assertIsInstance(query.plan()[0][1], RelatedPredicate)
+        self.assertEqual(strategies[-1], PLAN_FILTER)
+        self.assertListEqual(query.positions(), [position for position in range(len(TICKETS.values))
+                                                 if query.matches(position)])
+        with contextlib.redirect_stdout(io.StringIO()) as output:
+            SearchCommands().do_explain("tickets status open AND priority high")
+        self.assertIn("1. {}".format(PLAN_LOOKUP), output.getvalue())
+        self.assertIn('status = "open"', output.getvalue())
+        # An unindexed first step scans with scan_positions, which can share it between processes
+        _, query = parse_query("tickets description contains nisi AND url contains 4")
+        self.assertEqual(query.plan()[0][0], PLAN_SCAN)
+        with unittest.mock.patch("tomsearch.scan_positions", side_effect=scan_positions) as scan:
+            found = query.positions()
+        self.assertEqual(scan.call_count, 1)
+        self.assertListEqual(found, [position for position in range(len(TICKETS.values))
+                                     if query.matches(position)])
+
+class TestScanSearch(unittest.TestCase):
+    """Test substring and regular expression searches"""
+    def setUp(self):
+        do_init()
+
+    def test_scan_search(self):
+        """Test scanning finds the same records as checking each one"""
+        found = [result.valuedict["_id"] for result in cmd_search("users email contains @FLOTONIC")]
+        self.assertTrue(found)
+        self.assertListEqual(found, [user["_id"] for user in USERS.values
+                                     if "@flotonic" in user["email"].lower()])
+        found = [result.valuedict["_id"] for result in cmd_search("tickets status matches ^(open|hold)$")]
+        self.assertListEqual(found, [ticket["_id"] for ticket in TICKETS.values
+                                     if ticket["status"] in ("open", "hold")])
+        self.assertEqual(len(cmd_search("users _id matches ^7.$")), 6)
+        with self.assertRaises(FailedException):
+            with contextlib.redirect_stdout(io.StringIO()):
+                cmd_search("users email matches (")
+        # Unindexed conditions are checked last in a compound search
+        _, query = parse_query("tickets description contains nostrud AND status open")
+        self.assertEqual(query.plan()[-1][:2], (PLAN_FILTER, query.queries[0]))
+
+    def test_trigram_search(self):
+        """Test substring and fuzzy searches of indexed fields match scanning every record"""
+        for search_type, field_name, needles in (
+                (USERS, "name", ("ra", "Rasmus", "francsica rasmusen", "zzz")),
+                (USERS, "email", ("@FLOTONIC", "coffeyrasmusen", "x")),
+                (TICKETS, "subject", ("korea (n", "A Catastrophy in Korea", "nuisance"))):
+            for needle in needles:
+                for mode in (MODE_CONTAINS, MODE_FUZZY):
+                    predicate = ScanPredicate(search_type, field_name, mode, needle)
+                    self.assertTrue(predicate.indexed)
+                    self.assertListEqual(predicate.positions(),
+                                         scan_column(search_type.values, field_name,
+                                                     scan_test(mode, needle), 0,
+                                                     len(search_type.values)), needle)
+        found = [result.valuedict["name"] for result in cmd_search("users name fuzzy Francsica Rasmusen")]
+        self.assertListEqual(found, ["Francisca Rasmussen"])
+        # Fuzzy matches come closest first
+        found = [result.valuedict["subject"] for result in
+                 cmd_search("tickets subject fuzzy catastrophy in korea (south")]
+        self.assertListEqual(found[:2], ["A Catastrophe in Korea (South)", "A Catastrophe in Korea (North)"])
+        self.assertFalse(ScanPredicate(USERS, "signature", MODE_FUZZY, "be hapy").indexed)
+        self.assertEqual(len(cmd_search("users signature fuzzy be hapy")), len(USERS.values))
+        # Short searches allow no typos rather than matching nearly everything
+        self.assertEqual(fuzzy_edits("ras"), 0)
+        self.assertListEqual(ScanPredicate(USERS, "name", MODE_FUZZY, "a").positions(),
+                             ScanPredicate(USERS, "name", MODE_CONTAINS, "a").positions())
+        self.assertLess(len(cmd_search("users name fuzzy xq")), len(USERS.values))
+        self.assertEqual(substring_edit_distance("rasmusen", "coffeyrasmussen@flotonic.com", 1), 1)
+        self.assertIsNone(substring_edit_distance("rasmsen", "coffeyrasmussen@flotonic.com", 0))
+        # Records deleted by a reload aren't found, and records added are
+        trigram_index = USERS.trigram_index("name")
+        trigram_index.add(len(USERS.values), "Francisca Rasmussen")
+        trigram_index.remove(0)
+        self.assertListEqual(trigram_index.record_positions(trigram_index.contains("rasmussen")),
+                             [len(USERS.values)])
+
+    def test_parallel_scan(self):
+        """Test a scan shared between processes returns the records in order"""
+        expected = scan_positions(TICKETS, "description", MODE_CONTAINS, "sint")
+        self.addCleanup(SCAN_POOL.close)
+        with unittest.mock.patch("tomsearch.SCAN_PARALLEL_MIN_RECORDS", 0), \
+                unittest.mock.patch("tomsearch.SCAN_JOBS", 3):
+            self.assertListEqual(scan_positions(TICKETS, "description", MODE_CONTAINS, "sint"), expected)
+            self.assertListEqual(scan_positions(TICKETS, "tags", MODE_MATCHES, "Ohio"),
+                                 [position for position, ticket in enumerate(TICKETS.values)
+                                  if "Ohio" in ticket["tags"]])
+            self.assertEqual(SCAN_POOL.jobs, 3)
+
+class TestServer(unittest.TestCase):
+    """Test serving searches to clients over a socket"""
+    def setUp(self):
+        do_init()
+        self.server = SearchServer()
+        started = threading.Event()
+        def ready(address):
+            self.address = address
+            started.set()
+        self.thread = threading.Thread(target=self.server.run, args=(ready,))
+        self.thread.start()
+        started.wait(10)
+
+    def tearDown(self):
+        self.server.stop()
+        self.thread.join()
+
+    def test_commands(self):
+        """Test searches, paging, completion and errors match running the commands locally"""
+        client = SearchClient(*self.address)
+        other = SearchClient(*self.address)
+        try:
+            commands = SearchCommands()
+            for line in ("search tickets has_incidents False", "next", "search users _id 1",
+                         "explain users _id 1", "search cats _id 1"):
+                with contextlib.redirect_stdout(io.StringIO()) as output:
+                    commands.onecmd(line)
+                self.assertEqual(client.request({"command": line, "id": 7}),
+                                 {"id": 7, "output": output.getvalue()})
+            # Paging follows the last search on the same connection
+            self.assertIn("No search to page through", other.request({"command": "next"})["output"])
+            self.assertIn("Showing results 31 to 60", other.request(
+                {"command": "search tickets has_incidents False"})["output"] +
+                          other.request({"command": "next"})["output"])
+            self.assertListEqual(client.request({"complete": "search users na", "text": "na"})
+                                 ["completions"], ["name"])
+            with contextlib.redirect_stdout(io.StringIO()):
+                with self.assertRaises(FailedException):
+                    client.request({"cats": 1})
+            # The connection is still usable after a bad request
+            self.assertIn("Francisca Rasmussen", client.request({"command": "search users _id 1"})["output"])
+            # Requests that are too long, or that fail unexpectedly, still get a response
+            with contextlib.redirect_stdout(io.StringIO()) as output:
+                with self.assertRaises(FailedException):
+                    client.request({"command": "search users name " + "x" * SERVER_REQUEST_LIMIT})
+                with unittest.mock.patch.object(SearchCommands, "onecmd",
+                                                side_effect=RuntimeError("broken")):
+                    with self.assertRaises(FailedException):
+                        client.request({"command": "search users _id 1"})
+            self.assertEqual(output.getvalue().splitlines(), [
+                "Requests must be shorter than {} bytes".format(SERVER_REQUEST_LIMIT),
+                "Unable to answer the request: RuntimeError('broken')"])
+            self.assertIn("Francisca Rasmussen", client.request({"command": "search users _id 1"})["output"])
+        finally:
+            client.close()
+            other.close()
+
+    def test_concurrent_clients(self):
+        """Test many clients searching at once each get their own results"""
+        lines = ["search users _id {}".format(user_id) for user_id in range(1, 21)]
+        outputs = {}
+        def search(line):
+            client = SearchClient(*self.address)
+            try:
+                outputs[line] = client.request({"command": line})["output"]
+            finally:
+                client.close()
+        threads = [threading.Thread(target=search, args=(line,)) for line in lines]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        for line in lines:
+            name = USERS.values[int(line.split()[-1]) - 1]["name"]
+            self.assertIn(name, outputs[line])
+
+    def test_remote_commands(self):
+        """Test the interactive commands print what the server sends and complete from it"""
+        commands = RemoteSearchCommands(SearchClient(*self.address))
+        try:
+            with contextlib.redirect_stdout(io.StringIO()) as output:
+                commands.onecmd("search orgs _id 101")
+                commands.onecmd("")
+            self.assertEqual(output.getvalue().count("Name: Enthaze"), 2)
+            self.assertListEqual(commands.complete_search("Ent", "search orgs name Ent", 17, 20),
+                                 ["Enthaze"])
+            with self.assertRaises(ExitException):
+                commands.onecmd("exit")
+        finally:
+            commands.client.close()
+
+    def test_thread_count(self):
+        """Test counts of threads and processes below one are refused by the parser"""
+        self.assertEqual(parse_args(["--serve", "0", "--threads", "2"]).threads, 2)
+        for option in ("--threads", "--jobs", "--scan-jobs", "--validate-jobs"):
+            for value in ("0", "-1", "x"):
+                with contextlib.redirect_stderr(io.StringIO()) as output:
+                    with self.assertRaises(SystemExit):
+                        parse_args([option, value])
+                self.assertIn("invalid count '{}'".format(value), output.getvalue())
+
+class TestGroup(unittest.TestCase):
+    """Test counting and grouping records from their columns"""
+    def setUp(self):
+        do_init()
+
+    def run_command(self, line):
+        """Run a command without creating any results, returning what it printed"""
+        with unittest.mock.patch("tomsearch.create_result",
+                                 side_effect=AssertionError("Grouping shouldn't create results")), \
+                contextlib.redirect_stdout(io.StringIO()) as output:
+            SearchCommands().onecmd(line)
+        return output.getvalue()
+
+    def test_count(self):
+        """Test counts match the number of search results"""
+        self.assertEqual(self.run_command("count tickets"), "{} tickets record(s)\n".format(
+            len(TICKETS.values)))
+        self.assertEqual(self.run_command("count tickets status open AND priority high"),
+                         "{} tickets record(s)\n".format(
+                             len(cmd_search("tickets status open AND priority high"))))
+        self.assertEqual(self.run_command("count cats"), "Invalid search type cats\n")
+        STATS.reset()
+        self.run_command("count tickets status open")
+        self.assertEqual(list(STATS.dump()["stages"]), ["count"])
+
+    def test_group(self):
+        """Test groups match counting the records, including related and list fields"""
+        expected = collections.Counter((user["role"], user["locale"]) for user in USERS.values)
+        self.assertEqual(group_counts("users", ["role", "locale"], range(len(USERS.values))), expected)
+        output = self.run_command("group users role locale top 2").splitlines()
+        self.assertEqual(output[0], "{} record(s) in {} group(s)".format(len(USERS.values),
+                                                                           len(expected)))
+        (role, locale), count = expected.most_common(1)[0]
+        self.assertEqual(output[2].split(), [str(count), role, locale])
+        self.assertIn("Showing the largest 2 of", output[-1])
+        open_tickets = [ticket for ticket in TICKETS.values if ticket["status"] == "open"]
+        query = parse_group("tickets organization.name top all where status open")[3]
+        self.assertEqual(group_counts("tickets", ["organization.name"], query.positions()),
+                         collections.Counter((found_name(RELATIONS.org_name(ticket["organization_id"])),)
+                                             for ticket in open_tickets))
+        self.assertEqual(group_counts("tickets", ["tags"], range(len(TICKETS.values))),
+                         collections.Counter((tag,) for ticket in TICKETS.values
+                                             for tag in set(ticket["tags"])))
+        # Deleted records aren't counted
+        TICKETS.delete(0)
+        self.assertTrue(self.run_command("group tickets via submitter.role").startswith(
+            "{} record(s)".format(len(TICKETS.values) - 1)))
+        for line in ("group tickets bogus", "group tickets status top 0", "group tickets status where",
+                     "group tickets organization.bogus"):
+            self.assertNotIn("record(s)", self.run_command(line), line)
+
+    def test_group_formats(self):
+        """Test groups can be written for other programs"""
+        commands = SearchCommands()
+        commands.do_format("jsonl")
+        with contextlib.redirect_stdout(io.StringIO()) as output:
+            commands.do_group("orgs shared_tickets")
+        self.assertEqual([json.loads(line) for line in output.getvalue().splitlines()],
+                         [{"shared_tickets": False, "count": 15}, {"shared_tickets": True, "count": 10}])
+
+class TestQueryCache(unittest.TestCase):
+    """Test repeated searches are answered from the query cache"""
+    def setUp(self):
+        do_init()
+        QUERY_CACHE.clear()
+
+    def tearDown(self):
+        QUERY_CACHE.resize(QUERY_CACHE_ENTRIES, QUERY_CACHE_BYTES)
+
+    def test_hits(self):
+        """Test searches parsing to the same query share the cached positions and results"""
+        first = run_search("users organization_id 101")
+        names = [result.org_name for result in first]
+        hits = QUERY_CACHE.hits
+        second = run_search("users ( organization_id \"101\" )")
+        self.assertEqual(QUERY_CACHE.hits, hits + 1)
+        self.assertIs(second.cached, first.cached)
+        # Results already created are reused, with their related names
+        self.assertIs(second[0], first[0])
+        self.assertListEqual([result.org_name for result in second], names)
+        self.assertListEqual([result.valuedict["_id"] for result in run_search("users _id 1")], [1])
+        dump = QUERY_CACHE.dump()
+        self.assertEqual((dump["entries"], dump["hits"] - hits), (2, 1))
+        self.assertGreater(dump["bytes"], 0)
+
+    def test_invalidation(self):
+        """Test changed data is never answered from the cache"""
+        cached = run_search("tickets status open").cached
+        self.assertIs(run_search("tickets status open").cached, cached)
+        global DATA_GENERATION
+        DATA_GENERATION += 1
+        self.assertIsNot(run_search("tickets status open").cached, cached)
+        self.assertEqual(QUERY_CACHE.dump()["entries"], 1)
+
+    def test_limits(self):
+        """Test the least recently used searches are evicted to stay within the limits"""
+        QUERY_CACHE.resize(max_entries=2)
+        run_search("users _id 1")
+        run_search("users _id 2")
+        run_search("users _id 1")
+        run_search("users _id 3")
+        self.assertListEqual([key[1] for key in QUERY_CACHE.entries],
+                             ['_id = "1"', '_id = "3"'])
+        # Results stop being kept once their search would take the cache over its memory limit
+        QUERY_CACHE.resize(max_entries=10, max_bytes=QUERY_CACHE_ENTRY_BYTES + 8 * 10)
+        results = run_search("tickets has_incidents False")
+        self.assertIsNone(results.cached)
+        results = run_search("users _id 2")
+        list(results)
+        self.assertLessEqual(QUERY_CACHE.size, QUERY_CACHE.max_bytes)
+        QUERY_CACHE.resize(max_entries=0)
+        self.assertEqual(QUERY_CACHE.dump()["entries"], 0)
+        self.assertIsNone(run_search("users _id 1").cached)
+
+class TestReload(unittest.TestCase):
+    """Test applying changes to the json files without loading them again"""
+    QUERIES = ["tickets status pending", "tickets tags any Ohio Reloaded", "tickets text Catastrophe",
+               "tickets subject contains reload", "tickets organization.name Enthaze",
+               "tickets assignee.name Reload Tester", "tickets created_at > 2016-05-01",
+               "tickets NOT status pending", "users name Reload Tester", "users organization_id 119"]
+
+    def setUp(self):
+        self.directory = os.getcwd()
+        self.tmpdir = tempfile.TemporaryDirectory()
+        for filename in ("organizations.json", "users.json", "tickets.json"):
+            shutil.copy(filename, self.tmpdir.name)
+        os.chdir(self.tmpdir.name)
+        patcher = unittest.mock.patch("tomsearch.SNAPSHOT_DIR",
+                                      os.path.join(self.tmpdir.name, "snapshots"))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        do_init(True)
+
+    def tearDown(self):
+        os.chdir(self.directory)
+        self.tmpdir.cleanup()
+
+    @staticmethod
+    def rewrite(filename, change):
+        """Change the records of a json file, making sure its modification time changes"""
+        with open(filename) as jsonfile:
+            records = change(json.load(jsonfile))
+        stat = os.stat(filename)
+        with open(filename, "w") as jsonfile:
+            json.dump(records, jsonfile)
+        os.utime(filename, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+
+    @staticmethod
+    def found_ids():
+        """Return the sorted ids found by each of the test queries"""
+        return {query: sorted(str(result.valuedict["_id"]) for result in run_search(query))
+                for query in TestReload.QUERIES}
+
+    def test_reload(self):
+        """Test inserts, updates and deletes reach the records, indexes and relationships"""
+        for query in self.QUERIES:
+            # Build the indexes first, so they are updated rather than built after the reload
+            run_search(query)
+        self.assertListEqual(TICKETS.complete("subject", "A Catastrophe in Korea (N"),
+                             ["A Catastrophe in Korea (North)"])
+        old = run_search("tickets _id 436bf9b0-1147-4c0a-8439-6f79833bff5b")
+        def change_tickets(tickets):
+            tickets[0].update(status="closed", subject="A Reload in Testland", tags=["Reloaded"])
+            del tickets[1]
+            tickets.append(dict(tickets[2], _id="reload-new", subject="A Brand New Catastrophe"))
+            return tickets
+        def change_users(users):
+            for user in users:
+                if user["_id"] == 24:
+                    user["name"] = "Reload Tester"
+            return users
+        self.rewrite("tickets.json", change_tickets)
+        self.rewrite("users.json", change_users)
+        self.assertListEqual(reload_files(), ["users.json: 0 added, 1 changed, 0 removed",
+                                              "tickets.json: 1 added, 1 changed, 1 removed"])
+        self.assertListEqual(reload_files(), [])
+        reloaded = self.found_ids()
+        self.assertIn("436bf9b0-1147-4c0a-8439-6f79833bff5b",
+                      reloaded["tickets assignee.name Reload Tester"])
+        self.assertListEqual(TICKETS.complete("subject", "A Catastrophe in Korea (N"), [])
+        self.assertListEqual(TICKETS.complete("subject", "A Reload"), ["A Reload in Testland"])
+        self.assertEqual(cmd_search("tickets _id 436bf9b0-1147-4c0a-8439-6f79833bff5b")[0]
+                         .as_dict()["assignee_name"], "Reload Tester")
+        # Results found before the reload still show the records as they were
+        self.assertEqual(old[0].valuedict["subject"], "A Catastrophe in Korea (North)")
+        # Plans only count the records left
+        self.assertEqual(parse_query("tickets NOT status nosuch")[1].estimate(),
+                         TICKETS.values.live_count())
+        self.assertLess(TICKETS.values.live_count(), len(TICKETS.values))
+        do_init(False)
+        self.assertDictEqual(reloaded, self.found_ids())
+
+    def test_watch_errors(self):
+        """Test watching carries on after an unexpected error reloading"""
+        reloaded = threading.Event()
+        errors = [RuntimeError("dictionary changed size during iteration")]
+        def reload():
+            if errors:
+                raise errors.pop()
+            reloaded.set()
+            return []
+        with unittest.mock.patch("tomsearch.reload_files", side_effect=reload), \
+                contextlib.redirect_stderr(io.StringIO()) as output:
+            stop = watch_files(0.01)
+            self.assertTrue(reloaded.wait(10))
+            stop.set()
+        self.assertIn("Unable to reload the files: RuntimeError", output.getvalue())
+
+    def test_invalid_reload(self):
+        """Test a file with an invalid record leaves the data as it was"""
+        def break_users(users):
+            users[0]["name"] = 5
+            return users
+        self.rewrite("users.json", break_users)
+        with contextlib.redirect_stdout(io.StringIO()) as output:
+            with self.assertRaises(FailedException):
+                reload_files()
+        self.assertIn("instead of <class 'str'>", output.getvalue())
+        self.assertEqual(cmd_search("users _id 1")[0].valuedict["name"], "Francisca Rasmussen")
+
+    def test_compact(self):
+        """Test the records are stored again once most have been deleted"""
+        self.rewrite("users.json", lambda users: users[:10])
+        self.assertListEqual(reload_files(), ["users.json: 0 added, 0 changed, 65 removed"])
+        self.assertEqual(len(USERS.values), 10)
+        self.assertFalse(USERS.values.deleted)
+        reloaded = self.found_ids()
+        do_init(False)
+        self.assertDictEqual(reloaded, self.found_ids())
+
+class TestStats(unittest.TestCase):
+    """Test timing the stages of commands"""
+    def setUp(self):
+        do_init()
+        STATS.reset()
+
+    def tearDown(self):
+        STATS.enabled = True
+
+    def test_stats(self):
+        """Test searching, paging and completing are timed and counted"""
+        commands = SearchCommands()
+        with contextlib.redirect_stdout(io.StringIO()):
+            commands.onecmd("search tickets has_incidents False")
+            commands.onecmd("next")
+            commands.complete_search("Fr", "search users name Fr", 18, 20)
+        dump = STATS.dump()
+        self.assertEqual(dump["stages"]["search"]["count"], 1)
+        self.assertEqual(dump["stages"]["join"]["count"], MAX_RESULTS_SHOW * 2)
+        self.assertEqual(dump["stages"]["render"]["count"], MAX_RESULTS_SHOW * 2)
+        self.assertEqual(dump["stages"]["completion"]["count"], 1)
+        self.assertEqual(sum(dump["stages"]["join"]["histogram"].values()), MAX_RESULTS_SHOW * 2)
+        self.assertEqual(dump["counters"], {"searches": 1, "results found": 101,
+                                            "results shown": MAX_RESULTS_SHOW * 2,
+                                            "query cache misses": 1})
+        with contextlib.redirect_stdout(io.StringIO()) as output:
+            commands.onecmd("stats json")
+        self.assertEqual(json.loads(output.getvalue())["counters"]["searches"], 1)
+        with contextlib.redirect_stdout(io.StringIO()) as output:
+            commands.onecmd("stats")
+        self.assertIn("search latency:", output.getvalue())
+        STATS.enabled = False
+        with contextlib.redirect_stdout(io.StringIO()):
+            commands.onecmd("search users _id 1")
+        self.assertEqual(STATS.dump()["counters"]["searches"], 1)
+        commands.onecmd("stats reset")
+        self.assertEqual(STATS.dump()["stages"], {})
+
+    def test_profile(self):
+        """Test profiling a command shows its output and the functions it ran"""
+        with contextlib.redirect_stdout(io.StringIO()) as output:
+            SearchCommands().onecmd("profile search users _id 1")
+        self.assertIn("Francisca Rasmussen", output.getvalue())
+        self.assertIn("function calls", output.getvalue())
+        self.assertIn("Ordered by: internal time", output.getvalue())
+
 class TestValidatedDictList(unittest.TestCase):
     """Test data loading and parsing"""
     def test_ValididatedDict_List_init(self):
@@ -576,10 +5508,289 @@ class TestValidatedDictList(unittest.TestCase):
         value = find_one_field(valid, "test_string", "string", FIELD_ID)
         self.assertEqual(value, 1)
 
+    def test_schema_warnings(self):
+        """Test defaults are reported once per field unless verbose"""
+        schema = {"test_int": int, "test_string": str, "test_missing": int, "test_missing_id": int}
+        with contextlib.redirect_stderr(io.StringIO()) as output:
+            valid = ValidatedDictList("test-valid.json", "test-valid", schema)
+        self.assertEqual(output.getvalue().splitlines(), [
+            "test-valid.json Created a default for test_string <class 'str'> in 1 record(s), "
+            "e.g. record ids 2",
+            "test-valid.json Created a default for test_missing <class 'int'> in 2 record(s), "
+            "e.g. record ids 1, 2",
+            "test-valid.json Created a default for test_missing_id <class 'int'> in 2 record(s), "
+            "e.g. record ids 1, 2"])
+        self.assertEqual(valid.values[1]["test_string"], "")
+        warnings = SchemaWarnings("test.json", {"a": int})
+        for record_id in range(5):
+            warnings.add(record_id, ("a",))
+        with contextlib.redirect_stderr(io.StringIO()) as output:
+            warnings.report()
+        self.assertIn("in 5 record(s), e.g. record ids 0, 1, 2, ...", output.getvalue())
+        with unittest.mock.patch("tomsearch.VERBOSE_WARNINGS", True), \
+                contextlib.redirect_stderr(io.StringIO()) as output:
+            ValidatedDictList("test-valid.json", "test-valid", {"test_string": str})
+        self.assertEqual(output.getvalue(),
+                         "test-valid.json Creating a default for test_string <class 'str'> "
+                         "record id 2\n")
+
+    def test_parallel_validation(self):
+        """Test validating chunks in processes matches validating them here"""
+        with contextlib.redirect_stderr(io.StringIO()) as output:
+            expected = ValidatedDictList("tickets.json", "tickets", TICKETS_SCHEMA)
+        with unittest.mock.patch("tomsearch.VALIDATE_JOBS", 2), \
+                unittest.mock.patch("tomsearch.VALIDATE_CHUNK_SIZE", 7):
+            with contextlib.redirect_stderr(io.StringIO()) as parallel_output:
+                tickets = ValidatedDictList("tickets.json", "tickets", TICKETS_SCHEMA)
+            self.assertListEqual(list(tickets.values), list(expected.values))
+            self.assertEqual(parallel_output.getvalue(), output.getvalue())
+            with contextlib.redirect_stdout(io.StringIO()) as output:
+                with self.assertRaises(FailedException):
+                    ValidatedDictList("tickets.json", "tickets", dict(TICKETS_SCHEMA, subject=int))
+            self.assertIn("with key subject that was type <class 'str'>", output.getvalue())
+
+    def test_streaming_load(self):
+        """Test the incremental loader matches loading the whole file"""
+        with open("tickets.json") as ticketfile:
+            expected = json.load(ticketfile)
+        for chunk_size in (1, 7, LOAD_CHUNK_SIZE):
+            self.assertEqual(list(iterloadfile("tickets.json", chunk_size)), expected)
+        # Syntax errors report their position in the whole stream
+        with self.assertRaisesRegex(json.decoder.JSONDecodeError, "line 3 column 7"):
+            list(iter_json_array(io.StringIO('[{"a": 1},\n {"b": 2},\n {"c" 3}]'), 4))
+        with self.assertRaisesRegex(json.decoder.JSONDecodeError, "Expecting '\\['"):
+            list(iter_json_array(io.StringIO('{"a": 1}')))
+        # Literals and escapes cut off by a chunk are read whole
+        for chunk_size in range(1, 12):
+            self.assertEqual(list(iter_json_array(io.StringIO('[true, false, null, "\\u00e9"]'),
+                                                  chunk_size)), [True, False, None, "\u00e9"])
+        # An invalid entry fails without reading the rest of the file
+        stream = io.StringIO('[{"a" 1}, ' + '{"b": 2}, ' * 10000 + '{}]')
+        with self.assertRaisesRegex(json.decoder.JSONDecodeError, "line 1 column 7"):
+            list(iter_json_array(stream, 64))
+        self.assertLess(stream.tell(), 256)
+
+    def test_snapshot(self):
+        """Test snapshots are used until the source file changes"""
+        schema = {"test_int": int, "test_string": str}
+        with tempfile.TemporaryDirectory() as tmpdir, \
+                unittest.mock.patch("tomsearch.SNAPSHOT_DIR", os.path.join(tmpdir, "snapshots")):
+            filename = os.path.join(tmpdir, "test-valid.json")
+            shutil.copy("test-valid.json", filename)
+            first = ValidatedDictList(filename, "test-valid", schema, use_snapshot=True)
+            self.assertFalse(first.from_snapshot)
+            first.index("test_int")
+            first.save_snapshot()
+            self.assertFalse(os.path.exists(filename + SNAPSHOT_SUFFIX))
+            self.assertTrue(is_private(snapshot_path(filename)))
+            second = ValidatedDictList(filename, "test-valid", schema, use_snapshot=True)
+            self.assertTrue(second.from_snapshot)
+            self.assertListEqual([dict(value) for value in second.values],
+                                 [dict(value) for value in first.values])
+            self.assertIn("test_int", second.indexes)
+            # The same contents with a new modification time are hashed and still match
+            stat = os.stat(filename)
+            os.utime(filename, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+            with unittest.mock.patch("tomsearch.file_digest", side_effect=file_digest) as digest:
+                self.assertTrue(ValidatedDictList(filename, "test-valid", schema,
+                                                  use_snapshot=True).from_snapshot)
+            self.assertEqual(digest.call_count, 1)
+            # Snapshots others can write to aren't loaded, as they could run any code
+            os.chmod(snapshot_path(filename), 0o666)
+            with contextlib.redirect_stderr(io.StringIO()) as output:
+                self.assertFalse(ValidatedDictList(filename, "test-valid", schema,
+                                                   use_snapshot=True).from_snapshot)
+            self.assertIn("others can write", output.getvalue())
+            os.chmod(snapshot_path(filename), 0o600)
+            # A different schema or changed contents rebuild from the file
+            other = ValidatedDictList(filename, "test-valid", {"test_int": int}, use_snapshot=True)
+            self.assertFalse(other.from_snapshot)
+            with open(filename, "w") as sourcefile:
+                sourcefile.write('[{"_id": 3, "test_int": 5, "test_string": "new"}]')
+            changed = ValidatedDictList(filename, "test-valid", schema, use_snapshot=True)
+            self.assertFalse(changed.from_snapshot)
+            self.assertEqual(changed.values[0]["test_string"], "new")
+
+    def test_field_index(self):
+        """Test that indexed lookups match on the string form of values"""
+        valid = ValidatedDictList("test-valid.json", "test-valid", {"test_int": int})
+        self.assertEqual(valid.lookup("test_int", 123), [0, 1])
+        self.assertEqual(valid.lookup("test_int", "123"), [0, 1])
+        self.assertEqual(valid.lookup("test_int", 124), [])
+        self.assertEqual(valid.lookup("_id", "2"), [1])
+        self.assertEqual(len(find_all(valid, "test_int", "123")), 2)
+        # Uniqueness is checked once when building a primary key map
+        with self.assertRaises(FailedException):
+            unique_index(valid, "test_int")
+        self.assertEqual(unique_index(valid, "_id"), {"1": [0], "2": [1]})
+
+class SqliteStorage(object):
+    """Mixin running the tests of a test case with the records stored in sqlite, in databases
+    of copies of the json files in a temporary directory"""
+    def setUp(self):
+        directory = os.getcwd()
+        sqlite_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(sqlite_dir.cleanup)
+        for filename in ("organizations.json", "users.json", "tickets.json"):
+            shutil.copy(filename, sqlite_dir.name)
+        os.chdir(sqlite_dir.name)
+        self.addCleanup(os.chdir, directory)
+        patcher = unittest.mock.patch("tomsearch.STORAGE", STORAGE_SQLITE)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        super().setUp()
+
+class TestSqliteTabCompletion(SqliteStorage, TestTabCompletion):
+    pass
+
+class TestSqliteMembershipSearch(SqliteStorage, TestMembershipSearch):
+    pass
+
+class TestSqliteTextSearch(SqliteStorage, TestTextSearch):
+    pass
+
+class TestSqlitePaging(SqliteStorage, TestPaging):
+    pass
+
+class TestSqliteOutputFormat(SqliteStorage, TestOutputFormat):
+    pass
+
+class TestSqliteRangeSearch(SqliteStorage, TestRangeSearch):
+    pass
+
+class TestSqliteCompoundSearch(SqliteStorage, TestCompoundSearch):
+    pass
+
+class TestSqliteScanSearch(SqliteStorage, TestScanSearch):
+    pass
+
+class TestSqliteServer(SqliteStorage, TestServer):
+    pass
+
+class TestSqliteGroup(SqliteStorage, TestGroup):
+    pass
+
+class TestSqliteQueryCache(SqliteStorage, TestQueryCache):
+    pass
+
+class TestSqliteStats(SqliteStorage, TestStats):
+    pass
+
+class TestSqliteReload(SqliteStorage, TestReload):
+    def test_compact(self):
+        """Test deleted records are kept in the database rather than stored again"""
+        self.rewrite("users.json", lambda users: users[:10])
+        self.assertListEqual(reload_files(), ["users.json: 0 added, 0 changed, 65 removed"])
+        self.assertEqual(USERS.values.live_count(), 10)
+        reloaded = self.found_ids()
+        # The deleted flags are saved, so a database used again finds the same records
+        do_init(True)
+        self.assertTrue(USERS.from_snapshot)
+        self.assertEqual(len(USERS.values.deleted), 65)
+        self.assertDictEqual(reloaded, self.found_ids())
+        do_init(False)
+        self.assertDictEqual(reloaded, self.found_ids())
+
+class TestSqliteStore(unittest.TestCase):
+    """Test storing records in sqlite"""
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+
+    def test_round_trip(self):
+        """Test records read back from the database match those stored in memory"""
+        filename = os.path.join(self.tmpdir.name, "tickets.json")
+        shutil.copy("tickets.json", filename)
+        with contextlib.redirect_stderr(io.StringIO()):
+            expected = ValidatedDictList(filename, "tickets", TICKETS_SCHEMA)
+            tickets = SqliteDictList(filename, "tickets", TICKETS_SCHEMA, use_snapshot=True)
+        self.assertFalse(tickets.from_snapshot)
+        self.assertListEqual(list(tickets.values), [dict(record) for record in expected.values])
+        self.assertEqual(tickets.values[-1], dict(expected.values[-1]))
+        self.assertEqual(tickets.values.field_values("tags", [3, 1, 2]),
+                         expected.values.field_values("tags", [3, 1, 2]))
+        for field_name in ("due_at", "organization_id"):
+            self.assertEqual(tickets.range_index(field_name), expected.range_index(field_name))
+        tickets.save_snapshot()
+        # The database is used again until the file changes
+        with contextlib.redirect_stderr(io.StringIO()) as output:
+            again = SqliteDictList(filename, "tickets", TICKETS_SCHEMA, use_snapshot=True)
+        self.assertTrue(again.from_snapshot)
+        self.assertEqual(output.getvalue(), "")
+        self.assertEqual(len(again.values), len(expected.values))
+        TestReload.rewrite(filename, lambda records: records[:5])
+        changed = SqliteDictList(filename, "tickets", TICKETS_SCHEMA, use_snapshot=True)
+        self.assertFalse(changed.from_snapshot)
+        self.assertEqual(len(changed.values), 5)
+
+    def test_field_index(self):
+        """Test sqlite lookups match on the string form of values as the indexes in memory do"""
+        filename = os.path.join(self.tmpdir.name, "values.json")
+        with open(filename, "w") as jsonfile:
+            # Only missing id fields are left as None by validation
+            json.dump([{"_id": 1, "number_id": 7, "flag": True, "text": "None", "tags": ["a"],
+                        "extra": 1},
+                       {"_id": 2, "number_id": -7, "flag": False, "text": "", "tags": ["a", "b"]},
+                       {"_id": 3, "flag": False, "text": "007", "tags": []},
+                       {"_id": 4, "number_id": 7, "flag": True, "text": "x", "tags": ["a"]}],
+                      jsonfile)
+        schema = {"_id": int, "number_id": int, "flag": bool, "text": str, "tags": list}
+        with contextlib.redirect_stderr(io.StringIO()):
+            expected = ValidatedDictList(filename, "values", schema)
+            values = SqliteDictList(filename, "values", schema)
+        for field_name in ("number_id", "flag", "text", "tags", "extra"):
+            self.assertEqual(sorted(values.index(field_name)), sorted(expected.index(field_name)))
+            self.assertEqual(dict(values.index(field_name).items()),
+                             expected.index(field_name))
+            for text in ("7", "07", "-7", "+7", "None", "True", "False", "007", "['a']", "1", ""):
+                self.assertEqual(values.lookup(field_name, text),
+                                 expected.lookup(field_name, text), (field_name, text))
+            for prefix in ("", "N", "0", "T", "["):
+                self.assertEqual(values.complete(field_name, prefix),
+                                 expected.complete(field_name, prefix), (field_name, prefix))
+        self.assertEqual(values.values[0]["extra"], 1)
+        with self.assertRaises(FailedException):
+            unique_index(values, "number_id")
+        self.assertEqual(dict(unique_index(values, "_id").items()), unique_index(expected, "_id"))
+        values.delete(0)
+        self.assertEqual(values.lookup("number_id", 7), [3])
+        self.assertIsNone(values.duplicate_value("number_id"))
+
 if __name__ == "__main__":
+    args = parse_args()
+    set_scan_jobs(args.scan_jobs)
+    STATS.enabled = not args.no_stats
+    VALIDATE_JOBS = args.validate_jobs
+    VERBOSE_WARNINGS = args.verbose
+    OUTPUT_FORMAT = args.format or FORMAT_TEXT
+    STORAGE = args.storage
+    QUERY_CACHE.resize(args.cache_entries, int(args.cache_mb * 1024 * 1024))
     try:
-        do_init()
-        do_interactive()
+        if args.connect:
+            commands = RemoteSearchCommands(SearchClient(*args.connect))
+            if args.format:
+                # The server writes the results, so it needs to be told the format
+                commands.onecmd("format " + args.format)
+            if args.command:
+                commands.onecmd(" ".join(args.command))
+            else:
+                do_interactive(commands)
+        else:
+            do_init(not args.no_snapshots)
+            if args.batch == "-":
+                do_batch(sys.stdin, sys.stdout, args.jobs)
+            elif args.batch:
+                with open_batch_file(args.batch) as batchfile:
+                    do_batch(batchfile, sys.stdout, args.jobs)
+            elif args.command:
+                SearchCommands().onecmd(" ".join(args.command))
+            else:
+                if args.watch:
+                    watch_files(args.watch)
+                if args.serve:
+                    do_serve(*args.serve, threads=args.threads)
+                else:
+                    do_interactive()
     except FailedException:
         # Don't mess up the console with a FailedException
         # Error message is already printed